@@ -1,5 +1,7 @@
-from pydantic import Field, HttpUrl, PositiveInt
-from pydantic_settings import BaseSettings
+from functools import lru_cache
+
+from pydantic import Field, HttpUrl, PositiveFloat, PositiveInt
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class WhatsAppConfig(BaseSettings):
@@ -33,6 +35,42 @@ class OpenRouterConfig(BaseSettings):
         default="",
     )
 
+    OPENROUTER_BASE_URL: str = Field(
+        description="Base URL for the OpenRouter API",
+        default="https://openrouter.ai/api/v1",
+    )
+
+    AI_MODEL: str = Field(
+        description="OpenRouter model used for open-ended lead conversations",
+        default="google/gemini-3-flash-preview",
+    )
+
+    AI_MODEL_LIGHT: str = Field(
+        description="Cheaper OpenRouter model used for short, low-stakes turns",
+        default="google/gemini-2.5-flash-lite",
+    )
+
+
+class HumanizationConfig(BaseSettings):
+    """
+    Configuration for humanized reply pacing (simulated reading + typing)
+    """
+
+    TYPING_DELAY_MIN: PositiveFloat = Field(
+        description="Minimum thinking time in seconds before the reply starts being typed",
+        default=1.5,
+    )
+
+    TYPING_DELAY_MAX: PositiveFloat = Field(
+        description="Maximum thinking time in seconds before the reply starts being typed",
+        default=4.0,
+    )
+
+    CHARS_PER_SECOND: PositiveFloat = Field(
+        description="Simulated human typing speed in characters per second (~60 WPM)",
+        default=6.0,
+    )
+
 
 class BrokerAssignmentConfig(BaseSettings):
     """
@@ -79,3 +117,26 @@ class FollowUpConfig(BaseSettings):
         description="Final contact follow-up interval in hours (14 days)",
         default=336,
     )
+
+
+class WhatsAppBrokerConfig(
+    WhatsAppConfig, OpenRouterConfig, HumanizationConfig, BrokerAssignmentConfig, FollowUpConfig
+):
+    """
+    Combined WhatsApp broker settings, validated once and read-only afterwards
+    """
+
+    model_config = SettingsConfigDict(
+        # read from dotenv format config file
+        env_file=".env",
+        env_file_encoding="utf-8",
+        # ignore extra attributes
+        extra="ignore",
+        frozen=True,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_whatsapp_config() -> WhatsAppBrokerConfig:
+    """Load the WhatsApp broker settings once per process."""
+    return WhatsAppBrokerConfig()
@@ -1,19 +1,28 @@
 """WhatsApp message service for AI integration and property image sending."""
+import asyncio
+import atexit
 import logging
-import os
+import random
+import re
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
 from typing import Any
 
 import httpx
+import orjson
+
+from configs.feature.whatsapp_broker_config import get_whatsapp_config
+
+from .waha_client import get_waha_client
 
 logger = logging.getLogger(__name__)
 
-# OpenRouter API Configuration
-OPENROUTER_API_KEY = os.getenv(
-    "OPENROUTER_API_KEY",
-    "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"
-)
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
-AI_MODEL = "google/gemini-3-flash-preview"
+# OpenRouter, model and pacing settings are read once from the shared WhatsApp config
+settings = get_whatsapp_config()
+
+# Short, low-stakes turns go to settings.AI_MODEL_LIGHT (see choose_model)
+LIGHT_TURN_MAX_CHARS = 40
+LIGHT_TURN_MAX_WORDS = 6
 
 SYSTEM_PROMPT = """Você é um assistente imobiliário especializado no Ceará.
 Seu objetivo é:
@@ -37,10 +46,165 @@ Depois informe: "Com sua renda de R$ X, você pode financiar imóveis de até R$
 
 Seja amigável e objetivo. Use emojis moderadamente."""
 
+VISIT_CONFIRMATION_TEMPLATE = """✅ *Visita Agendada!*
+
+Imóvel: {property_title}
+Corretor: {broker_name}
+Data/Hora: {scheduled_at}
+
+O corretor entrará em contato com você em breve para confirmar os detalhes.
+
+Qualquer dúvida, estou à disposição! 😊"""
+
+BROKER_VISIT_NOTIFICATION_TEMPLATE = """🏠 *Nova Visita Agendada*
+
+Lead: {lead_name}
+Telefone: {lead_phone}
+Imóvel: {property_title}
+Data/Hora: {scheduled_at}
+
+Responda "ACEITAR" para confirmar ou "RECUSAR" para recusar esta visita.
+
+Você tem 30 minutos para responder."""
+
+STATIC_GREETING = (
+    "Olá! 😊 Sou seu assistente imobiliário no Ceará. "
+    "Para encontrar o imóvel ideal para você, qual sua renda mensal?"
+)
+
+# Deterministic replies for trivial turns, answered without calling the model
+_INTENT_RULES: list[tuple[re.Pattern[str], str]] = [
+    (
+        re.compile(r"^\s*(?:oi+|ol[aá]|e a[ií]|bom dia|boa tarde|boa noite)\s*[!.]*\s*$", re.IGNORECASE),
+        STATIC_GREETING,
+    ),
+]
+_DIGIT_RE = re.compile(r"\d")
+
+# System prompt as a cacheable content block: the static prefix is processed once per
+# cache window by providers that support prompt caching instead of on every request
+SYSTEM_PROMPT_CONTENT = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://sells.orquestr.ai",
+    "X-Title": "Sells - Real Estate AI Assistant",
+}
+OPENROUTER_LIMITS = httpx.Limits(max_keepalive_connections=20, keepalive_expiry=90)
+
+# Pooled OpenRouter clients, reused across messages to keep the TLS connection warm.
+# The async client is bound to the webhook service's long-lived event loop.
+_OPENROUTER_CLIENT = httpx.Client(
+    base_url=settings.OPENROUTER_BASE_URL, headers=OPENROUTER_HEADERS, timeout=30.0, limits=OPENROUTER_LIMITS
+)
+_OPENROUTER_ASYNC_CLIENT = httpx.AsyncClient(
+    base_url=settings.OPENROUTER_BASE_URL, headers=OPENROUTER_HEADERS, timeout=30.0, limits=OPENROUTER_LIMITS
+)
+atexit.register(_OPENROUTER_CLIENT.close)
+
+# Media (property photos) is relayed chunk by chunk instead of buffering whole files.
+# Chunks well above httpx's default keep per-chunk overhead low; memory stays O(chunk).
+MEDIA_CHUNK_SIZE = 128 * 1024
+_MEDIA_ASYNC_CLIENT = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0), follow_redirects=True)
+
+
+async def aclose_async_clients() -> None:
+    """
+    Close the pooled async clients.
+
+    Must run on the event loop that used them; the webhook service schedules this
+    on its long-lived loop at interpreter exit.
+    """
+    await _OPENROUTER_ASYNC_CLIENT.aclose()
+    await _MEDIA_ASYNC_CLIENT.aclose()
+
 
 class WhatsAppMessageService:
     """Service for managing WhatsApp messages with AI integration."""
 
+    @staticmethod
+    def choose_model(text: str) -> tuple[str, int]:
+        """
+        Pick the model and token budget for a turn.
+
+        The payload carries only the current message (no conversation history), so the
+        choice is made from the text alone: short one-liners without numbers
+        (acknowledgements, quick questions) go to the light model; anything carrying
+        income/price figures or longer messages stays on the flagship model.
+
+        Args:
+            text: User message text
+
+        Returns:
+            Tuple of (model, max_tokens)
+        """
+        if (
+            len(text) <= LIGHT_TURN_MAX_CHARS
+            and len(text.split()) <= LIGHT_TURN_MAX_WORDS
+            and not _DIGIT_RE.search(text)
+        ):
+            return settings.AI_MODEL_LIGHT, 200
+        return settings.AI_MODEL, 500
+
+    @staticmethod
+    def _static_reply(message: str) -> str | None:
+        """Return a canned reply if the message matches a deterministic intent rule."""
+        for pattern, reply in _INTENT_RULES:
+            if pattern.match(message):
+                return reply
+        return None
+
+    @staticmethod
+    def _build_ai_payload(message: str) -> dict[str, Any]:
+        """Build the OpenRouter chat completion payload for a user message."""
+        model, max_tokens = WhatsAppMessageService.choose_model(message)
+        return {
+            "model": model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": SYSTEM_PROMPT_CONTENT
+                },
+                {
+                    "role": "user",
+                    "content": message
+                }
+            ],
+            "temperature": 0.7,
+            "max_tokens": max_tokens
+        }
+
+    @staticmethod
+    def _ai_error_message(e: Exception) -> str:
+        """Log an OpenRouter failure and return the fallback reply for the lead."""
+        if isinstance(e, httpx.HTTPStatusError):
+            logger.error(f"HTTP error from OpenRouter API: {e.response.status_code} - {e.response.text}")
+            return "Desculpe, estou com dificuldades técnicas no momento. Por favor, tente novamente em instantes."
+        if isinstance(e, httpx.RequestError):
+            logger.error(f"Network error calling OpenRouter API: {e}")
+            return "Desculpe, não consegui me conectar ao serviço. Verifique sua conexão e tente novamente."
+        if isinstance(e, (KeyError, IndexError)):
+            logger.error(f"Unexpected API response format: {e}")
+            return "Desculpe, recebi uma resposta inesperada. Por favor, tente novamente."
+        logger.exception(f"Unexpected error getting AI response: {e}")
+        return "Desculpe, ocorreu um erro inesperado. Por favor, tente novamente."
+
+    @staticmethod
+    def calculate_human_delay(response_text: str) -> float:
+        """
+        Calculate how long a human would take to read and type a reply.
+
+        Args:
+            response_text: Reply that is about to be sent
+
+        Returns:
+            Delay in seconds, clamped between 2 and 12
+        """
+        thinking_time = random.uniform(settings.TYPING_DELAY_MIN, settings.TYPING_DELAY_MAX)
+        typing_time = len(response_text) / settings.CHARS_PER_SECOND * random.uniform(0.8, 1.2)
+        return min(max(thinking_time + typing_time, 2.0), 12.0)
+
     @staticmethod
     def get_ai_response(conversation_id: str, message: str) -> str:
         """
@@ -56,60 +220,111 @@ class WhatsAppMessageService:
         Returns:
             AI-generated response text
         """
+        static_reply = WhatsAppMessageService._static_reply(message)
+        if static_reply is not None:
+            return static_reply
+
         try:
             logger.info(f"Getting AI response for conversation {conversation_id}")
 
-            # Prepare the API request payload
-            payload = {
-                "model": AI_MODEL,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": SYSTEM_PROMPT
-                    },
-                    {
-                        "role": "user",
-                        "content": message
-                    }
-                ],
-                "temperature": 0.7,
-                "max_tokens": 500
-            }
-
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://sells.orquestr.ai",
-                "X-Title": "Sells - Real Estate AI Assistant"
-            }
-
-            # Make synchronous HTTP request to OpenRouter
-            with httpx.Client(timeout=30.0) as client:
-                response = client.post(
-                    f"{OPENROUTER_BASE_URL}/chat/completions",
-                    json=payload,
-                    headers=headers
-                )
-                response.raise_for_status()
+            payload = WhatsAppMessageService._build_ai_payload(message)
 
-                data = response.json()
-                ai_message = data["choices"][0]["message"]["content"]
+            # Make synchronous HTTP request to OpenRouter over the pooled client
+            response = _OPENROUTER_CLIENT.post("/chat/completions", json=payload)
+            response.raise_for_status()
 
-                logger.info(f"Successfully got AI response for conversation {conversation_id}")
-                return ai_message.strip()
+            data = orjson.loads(response.content)
+            ai_message = data["choices"][0]["message"]["content"]
+
+            logger.info(f"Successfully got AI response for conversation {conversation_id}")
+            return ai_message.strip()
+
+        except Exception as e:
+            return WhatsAppMessageService._ai_error_message(e)
+
+    @staticmethod
+    async def aget_ai_response(
+        conversation_id: str, message: str, on_first_token: Callable[[], Awaitable[Any]] | None = None
+    ) -> str:
+        """
+        Async variant of get_ai_response that streams the completion.
+
+        The reply is accumulated from server-sent event deltas. As soon as the
+        first non-empty delta arrives, on_first_token is started in the background
+        (e.g. to show "typing..." to the lead) while the rest of the text streams in.
+
+        Args:
+            conversation_id: Conversation ID to maintain context
+            message: User message text
+            on_first_token: Optional coroutine factory fired once on the first delta
+
+        Returns:
+            AI-generated response text
+        """
+        static_reply = WhatsAppMessageService._static_reply(message)
+        if static_reply is not None:
+            return static_reply
+
+        first_token_task: asyncio.Task | None = None
+        try:
+            logger.info(f"Getting AI response for conversation {conversation_id}")
+
+            payload = WhatsAppMessageService._build_ai_payload(message)
+            payload["stream"] = True
+
+            chunks: list[str] = []
+            async with _OPENROUTER_ASYNC_CLIENT.stream("POST", "/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    # SSE: keep only "data: ..." lines, skip keep-alive comments
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        break
+                    delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+                    if not delta:
+                        continue
+                    if first_token_task is None and on_first_token is not None:
+                        first_token_task = asyncio.create_task(on_first_token())
+                    chunks.append(delta)
+
+            if not chunks:
+                raise KeyError("content")
+
+            logger.info(f"Successfully got AI response for conversation {conversation_id}")
+            return "".join(chunks).strip()
 
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error from OpenRouter API: {e.response.status_code} - {e.response.text}")
-            return "Desculpe, estou com dificuldades técnicas no momento. Por favor, tente novamente em instantes."
-        except httpx.RequestError as e:
-            logger.error(f"Network error calling OpenRouter API: {e}")
-            return "Desculpe, não consegui me conectar ao serviço. Verifique sua conexão e tente novamente."
-        except (KeyError, IndexError) as e:
-            logger.error(f"Unexpected API response format: {e}")
-            return "Desculpe, recebi uma resposta inesperada. Por favor, tente novamente."
         except Exception as e:
-            logger.exception(f"Unexpected error getting AI response: {e}")
-            return "Desculpe, ocorreu um erro inesperado. Por favor, tente novamente."
+            if isinstance(e, httpx.HTTPStatusError):
+                await e.response.aread()
+            return WhatsAppMessageService._ai_error_message(e)
+        finally:
+            if first_token_task is not None:
+                try:
+                    await first_token_task
+                except Exception as e:
+                    logger.warning(f"First-token callback failed for conversation {conversation_id}: {e}")
+
+    @staticmethod
+    async def _stream_proxy(src_url: str, write: Callable[[bytes], Awaitable[Any]]) -> int:
+        """
+        Stream a remote file into a destination without holding it in memory.
+
+        Args:
+            src_url: URL of the source file (e.g. a property photo)
+            write: Async sink called with each chunk (upload body, file, etc.)
+
+        Returns:
+            Number of bytes transferred
+        """
+        transferred = 0
+        async with _MEDIA_ASYNC_CLIENT.stream("GET", src_url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                await write(chunk)
+                transferred += len(chunk)
+        return transferred
 
     @staticmethod
     async def send_property_with_image(session: str, chat_id: str, property_data: dict[str, Any]) -> None:
@@ -122,9 +337,7 @@ class WhatsAppMessageService:
             property_data: Property data including image URL and details
         """
         try:
-            from .waha_client import WAHAClient
-
-            client = WAHAClient()
+            client = get_waha_client()
 
             # Extract property details
             title = property_data.get("title", "Imóvel")
@@ -166,26 +379,13 @@ class WhatsAppMessageService:
             visit: Visit data including property, broker, and scheduled time
         """
         try:
-            from .waha_client import WAHAClient
-
-            client = WAHAClient()
+            client = get_waha_client()
 
             # TODO: Get active session for tenant
             session = "default"  # Replace with actual session lookup
 
-            property_title = visit.get("property_title", "")
-            broker_name = visit.get("broker_name", "")
-            scheduled_at = visit.get("scheduled_at", "")
-
-            message = f"""✅ *Visita Agendada!*
-
-Imóvel: {property_title}
-Corretor: {broker_name}
-Data/Hora: {scheduled_at}
-
-O corretor entrará em contato com você em breve para confirmar os detalhes.
-
-Qualquer dúvida, estou à disposição! 😊"""
+            # Missing fields render as empty strings
+            message = VISIT_CONFIRMATION_TEMPLATE.format_map(defaultdict(str, visit))
 
             await client.send_text(session, lead_phone, message)
             logger.info(f"Sent visit confirmation to {lead_phone}")
@@ -202,28 +402,13 @@ Qualquer dúvida, estou à disposição! 😊"""
             visit: Visit data including lead and property details
         """
         try:
-            from .waha_client import WAHAClient
-
-            client = WAHAClient()
+            client = get_waha_client()
 
             # TODO: Get active session for tenant
             session = "default"
 
-            lead_name = visit.get("lead_name", "")
-            lead_phone = visit.get("lead_phone", "")
-            property_title = visit.get("property_title", "")
-            scheduled_at = visit.get("scheduled_at", "")
-
-            message = f"""🏠 *Nova Visita Agendada*
-
-Lead: {lead_name}
-Telefone: {lead_phone}
-Imóvel: {property_title}
-Data/Hora: {scheduled_at}
-
-Responda "ACEITAR" para confirmar ou "RECUSAR" para recusar esta visita.
-
-Você tem 30 minutos para responder."""
+            # Missing fields render as empty strings
+            message = BROKER_VISIT_NOTIFICATION_TEMPLATE.format_map(defaultdict(str, visit))
 
             await client.send_text(session, broker_phone, message)
             logger.info(f"Sent visit notification to broker {broker_phone}")
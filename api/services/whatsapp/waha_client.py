@@ -3,11 +3,20 @@ import logging
 from typing import Any
 
 import httpx
+import orjson
 
-from configs import dify_config
+from configs.feature.whatsapp_broker_config import get_whatsapp_config
 
 logger = logging.getLogger(__name__)
 
+# Keep-alive pool shared by every request made through a client instance
+WAHA_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60)
+WAHA_HTTP_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=5.0)
+WAHA_MAX_REDIRECTS = 3
+
+# WAHA replies are small JSON ACKs; anything larger is treated as a malformed response
+WAHA_MAX_RESPONSE_BYTES = 1_000_000
+
 
 class WAHAClient:
     """Client for interacting with WAHA API."""
@@ -20,9 +29,59 @@ class WAHAClient:
             base_url: WAHA API base URL (defaults to env var WAHA_BASE_URL)
             api_key: WAHA API key (defaults to env var WAHA_API_KEY)
         """
-        self.base_url = base_url or getattr(dify_config, "WAHA_BASE_URL", "http://waha:3000")
-        self.api_key = api_key or getattr(dify_config, "WAHA_API_KEY", "")
+        config = get_whatsapp_config()
+        self.base_url = base_url or str(config.WAHA_BASE_URL)
+        self.api_key = api_key or config.WAHA_API_KEY
         self.headers = {"X-Api-Key": self.api_key, "Content-Type": "application/json"}
+        self._client = httpx.AsyncClient(
+            base_url=str(self.base_url),
+            headers=self.headers,
+            timeout=WAHA_HTTP_TIMEOUT,
+            limits=WAHA_HTTP_LIMITS,
+            max_redirects=WAHA_MAX_REDIRECTS,
+        )
+
+    async def __aenter__(self) -> "WAHAClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the underlying connection pool."""
+        await self._client.aclose()
+
+    async def _request_json(self, method: str, path: str, json: dict[str, Any] | None = None) -> Any:
+        """
+        Send a request to WAHA and decode the JSON reply.
+
+        The body is streamed and capped at WAHA_MAX_RESPONSE_BYTES so a misbehaving
+        upstream cannot make us buffer an unbounded response.
+
+        Args:
+            method: HTTP method
+            path: API path relative to the base URL
+            json: Optional JSON request body
+
+        Returns:
+            Decoded JSON response (empty dict for an empty body)
+        """
+        request = self._client.build_request(method, path, json=json)
+        response = await self._client.send(request, stream=True)
+        try:
+            response.raise_for_status()
+            if int(response.headers.get("content-length") or 0) > WAHA_MAX_RESPONSE_BYTES:
+                raise httpx.DecodingError("WAHA response body too large", request=request)
+
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) > WAHA_MAX_RESPONSE_BYTES:
+                    raise httpx.DecodingError("WAHA response body too large", request=request)
+        finally:
+            await response.aclose()
+
+        return orjson.loads(body) if body else {}
 
     async def create_session(self, session_name: str) -> dict[str, Any]:
         """
@@ -35,13 +94,9 @@ class WAHAClient:
             Session creation response with QR code and status
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/api/sessions", headers=self.headers, json={"name": session_name}
-                )
-                response.raise_for_status()
-                logger.info(f"Created WAHA session: {session_name}")
-                return response.json()
+            data = await self._request_json("POST", "/api/sessions", json={"name": session_name})
+            logger.info(f"Created WAHA session: {session_name}")
+            return data
         except httpx.HTTPError as e:
             logger.exception(f"Failed to create WAHA session {session_name}: {e}")
             raise
@@ -57,11 +112,8 @@ class WAHAClient:
             QR code as base64 string
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{self.base_url}/api/sessions/{session_name}/qr", headers=self.headers)
-                response.raise_for_status()
-                data = response.json()
-                return data.get("qr", "")
+            data = await self._request_json("GET", f"/api/sessions/{session_name}/qr")
+            return data.get("qr", "")
         except httpx.HTTPError as e:
             logger.exception(f"Failed to get QR code for session {session_name}: {e}")
             raise
@@ -77,10 +129,7 @@ class WAHAClient:
             Session status information
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{self.base_url}/api/sessions/{session_name}", headers=self.headers)
-                response.raise_for_status()
-                return response.json()
+            return await self._request_json("GET", f"/api/sessions/{session_name}")
         except httpx.HTTPError as e:
             logger.exception(f"Failed to get session status {session_name}: {e}")
             raise
@@ -98,19 +147,40 @@ class WAHAClient:
             Send message response
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/api/{session}/sendText",
-                    headers=self.headers,
-                    json={"chatId": chat_id, "text": text},
-                )
-                response.raise_for_status()
-                logger.info(f"Sent text message to {chat_id} via session {session}")
-                return response.json()
+            data = await self._request_json(
+                "POST",
+                f"/api/{session}/sendText",
+                json={"chatId": chat_id, "text": text},
+            )
+            logger.info(f"Sent text message to {chat_id} via session {session}")
+            return data
         except httpx.HTTPError as e:
             logger.exception(f"Failed to send text message to {chat_id}: {e}")
             raise
 
+    async def start_typing(self, session: str, chat_id: str) -> dict[str, Any]:
+        """
+        Show the "typing..." presence indicator in a chat.
+
+        Args:
+            session: Session name
+            chat_id: Recipient chat ID
+
+        Returns:
+            Presence update response
+        """
+        try:
+            data = await self._request_json(
+                "POST",
+                f"/api/{session}/presence",
+                json={"chatId": chat_id, "presence": "typing"},
+            )
+            logger.info(f"Sent typing indicator to {chat_id} via session {session}")
+            return data
+        except httpx.HTTPError as e:
+            logger.exception(f"Failed to send typing indicator to {chat_id}: {e}")
+            raise
+
     async def send_image(self, session: str, chat_id: str, image_url: str, caption: str | None = None) -> dict[str, Any]:
         """
         Send image message via WhatsApp.
@@ -129,13 +199,9 @@ class WAHAClient:
             if caption:
                 payload["caption"] = caption
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/api/{session}/sendImage", headers=self.headers, json=payload
-                )
-                response.raise_for_status()
-                logger.info(f"Sent image to {chat_id} via session {session}")
-                return response.json()
+            data = await self._request_json("POST", f"/api/{session}/sendImage", json=payload)
+            logger.info(f"Sent image to {chat_id} via session {session}")
+            return data
         except httpx.HTTPError as e:
             logger.exception(f"Failed to send image to {chat_id}: {e}")
             raise
@@ -161,13 +227,9 @@ class WAHAClient:
             if title:
                 payload["title"] = title
 
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/api/{session}/sendLocation", headers=self.headers, json=payload
-                )
-                response.raise_for_status()
-                logger.info(f"Sent location to {chat_id} via session {session}")
-                return response.json()
+            data = await self._request_json("POST", f"/api/{session}/sendLocation", json=payload)
+            logger.info(f"Sent location to {chat_id} via session {session}")
+            return data
         except httpx.HTTPError as e:
             logger.exception(f"Failed to send location to {chat_id}: {e}")
             raise
@@ -183,11 +245,25 @@ class WAHAClient:
             Deletion response
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(f"{self.base_url}/api/sessions/{session_name}", headers=self.headers)
-                response.raise_for_status()
-                logger.info(f"Deleted WAHA session: {session_name}")
-                return response.json()
+            data = await self._request_json("DELETE", f"/api/sessions/{session_name}")
+            logger.info(f"Deleted WAHA session: {session_name}")
+            return data
         except httpx.HTTPError as e:
             logger.exception(f"Failed to delete WAHA session {session_name}: {e}")
             raise
+
+
+_shared_client: WAHAClient | None = None
+
+
+def get_waha_client() -> WAHAClient:
+    """
+    Return the process-wide WAHA client.
+
+    The shared instance keeps its connection pool alive across calls, so
+    consecutive sends reuse the same TCP connections to WAHA.
+    """
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = WAHAClient()
+    return _shared_client
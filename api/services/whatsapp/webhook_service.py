@@ -1,15 +1,89 @@
 """WhatsApp webhook service for handling incoming messages and events."""
 import asyncio
+import atexit
 import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from typing import Any
 
+import orjson
 from flask import Response
 
-from .message_service import WhatsAppMessageService
-from .waha_client import WAHAClient
+from .message_service import WhatsAppMessageService, aclose_async_clients
+from .waha_client import get_waha_client
 
 logger = logging.getLogger(__name__)
 
+# Broker replies to visit assignment notifications ("ACEITAR" / "RECUSAR").
+# One alternation with a named group per intent: a single search classifies the
+# reply by its first keyword, and new intents only need a new group here.
+BROKER_INTENT_RE = re.compile(
+    r"\b(?:"
+    r"(?P<decline>recus(?:ar|o)|n[aã]o|cancel\w*)"
+    r"|(?P<accept>aceit(?:ar|o)|sim|confirm\w*)"
+    r")\b",
+    re.IGNORECASE,
+)
+
+ACCEPTED_RESPONSE_BODY = orjson.dumps({"status": "accepted", "message": "Message accepted for processing"})
+
+# Message IDs already accepted; WAHA redelivers webhooks on non-2xx/timeouts
+MAX_SEEN_IDS = 10_000
+_SEEN_IDS: OrderedDict[str, None] = OrderedDict()
+_SEEN_IDS_LOCK = threading.Lock()
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the long-lived event loop that runs WhatsApp message processing.
+
+    The loop lives on a daemon thread for the whole process so pooled async
+    HTTP clients (OpenRouter, WAHA) keep their connections across webhooks.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="whatsapp-event-loop", daemon=True).start()
+    return _loop
+
+
+def _close_async_clients() -> None:
+    """Close the pooled async HTTP clients on their event loop at interpreter exit."""
+    with _loop_lock:
+        loop = _loop
+    if loop is None or not loop.is_running():
+        return  # The loop never started, so no connection was opened
+    try:
+        asyncio.run_coroutine_threadsafe(aclose_async_clients(), loop).result(timeout=5)
+    except Exception as e:
+        logger.warning(f"Error closing WhatsApp async HTTP clients: {e}")
+
+
+atexit.register(_close_async_clients)
+
+
+def _is_duplicate(message_id: str) -> bool:
+    """Record a message ID and report whether it was already seen."""
+    with _SEEN_IDS_LOCK:
+        if message_id in _SEEN_IDS:
+            return True
+        _SEEN_IDS[message_id] = None
+        if len(_SEEN_IDS) > MAX_SEEN_IDS:
+            _SEEN_IDS.popitem(last=False)
+        return False
+
+
+def _log_processing_failure(future: Future) -> None:
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"Error processing WhatsApp message in background: {exc}", exc_info=exc)
+
 
 class WhatsAppWebhookService:
     """Service for handling WhatsApp webhook events."""
@@ -17,9 +91,10 @@ class WhatsAppWebhookService:
     @staticmethod
     def handle_incoming_message(payload: dict[str, Any]) -> Response:
         """
-        Handle incoming WhatsApp message from WAHA webhook synchronously.
+        Handle incoming WhatsApp message from WAHA webhook.
 
-        Processes the message, gets AI response, and sends reply - all synchronously.
+        Validates the message and schedules the AI response + reply on the shared
+        event loop, so the webhook returns without waiting for OpenRouter or WAHA.
 
         Args:
             payload: Webhook payload containing message data
@@ -60,24 +135,26 @@ class WhatsAppWebhookService:
                 logger.debug(f"Ignoring non-text message type: {message_type}")
                 return Response(status=200)
 
-            logger.info(f"Processing message from {from_number}: {message_text[:50]}...")
-
-            # 5. Get AI response synchronously using conversation_id (phone number)
-            conversation_id = from_number
-            ai_response = WhatsAppMessageService.get_ai_response(conversation_id, message_text)
-
-            logger.info(f"Got AI response for {from_number}: {ai_response[:50]}...")
+            # Redelivered webhook (same message ID): already handled, acknowledge only.
+            # Checked only after validation so ignored events (e.g. message.any) with the same
+            # ID don't mark the real message as seen
+            message_id = message_data.get("id")
+            if message_id and _is_duplicate(message_id):
+                logger.debug(f"Ignoring duplicate webhook for message {message_id}")
+                return Response(status=200)
 
-            # 6. Send response via WAHA synchronously
-            client = WAHAClient()
-            send_result = asyncio.run(client.send_text(session, from_number, ai_response))
+            logger.info(f"Processing message from {from_number}: {message_text[:50]}...")
 
-            logger.info(f"Successfully sent response to {from_number} via session {session}")
+            # 5. Hand the AI call + reply off to the shared event loop so the worker returns immediately
+            future = asyncio.run_coroutine_threadsafe(
+                WhatsAppWebhookService.process_message(session, from_number, message_text), get_event_loop()
+            )
+            future.add_done_callback(_log_processing_failure)
 
-            # 7. Return success status
+            # 6. Return accepted status
             return Response(
                 status=200,
-                response='{"status": "processed", "message": "Message processed and response sent"}',
+                response=ACCEPTED_RESPONSE_BODY,
                 mimetype="application/json",
             )
 
@@ -85,10 +162,41 @@ class WhatsAppWebhookService:
             logger.exception(f"Error handling incoming message: {e}")
             return Response(
                 status=500,
-                response=f'{{"status": "error", "message": "Internal server error: {str(e)}"}}',
+                response=orjson.dumps({"status": "error", "message": f"Internal server error: {e}"}),
                 mimetype="application/json",
             )
 
+    @staticmethod
+    async def process_message(session: str, from_number: str, message_text: str) -> dict[str, Any]:
+        """
+        Get the AI reply for a message and send it back via WAHA.
+
+        Args:
+            session: WAHA session name
+            from_number: Sender chat ID, also used as conversation ID
+            message_text: Incoming message text
+
+        Returns:
+            WAHA send response
+        """
+        client = get_waha_client()
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        ai_response = await WhatsAppMessageService.aget_ai_response(
+            from_number, message_text, on_first_token=lambda: client.start_typing(session, from_number)
+        )
+        logger.info(f"Got AI response for {from_number}: {ai_response[:50]}...")
+
+        # "Typing..." is already showing since the first token; time spent waiting on
+        # the model counts toward the humanized delay and the rest yields the loop
+        delay = WhatsAppMessageService.calculate_human_delay(ai_response) - (loop.time() - started_at)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        send_result = await client.send_text(session, from_number, ai_response)
+        logger.info(f"Successfully sent response to {from_number} via session {session}")
+        return send_result
+
     @staticmethod
     def handle_session_status(payload: dict[str, Any]) -> Response:
         """
@@ -129,13 +237,14 @@ class WhatsAppWebhookService:
         """
         try:
             from_number = payload.get("from_number", "")
-            message_text = payload.get("message_text", "").lower().strip()
+            message_text = payload.get("message_text", "")
 
             # Check if this is from a broker
-            # Look for keywords like "aceitar", "recusar", "sim", "não"
             # Extract visit ID from context (could be stored in conversation state)
+            match = BROKER_INTENT_RE.search(message_text)
+            decision = match.lastgroup if match else None
 
-            logger.info(f"Broker {from_number} responded: {message_text}")
+            logger.info(f"Broker {from_number} responded ({decision}): {message_text}")
 
             # Process broker response
             # Update BrokerAssignment status
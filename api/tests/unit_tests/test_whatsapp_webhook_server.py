@@ -0,0 +1,252 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import whatsapp_webhook_server as ws
+
+
+@pytest.fixture(autouse=True)
+def _isolated_history(monkeypatch):
+    """Keep conversation state in memory only (no SQLite reads/writes)."""
+    monkeypatch.setattr(ws, "save_message_to_db", lambda *args, **kwargs: 0)
+    monkeypatch.setattr(ws, "get_conversation_history_from_db", lambda *args, **kwargs: [])
+    yield
+    ws.conversation_history.clear()
+    ws._history_versions.clear()
+    ws.conversation_state.clear()
+
+
+def _send_window_overflow_conversation(conversation_id: str, read_every_turn: bool):
+    messages = [("user", "quero 2 quartos, me chamo Ana")]
+    messages += [("user" if i % 2 else "assistant", f"ok {i}") for i in range(24)]
+    messages.append(("user", "na verdade 3 quartos na Aldeota"))
+    for role, content in messages:
+        ws.add_to_history(conversation_id, role, content)
+        if read_every_turn:
+            ws.extract_filters_from_history(conversation_id)
+            ws.extract_lead_name(conversation_id)
+    return ws.extract_filters_from_history(conversation_id), ws.extract_lead_name(conversation_id)
+
+
+class TestLeadStateWindow:
+    """The lead state only reflects messages still kept in the history window."""
+
+    @pytest.mark.parametrize("read_every_turn", [True, False])
+    def test_first_wins_values_expire_with_the_window(self, read_every_turn):
+        filters, name = _send_window_overflow_conversation("whatsapp_1@c.us", read_every_turn)
+
+        assert filters["bedrooms"] == "3"
+        assert filters["neighborhood"] == "Aldeota"
+        assert name == "Nao informado"
+
+    def test_warm_and_cold_state_match(self):
+        warm = _send_window_overflow_conversation("whatsapp_2@c.us", read_every_turn=True)
+        ws.conversation_state.clear()
+
+        cold = (ws.extract_filters_from_history("whatsapp_2@c.us"), ws.extract_lead_name("whatsapp_2@c.us"))
+
+        assert warm == cold
+
+    def test_first_wins_values_within_the_window(self):
+        conversation_id = "whatsapp_3@c.us"
+        for content in ("me chamo Ana", "quero 2 quartos na Meireles", "ou 3 quartos na Aldeota"):
+            ws.add_to_history(conversation_id, "user", content)
+            ws.extract_filters_from_history(conversation_id)
+
+        filters = ws.extract_filters_from_history(conversation_id)
+
+        assert filters["bedrooms"] == "2"
+        assert filters["neighborhood"] == "Aldeota"
+        assert ws.extract_lead_name(conversation_id) == "Ana"
+
+
+def test_public_row_hides_internal_landing_lead_columns():
+    conn = ws.sqlite3.connect(":memory:")
+    conn.row_factory = ws.sqlite3.Row
+    row = conn.execute("SELECT 1 AS id, '(85) 9999' AS phone, '859999' AS phone_normalized").fetchone()
+
+    assert ws.public_row(row, ws.LANDING_LEAD_INTERNAL_COLUMNS) == {"id": 1, "phone": "(85) 9999"}
+
+
+def test_failed_ai_reply_delivery_counts_as_failed(monkeypatch):
+    def fail_send(session, chat_id, text):
+        raise RuntimeError("WAHA down")
+
+    monkeypatch.setattr(ws, "send_waha_message_sync", fail_send)
+    monkeypatch.setitem(ws.stats, "messages_failed", 0)
+
+    ws.deliver_ai_response("default", "5585@c.us", "whatsapp_5585@c.us", "Oi!", send_properties=True)
+
+    assert ws.stats["messages_failed"] == 1
+
+
+class TestFlushPendingMessages:
+    """Failed write-behind flushes keep the batch queued, up to a retry limit."""
+
+    @staticmethod
+    def _failing_db(monkeypatch):
+        class _LockedDb:
+            def __enter__(self):
+                raise ws.sqlite3.OperationalError("database is locked")
+
+            def __exit__(self, *exc_info):
+                return False
+
+        monkeypatch.setattr(ws, "get_db", _LockedDb)
+        monkeypatch.setattr(ws, "_pending_messages", [])
+        monkeypatch.setattr(ws, "_message_flush_failures", 0)
+
+    def test_failed_flush_requeues_batch_in_order(self, monkeypatch):
+        self._failing_db(monkeypatch)
+        ws._pending_messages.extend([("c1", "user", "a", "t1"), ("c1", "assistant", "b", "t2")])
+
+        ws.flush_pending_messages()
+
+        assert ws._pending_messages == [("c1", "user", "a", "t1"), ("c1", "assistant", "b", "t2")]
+
+    def test_batch_is_dropped_after_retry_limit(self, monkeypatch):
+        self._failing_db(monkeypatch)
+        ws._pending_messages.append(("c1", "user", "a", "t1"))
+
+        for _ in range(ws.MESSAGE_FLUSH_MAX_RETRIES + 1):
+            ws.flush_pending_messages()
+
+        assert ws._pending_messages == []
+
+
+def test_property_send_reuses_the_turns_ai_extraction(monkeypatch):
+    extraction_calls = []
+    searched_filters = []
+    monkeypatch.setattr(ws, "extract_lead_data_with_ai", lambda *args, **kwargs: extraction_calls.append(args) or {})
+    monkeypatch.setattr(ws, "search_properties_memude", lambda filters: searched_filters.append(dict(filters)) or [])
+
+    sent = ws.send_properties_to_lead(
+        "default", "5585@c.us", filters={"neighborhood": "Aldeota"}, conversation_id="whatsapp_5585@c.us",
+        ai_data={"bedrooms": 2},
+    )
+
+    assert sent == 0
+    assert extraction_calls == []
+    assert searched_filters == [{"neighborhood": "Aldeota", "bedrooms": "2"}]
+
+
+@pytest.mark.parametrize(
+    ("message", "weekday", "period"),
+    [
+        ("pode ser aos sábados de manhã", 5, "manha"),
+        ("segundas à tarde", 0, "tarde"),
+        ("nas noites de quinta", 3, "noite"),
+    ],
+)
+def test_parse_portuguese_datetime_accepts_plural_weekdays_and_periods(message, weekday, period):
+    result = ws.parse_portuguese_datetime(message)
+
+    assert result["date"].weekday() == weekday
+    assert result["period"] == period
+
+
+@pytest.mark.parametrize(
+    ("message", "intent"),
+    [
+        ("gostei, quero visitas nesse", "schedule"),
+        ("quero esses dois", "interest"),
+        ("na verdade gostei desse", "interest"),
+    ],
+)
+def test_detect_property_selection_intent_on_quoted_property(message, intent):
+    result = ws.detect_property_selection(message, True, {"body": "Apartamento na Aldeota"})
+
+    assert result["has_selection"] is True
+    assert result["intent"] == intent
+
+
+def test_failed_scheduled_reply_counts_as_failed(monkeypatch):
+    def fail_send(session, chat_id, text):
+        raise RuntimeError("WAHA down")
+
+    monkeypatch.setattr(ws, "send_waha_message_sync", fail_send)
+    monkeypatch.setitem(ws.stats, "messages_failed", 0)
+
+    assert ws.deliver_reply("default", "5585@c.us", "Confirmado!") is False
+    assert ws.stats["messages_failed"] == 1
+
+
+class TestFollowupScheduler:
+    """Delayed jobs run in deadline order and cancelled jobs never run."""
+
+    @staticmethod
+    def _wait_for(condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_jobs_run_in_deadline_order(self):
+        scheduler = ws.FollowupScheduler()
+        fired = []
+        lock = threading.Lock()
+
+        def record(name):
+            with lock:
+                fired.append(name)
+
+        scheduler.schedule(0.15, record, "third")
+        scheduler.schedule(0.05, record, "first")
+        scheduler.schedule(0.10, record, "second")
+        self._wait_for(lambda: len(fired) == 3)
+
+        assert fired == ["first", "second", "third"]
+
+    def test_cancel_before_due_skips_the_job(self):
+        scheduler = ws.FollowupScheduler()
+        fired = []
+
+        job_id = scheduler.schedule(0.05, fired.append, "cancelled")
+        scheduler.schedule(0.10, fired.append, "kept")
+        scheduler.cancel(job_id)
+        self._wait_for(lambda: fired)
+        time.sleep(0.05)
+
+        assert fired == ["kept"]
+
+    def test_cancel_of_unknown_or_none_job_is_a_no_op(self):
+        scheduler = ws.FollowupScheduler()
+
+        scheduler.cancel(None)
+        scheduler.cancel(12345)
+
+        assert scheduler._pending == set()
+
+    def test_rescheduling_runs_only_the_new_job(self):
+        scheduler = ws.FollowupScheduler()
+        fired = []
+
+        job_id = scheduler.schedule(0.05, fired.append, "old")
+        scheduler.cancel(job_id)
+        scheduler.schedule(0.10, fired.append, "new")
+        self._wait_for(lambda: fired)
+        time.sleep(0.05)
+
+        assert fired == ["new"]
+
+    def test_cancelled_entries_are_compacted_out_of_the_heap(self):
+        scheduler = ws.FollowupScheduler()
+        job_ids = [scheduler.schedule(60, lambda: None) for _ in range(200)]
+
+        for job_id in job_ids:
+            scheduler.cancel(job_id)
+
+        assert scheduler._pending == set()
+        assert len(scheduler._heap) <= 64
+
+    def test_job_exceptions_are_logged(self, monkeypatch):
+        errors = []
+        monkeypatch.setattr(ws.logger, "error", lambda message, **kwargs: errors.append((message, kwargs)))
+        future = Future()
+        future.set_exception(RuntimeError("boom"))
+
+        ws._log_scheduled_job_failure(future)
+
+        assert len(errors) == 1
+        assert isinstance(errors[0][1]["exc_info"], RuntimeError)
@@ -13,21 +13,39 @@ Features:
 - OpenRouter AI integration for intelligent responses
 """
 
+import array
+import atexit
+import heapq
+import itertools
+import hashlib
+import json
 import logging
 import os
+import queue
 import random
 import re
 import sqlite3
 import sys
 import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections.abc import Callable
 from contextlib import contextmanager
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from functools import lru_cache
+from datetime import date, datetime, timedelta
 from typing import Any
 import uuid
 
+import httpx
+import orjson
+import requests
 from flask import Flask, jsonify, request
 from flask_cors import CORS
+from flask_orjson import OrjsonProvider
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configure logging
 logging.basicConfig(
@@ -42,6 +60,7 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # orjson para request.json e jsonify
 CORS(app)
 
 # Configuration
@@ -50,53 +69,184 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
 DEBUG_MODE = os.getenv("DEBUG", "true").lower() == "true"
 
 # OpenRouter configuration
-OPENROUTER_API_KEY = os.getenv(
-    "OPENROUTER_API_KEY",
-    "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"
-)
+# Mesmos nomes/defaults de configs/feature/whatsapp_broker_config.py (WhatsAppBrokerConfig);
+# o servidor standalone nao importa o pacote configs (carregaria o DifyConfig inteiro)
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+if not OPENROUTER_API_KEY:
+    # Sem chave as chamadas ao OpenRouter falham (401) e o lead recebe a resposta de fallback
+    logger.warning("OPENROUTER_API_KEY is not set - AI responses and lead extraction will fail")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+AI_MODEL = os.getenv("AI_MODEL", "google/gemini-3-flash-preview")
+# Modelo mais rapido/barato para turnos de conversa de lead ja qualificado, sem agendamento
+# em jogo (mesmo default do WhatsAppBrokerConfig); AI_MODEL_LIGHT="" desliga = sempre AI_MODEL
+AI_MODEL_LIGHT = os.getenv("AI_MODEL_LIGHT", "google/gemini-2.5-flash-lite")
+AI_EXTRACTION_MODEL = "google/gemini-2.0-flash-001"  # Extracao de filtros/nome (respostas curtas, temperatura baixa)
 
 # WAHA configuration
 WAHA_BASE_URL = os.getenv("WAHA_BASE_URL", "http://waha:3000")
 WAHA_API_KEY = os.getenv("WAHA_API_KEY", "broker-waha-key-2024")
 
 # Humanization delays (in seconds)
-TYPING_DELAY_MIN = 1.5      # Minimo antes de comecar a "digitar"
-TYPING_DELAY_MAX = 4.0      # Maximo antes de comecar a "digitar"
-CHARS_PER_SECOND = 6.0      # Velocidade de digitacao humana (~60 WPM)
+TYPING_DELAY_MIN = float(os.getenv("TYPING_DELAY_MIN", "1.5"))  # Minimo antes de comecar a "digitar"
+TYPING_DELAY_MAX = float(os.getenv("TYPING_DELAY_MAX", "4.0"))  # Maximo antes de comecar a "digitar"
+CHARS_PER_SECOND = float(os.getenv("CHARS_PER_SECOND", "6.0"))  # Velocidade de digitacao humana (~60 WPM)
+PROPERTY_SEND_INTERVAL = 1.5  # Espacamento minimo entre inicios de envio de imoveis (anti-spam)
 
 # Message buffer configuration (for aggregating consecutive messages)
 MESSAGE_BUFFER_DELAY = 3.0  # Segundos para aguardar mais mensagens antes de processar
 
+# Boot time: relogio monotonico para calcular uptime, ISO formatado uma unica vez para exibicao
+BOOT_MONOTONIC = time.monotonic()
+BOOT_ISO = datetime.utcnow().isoformat()
+
 # Statistics
 stats = {
     "messages_received": 0,
     "messages_processed": 0,
     "messages_failed": 0,
-    "server_started_at": datetime.utcnow().isoformat()
+    "ai_cache_hits": 0,
+    "ai_cache_misses": 0,
+    "server_started_at": BOOT_ISO
 }
 
-# In-memory conversation history storage
+# In-memory conversation history storage (LRU cache, banco e a fonte da verdade)
 # Key: conversation_id (whatsapp_5585999999999@c.us)
-# Value: list of messages [{"role": "user/assistant", "content": "..."}]
-conversation_history: dict[str, list[dict]] = {}
+# Value: deque of (role, content) tuples, trimmed automatically to MAX_HISTORY_MESSAGES
+conversation_history: OrderedDict[str, deque[tuple[str, str]]] = OrderedDict()
+# Protege o LRU (get + move_to_end + eviction) e os appends nos deques entre os workers
+conversation_history_lock = threading.RLock()
 
 # Max messages to keep per conversation (to avoid token overflow)
 MAX_HISTORY_MESSAGES = 20
 
+# Max conversations kept in memory; least recently used are evicted (reloaded from DB on demand)
+MAX_CACHED_CONVERSATIONS = 10000
+
+# Versao do historico em memoria por conversa (nova a cada mudanca no deque)
+_history_versions: dict[str, int] = {}
+_history_version_counter = itertools.count(1)
+
+# Estado incremental do lead por conversa (nome, bairro, quartos, renda), atualizado
+# so com cada nova mensagem do usuario; "version" e a versao do historico ja incorporada
+conversation_state: dict[str, dict] = {}
+
 # Message buffer for aggregating consecutive messages
+# Particionado por numero: cada shard tem seu proprio dict e lock, entao webhooks de leads
+# diferentes nao disputam o mesmo lock (ver message_buffer_shard)
 # Key: from_number
-# Value: {"messages": [...], "timer": Timer, "session": str}
-message_buffer: dict[str, dict] = {}
-message_buffer_lock = threading.Lock()
+# Value: {"messages": [...], "job_id": int (followup_scheduler), "deadline": float (time.monotonic()),
+#         "session": str, "real_phone": str}
+MESSAGE_BUFFER_SHARDS = 16
+MAX_BUFFERED_MESSAGES = 20  # Por lead; mensagens alem disso (flood) sao descartadas
+message_buffer_shards: tuple[tuple[threading.Lock, dict[str, dict]], ...] = tuple(
+    (threading.Lock(), {}) for _ in range(MESSAGE_BUFFER_SHARDS)
+)
+
+# IDs das mensagens ja recebidas (WAHA reenvia o webhook em caso de erro/timeout)
+MAX_SEEN_MESSAGE_IDS = 10000
+seen_message_ids: OrderedDict[str, None] = OrderedDict()
+seen_message_ids_lock = threading.Lock()
+
+# Pool limitado que processa os buffers (AI + WAHA + delays de humanizacao).
+# Os timers do buffer apenas enfileiram aqui, sem fazer o trabalho pesado na thread do timer.
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "32"))
+message_worker_pool = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix="message-worker")
+
+# Extracao de dados do lead via AI em segundo plano: a thread da mensagem usa o ultimo
+# resultado conhecido e a atualizacao fica pronta para o proximo turno
+AI_EXTRACTION_WORKERS = int(os.getenv("AI_EXTRACTION_WORKERS", "4"))
+ai_extraction_pool = ThreadPoolExecutor(max_workers=AI_EXTRACTION_WORKERS, thread_name_prefix="ai-extraction")
+# conversation_id -> (versao do historico, dados extraidos)
+_ai_extraction_cache: dict[str, tuple[int | None, dict]] = {}
+_ai_extraction_pending: set[str] = set()
+ai_extraction_lock = threading.Lock()
+
+# Cliente HTTP unico do OpenRouter (thread-safe): conexoes keep-alive reaproveitadas
+# entre chamadas, sem novo handshake TCP/TLS por resposta ou extracao
+# (connect curto: OpenRouter fora do ar falha rapido em vez de segurar o worker 30s)
+openrouter_client = httpx.Client(
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=MESSAGE_WORKERS, max_keepalive_connections=8),
+)
+atexit.register(openrouter_client.close)
+
+# Sessao HTTP unica com o WAHA (requests tem melhor compatibilidade de rede no Docker):
+# conexoes keep-alive por host em vez de uma conexao nova a cada envio; corpos JSON
+# serializados com orjson (data=...), por isso o Content-Type fica fixo na sessao
+waha_http = requests.Session()
+waha_http.headers.update({"Content-Type": "application/json", "X-Api-Key": WAHA_API_KEY})
+waha_http.mount("http://", HTTPAdapter(pool_maxsize=MESSAGE_WORKERS))
+waha_http.mount("https://", HTTPAdapter(pool_maxsize=MESSAGE_WORKERS))
+atexit.register(waha_http.close)
+
+# Notificacoes de UI ao WAHA sem resposta util (sendSeen, "digitando..."): disparadas aqui
+# para o RTT correr junto com a IA/delays em vez de bloquear o worker da mensagem
+# Fila limitada: com o WAHA lento, notificacoes excedentes sao descartadas (sao so cosmeticas)
+# em vez de se acumularem sem limite na fila do executor
+WAHA_NOTIFY_MAX_PENDING = 1024
+waha_notify_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="waha-notify")
+waha_notify_slots = threading.BoundedSemaphore(WAHA_NOTIFY_MAX_PENDING)
+
+# Sessao HTTP unica com a API do Memude (catalogo de imoveis): keep-alive entre buscas e
+# retry com backoff em erros de gateway (so GET e repetido; envios ao WAHA nao)
+memude_http = requests.Session()
+memude_http.headers.update({
+    # Headers de browser real para evitar bloqueio Cloudflare/ModSecurity
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Referer": "https://www.memude.com.br/"
+})
+memude_http.mount("https://", HTTPAdapter(
+    pool_maxsize=MESSAGE_WORKERS,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET"]),
+))
+atexit.register(memude_http.close)
+
+# Catalogo bruto do Memude (o filtro e client-side, a resposta e a mesma para todos os leads):
+# reaproveitado por MEMUDE_CACHE_TTL segundos; o lock garante uma so busca por vez ao expirar
+MEMUDE_CACHE_TTL = float(os.getenv("MEMUDE_CACHE_TTL", "90"))
+_memude_cache: dict[str, Any] = {"data": None, "ts": 0.0}
+_memude_cache_lock = threading.Lock()
+
+# Respostas da IA por hash do payload exato (modelo, prompt, contexto, historico e mensagem):
+# turnos identicos (ex: primeiro "oi" de leads novos) reaproveitam a resposta sem chamar o LLM
+AI_RESPONSE_CACHE_TTL = float(os.getenv("AI_RESPONSE_CACHE_TTL", "3600"))
+MAX_AI_RESPONSE_CACHE = 2048
+_ai_response_cache: OrderedDict[bytes, tuple[float, str]] = OrderedDict()
+_ai_response_cache_lock = threading.Lock()
+
+# Envios proativos (follow-ups agendados) em paralelo: limita quantos batem no WAHA ao mesmo
+# tempo quando muitos vencem juntos (ex: onda das 8h), sem segurar as respostas a mensagens
+WAHA_FOLLOWUP_CONCURRENCY = int(os.getenv("WAHA_FOLLOWUP_CONCURRENCY", "4"))
+FOLLOWUP_SEND_WAIT = 30.0  # segundos esperando vaga antes de desistir do envio
+followup_send_slots = threading.BoundedSemaphore(WAHA_FOLLOWUP_CONCURRENCY)
 
 # Scheduled visits storage (MVP in-memory)
 # Key: visit_id (uuid string)
 # Value: visit dict
 scheduled_visits: dict[str, dict] = {}
 
+# Indices de scheduled_visits para lead_has_scheduled_visit (lookup O(1) em vez de varredura)
+# Key: lead_number (com @c.us/@lid) / telefone normalizado (normalize_phone)
+# Value: visit_id
+visits_by_lead_number: dict[str, str] = {}
+visits_by_phone: dict[str, str] = {}
+
+# Colunas paralelas (SoA) com o horario das visitas para varreduras em lote (visits_due_before):
+# percorre um array de floats em vez de fazer .get() em cada dict de scheduled_visits
+visit_ids: list[str] = []
+visit_scheduled_ts = array.array("d")  # timestamp de scheduled_datetime (inf = a confirmar)
+_visit_slots: dict[str, int] = {}  # visit_id -> posicao nas colunas
+# Mantem scheduled_visits, indices e colunas consistentes entre threads
+visits_lock = threading.Lock()
+
 # Selected property per conversation (to track which property was selected before scheduling)
 # Key: conversation_id
 # Value: property_info dict
+# Limitado junto com conversation_history: sai quando a conversa e despejada do LRU
 selected_property_context: dict[str, dict] = {}
 
 # Broker WhatsApp number for notifications (Reno Alencar - socio)
@@ -105,23 +255,127 @@ BROKER_WHATSAPP_NUMBER = os.getenv("BROKER_WHATSAPP_NUMBER", "558596227722@c.us"
 # SQLite database for landing page leads
 DATABASE_PATH = os.getenv("LANDING_DB_PATH", "/tmp/landing_leads.db")
 
+# Pool de conexoes SQLite reutilizadas entre threads (o servidor Flask abre uma thread por request,
+# entao conexoes por thread eram reabertas a cada chamada HTTP)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+_db_pool: queue.LifoQueue = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# Conexao emprestada pela thread atual (chamadas aninhadas de get_db reutilizam a mesma)
+_db_local = threading.local()
+
 # Landing page leads context (in-memory)
 # Key: conversation_id
 # Value: {lead_id, property, is_landing_page, ...}
 landing_lead_context: dict[str, dict] = {}
 
-# Follow-up timers for proactive messaging
+
+def _log_scheduled_job_failure(future: Future) -> None:
+    """Registra excecoes de jobs do followup_scheduler (o future nao e guardado por ninguem)."""
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"Error in scheduled job: {exc}", exc_info=exc)
+
+
+class FollowupScheduler:
+    """
+    Agendador unico para acoes atrasadas (follow-ups, lembretes).
+
+    Substitui um threading.Timer (uma thread do SO) por evento: uma unica thread
+    dorme ate o proximo vencimento num min-heap de (deadline monotonic, job_id).
+    Ao vencer, o callback e enviado para o message_worker_pool.
+    Cancelamento e lazy: o job sai de _pending e a entrada do heap e descartada.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, Callable, tuple]] = []
+        self._pending: set[int] = set()
+        self._ids = itertools.count(1)
+        self._cv = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def schedule(self, delay_seconds: float, callback: Callable, *args) -> int:
+        """Agenda callback(*args) para daqui a delay_seconds. Retorna o job_id."""
+        with self._cv:
+            job_id = next(self._ids)
+            heapq.heappush(self._heap, (time.monotonic() + delay_seconds, job_id, callback, args))
+            self._pending.add(job_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="followup-scheduler", daemon=True)
+                self._thread.start()
+            self._cv.notify()
+        return job_id
+
+    def cancel(self, job_id: int | None) -> None:
+        """Cancela um job agendado (no-op se ja executou ou nao existe)."""
+        if job_id is None:
+            return
+        with self._cv:
+            self._pending.discard(job_id)
+            # Compacta o heap quando acumula muitos jobs cancelados
+            if len(self._heap) > 2 * len(self._pending) + 64:
+                self._heap = [entry for entry in self._heap if entry[1] in self._pending]
+                heapq.heapify(self._heap)
+
+    def _pop_due(self) -> list[tuple[Callable, tuple]]:
+        """Remove do heap todos os jobs vencidos (chamado com o lock adquirido)."""
+        due = []
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            _, job_id, callback, args = heapq.heappop(self._heap)
+            if job_id in self._pending:
+                self._pending.discard(job_id)
+                due.append((callback, args))
+        return due
+
+    def _run(self) -> None:
+        while True:
+            with self._cv:
+                while True:
+                    due = self._pop_due()
+                    if due:
+                        break
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
+                    # Descarta cancelados do topo para nao acordar a toa
+                    if self._heap[0][1] not in self._pending:
+                        heapq.heappop(self._heap)
+                        continue
+                    self._cv.wait(self._heap[0][0] - time.monotonic())
+            # Todos os jobs do mesmo instante (ex: onda das 8h) saem juntos para o pool,
+            # que envia em paralelo limitado por MESSAGE_WORKERS
+            for callback, args in due:
+                future = message_worker_pool.submit(callback, *args)
+                future.add_done_callback(_log_scheduled_job_failure)
+
+
+followup_scheduler = FollowupScheduler()
+
+# Follow-up jobs for proactive messaging
 # Key: lead_id
-# Value: threading.Timer
-followup_timers: dict[int, threading.Timer] = {}
+# Value: job_id no followup_scheduler
+followup_timers: dict[int, int] = {}
 
 # ============================================
 # COLD LEAD FOLLOW-UP SYSTEM
 # ============================================
-# Timers para leads que pararam de responder
+@dataclass(slots=True)
+class ColdLeadEntry:
+    """Follow-up pendente de um lead frio (slots: sem dict por entrada, milhares ficam em memoria)."""
+
+    job_id: int | None  # followup_scheduler
+    tier: int
+    scheduled_at: float  # time.monotonic()
+
+
+# Jobs para leads que pararam de responder
 # Key: conversation_id (ex: whatsapp_5585999999999@c.us)
-# Value: {timer, tier, last_agent_response, scheduled_at}
-cold_lead_timers: dict[str, dict] = {}
+# Value: ColdLeadEntry
+cold_lead_timers: dict[str, ColdLeadEntry] = {}
+# Leituras-modificacoes de cold_lead_timers (webhook, workers e scheduler concorrem)
+cold_lead_lock = threading.RLock()
 
 # Sequência de follow-ups progressivos (em segundos)
 COLD_LEAD_FOLLOWUP_TIERS = [
@@ -146,6 +400,80 @@ COLD_LEAD_MESSAGES = {
 # VISIT FOLLOW-UP FUNCTIONS
 # ============================================
 
+NON_DIGIT_RE = re.compile(r'\D')
+
+
+def normalize_phone(phone: str | None) -> str:
+    """
+    Normaliza telefone para comparacao por igualdade: remove sufixo @c.us/@lid,
+    mantem apenas digitos e garante o DDI 55 em numeros nacionais (DDD + numero).
+    """
+    if not phone:
+        return ""
+    digits = NON_DIGIT_RE.sub('', str(phone).split("@", 1)[0])
+    if digits and len(digits) <= 11:
+        digits = f"55{digits}"
+    return digits
+
+
+def strip_chat_suffix(chat_id: str) -> str:
+    """Remove o sufixo de chat do WhatsApp (@c.us / @lid), mantendo o numero/identificador."""
+    return chat_id.removesuffix("@c.us").removesuffix("@lid")
+
+
+# Troca os separadores do formato en-US ("9,500.00") pelos do pt-BR ("9.500,00") numa passada
+BRL_SEPARATORS = str.maketrans(",.", ".,")
+
+
+def format_brl(value: float, decimals: int = 0) -> str:
+    """Formata valor em reais com separadores brasileiros (ex.: "R$ 9.500" ou "R$ 9.500,00")."""
+    return f"R$ {value:,.{decimals}f}".translate(BRL_SEPARATORS)
+
+
+def index_visit(visit: dict) -> None:
+    """
+    Registra visita em memoria e nos indices por lead_number/telefone.
+    A visita indexada por ultimo vence (a mais recente do lead).
+    """
+    visit_id = visit["id"]
+    phone = normalize_phone((visit.get("lead_data") or {}).get("phone"))
+    scheduled_dt = visit.get("scheduled_datetime")
+    ts = scheduled_dt.timestamp() if isinstance(scheduled_dt, datetime) else float("inf")
+
+    with visits_lock:
+        scheduled_visits[visit_id] = visit
+        if visit.get("lead_number"):
+            visits_by_lead_number[visit["lead_number"]] = visit_id
+        if phone:
+            visits_by_phone[phone] = visit_id
+
+        slot = _visit_slots.get(visit_id)
+        if slot is None:
+            _visit_slots[visit_id] = len(visit_ids)
+            visit_ids.append(visit_id)
+            visit_scheduled_ts.append(ts)
+        else:
+            visit_scheduled_ts[slot] = ts
+
+
+def visits_due_before(deadline: datetime, statuses: tuple[str, ...] = ("pending", "confirmed")) -> list[dict]:
+    """
+    Retorna visitas em memoria agendadas ate deadline com status em statuses.
+
+    O filtro por horario roda sobre visit_scheduled_ts; o status (mutavel no dict
+    da visita) so e consultado para as candidatas.
+    """
+    limit = deadline.timestamp()
+    due = []
+    with visits_lock:
+        for slot, ts in enumerate(visit_scheduled_ts):
+            if ts <= limit:
+                visit = scheduled_visits[visit_ids[slot]]
+                if visit.get("status") in statuses:
+                    due.append(visit)
+    return due
+
+
 def lead_has_scheduled_visit(lead_number: str, real_phone: str = None) -> dict | None:
     """
     Verifica se lead já tem visita agendada e retorna a visita.
@@ -158,41 +486,54 @@ def lead_has_scheduled_visit(lead_number: str, real_phone: str = None) -> dict |
     Returns:
         Visit dict se encontrou, None se não
     """
-    # 1. Primeiro busca em memoria (rapido, visitas recentes)
-    for visit_id, visit in scheduled_visits.items():
-        # Verifica por lead_number
-        if visit.get("lead_number") == lead_number:
-            return visit
-        # Verifica por real_phone nos lead_data
-        if real_phone:
-            visit_phone = visit.get("lead_data", {}).get("phone")
-            if visit_phone and (visit_phone == real_phone or visit_phone in real_phone or real_phone in str(visit_phone)):
-                return visit
+    # 1. Primeiro busca em memoria (rapido, visitas recentes) pelos indices
+    visit_id = visits_by_lead_number.get(lead_number)
+    if visit_id is None and real_phone:
+        visit_id = visits_by_phone.get(normalize_phone(real_phone))
+    if visit_id is not None:
+        return scheduled_visits.get(visit_id)
 
     # 2. Se nao encontrou em memoria, busca no banco de dados
     db_visit = get_active_visit_from_db(lead_number, real_phone)
     if db_visit:
         # Carrega para memoria para proximas consultas
-        scheduled_visits[db_visit["id"]] = db_visit
+        index_visit(db_visit)
         logger.info(f"Loaded visit {db_visit['id']} from database into memory")
         return db_visit
 
     return None
 
 
+# Palavras de confirmacao/cancelamento de visita numa unica regex (uma varredura da mensagem).
+# Mesma semantica de substring da lista original: sim, não/nao, confirmo/confirmar, cancela(r), vou, irei
+CONFIRMATION_RE = re.compile(r"sim|n[ãa]o|confirm(?:o|ar)|cancela|vou|irei", re.IGNORECASE)
+# Subconjunto afirmativo (confirma presenca); o resto das respostas cancela a visita
+CONFIRMATION_YES_RE = re.compile(r"sim|confirmo|vou|irei", re.IGNORECASE)
+
+
 def is_confirmation_response(message: str) -> bool:
     """Verifica se mensagem é resposta de confirmação de visita."""
-    keywords = ["sim", "não", "nao", "confirmo", "cancela", "vou", "irei", "confirmar", "cancelar"]
-    message_lower = message.lower().strip()
+    message = message.strip()
     # Resposta curta com keyword
-    return len(message_lower) < 50 and any(k in message_lower for k in keywords)
+    return len(message) < 50 and CONFIRMATION_RE.search(message) is not None
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
 
 
 def extract_feedback_score(message: str) -> int | None:
-    """Extrai nota de 1-5 da mensagem."""
-    match = re.search(r'\b([1-5])\b', message)
-    if match:
-        return int(match.group(1))
+    """
+    Extrai nota de 1-5 da mensagem.
+
+    Varredura direta dos caracteres (equivalente a \\b([1-5])\\b): o primeiro
+    digito 1-5 sem letra/digito colado antes ou depois.
+    """
+    last = len(message) - 1
+    for i, ch in enumerate(message):
+        if "1" <= ch <= "5":
+            if (i == 0 or not _is_word_char(message[i - 1])) and (i == last or not _is_word_char(message[i + 1])):
+                return int(ch)
     return None
 
 
@@ -204,55 +545,83 @@ def notify_broker_lead_confirmed(visit: dict):
     logger.info(f"Notified broker about lead confirmation for visit #{visit['id']}")
 
 
-def send_lead_confirmation_request(visit_id: str):
-    """Envia mensagem pedindo confirmação ao lead no dia da visita."""
-    visit = scheduled_visits.get(visit_id)
-    if not visit or visit.get("status") == "cancelled":
-        logger.info(f"Skipping lead confirmation for visit #{visit_id} - cancelled or not found")
-        return
-
-    if visit.get("lead_confirmed"):
-        logger.info(f"Lead already confirmed for visit #{visit_id}")
-        return
-
-    message = f"Bom dia! Sua visita esta marcada para hoje as {visit.get('scheduled_time', 'horario agendado')}. Confirma presenca? (Sim/Nao)"
-    send_waha_message_sync(visit.get("session", "corretores"), visit["lead_number"], message)
-    visit["confirmation_sent"] = True
-    logger.info(f"Sent lead confirmation request for visit #{visit_id}")
+# Follow-ups de visita: kind -> (descricao p/ log, flag que dispensa o envio, flag marcada apos o envio,
+# destinatario e o corretor?, montagem da mensagem)
+VISIT_FOLLOWUP_MESSAGES: dict[str, tuple[str, str | None, str, bool, Callable[[dict], str]]] = {
+    "lead_confirm": (
+        "lead confirmation request", "lead_confirmed", "confirmation_sent", False,
+        lambda visit: (
+            f"Bom dia! Sua visita esta marcada para hoje as {visit.get('scheduled_time', 'horario agendado')}. "
+            "Confirma presenca? (Sim/Nao)"
+        ),
+    ),
+    "broker_confirm": (
+        "broker confirmation request", None, "broker_confirmation_sent", True,
+        lambda visit: (
+            f"Bom dia! Visita #{visit['id']} com {visit.get('lead_data', {}).get('name', 'Lead')} "
+            f"as {visit.get('scheduled_time', 'horario agendado')}.\n"
+            f"Imovel: {visit.get('property_info', {}).get('title', 'Imovel')}\n"
+            "Confirma disponibilidade? (Sim/Nao)"
+        ),
+    ),
+    "feedback": (
+        "feedback request", "feedback_requested", "feedback_requested", False,
+        lambda visit: (
+            "Como foi sua experiencia na visita? De 1 a 5, qual nota voce daria para o atendimento do corretor?"
+        ),
+    ),
+}
 
 
-def send_broker_confirmation_request(visit_id: str):
-    """Envia mensagem pedindo confirmação ao corretor no dia da visita."""
+def send_visit_followup(kind: str, visit_id: str):
+    """Envia um follow-up agendado da visita (confirmacao do lead/corretor ou pedido de feedback)."""
+    label, done_flag, sent_flag, to_broker, build_message = VISIT_FOLLOWUP_MESSAGES[kind]
     visit = scheduled_visits.get(visit_id)
     if not visit or visit.get("status") == "cancelled":
-        logger.info(f"Skipping broker confirmation for visit #{visit_id} - cancelled or not found")
+        logger.info(f"Skipping {label} for visit #{visit_id} - cancelled or not found")
         return
 
-    lead_name = visit.get("lead_data", {}).get("name", "Lead")
-    property_info = visit.get("property_info", {})
-    property_title = property_info.get("title", "Imovel")
+    if done_flag and visit.get(done_flag):
+        logger.info(f"Skipping {label} for visit #{visit_id} - {done_flag} already set")
+        return
 
-    message = f"Bom dia! Visita #{visit['id']} com {lead_name} as {visit.get('scheduled_time', 'horario agendado')}.\nImovel: {property_title}\nConfirma disponibilidade? (Sim/Nao)"
-    send_waha_message_sync(visit.get("session", "corretores"), BROKER_WHATSAPP_NUMBER, message)
-    visit["broker_confirmation_sent"] = True
-    logger.info(f"Sent broker confirmation request for visit #{visit_id}")
+    chat_id = BROKER_WHATSAPP_NUMBER if to_broker else visit["lead_number"]
+    send_followup_message_sync(visit.get("session", "corretores"), chat_id, build_message(visit))
+    visit[sent_flag] = True
+    logger.info(f"Sent {label} for visit #{visit_id}")
 
 
-def send_feedback_request(visit_id: str):
-    """Envia mensagem pedindo feedback ao lead após visita."""
-    visit = scheduled_visits.get(visit_id)
-    if not visit or visit.get("status") == "cancelled":
-        logger.info(f"Skipping feedback request for visit #{visit_id} - cancelled or not found")
-        return
+def parse_visit_datetime(date_str: str | None, time_str: str | None) -> datetime | None:
+    """
+    Converte data/hora da visita ("25/12/2024", "14h30"/"14:00") em datetime.
+
+    Returns:
+        datetime ou None se data/hora nao estiverem definidas ("A confirmar")
+    """
+    try:
+        if not date_str or "/" not in date_str:
+            return None
+        day, month, year = date_str.split("/")
+        if len(year) == 2:
+            year = "20" + year
+        hour, minute = (time_str or "10:00").replace("h", ":").split(":")[:2]
+        minute = minute if minute else "00"
+        return datetime(int(year), int(month), int(day), int(hour), int(minute))
+    except ValueError:
+        return None
 
-    if visit.get("feedback_requested"):
-        logger.info(f"Feedback already requested for visit #{visit_id}")
-        return
 
-    message = "Como foi sua experiencia na visita? De 1 a 5, qual nota voce daria para o atendimento do corretor?"
-    send_waha_message_sync(visit.get("session", "corretores"), visit["lead_number"], message)
-    visit["feedback_requested"] = True
-    logger.info(f"Sent feedback request for visit #{visit_id}")
+def restore_visit_datetime(visit: dict) -> None:
+    """Reidrata scheduled_datetime de uma visita lida do banco (ISO ou, em registros antigos, date/time)."""
+    scheduled_dt = visit.get("scheduled_datetime")
+    if isinstance(scheduled_dt, str):
+        try:
+            visit["scheduled_datetime"] = datetime.fromisoformat(scheduled_dt)
+            return
+        except ValueError:
+            pass
+    if not isinstance(visit.get("scheduled_datetime"), datetime):
+        visit["scheduled_datetime"] = parse_visit_datetime(visit.get("scheduled_date"), visit.get("scheduled_time"))
 
 
 def schedule_visit_followups(visit_id: str):
@@ -267,28 +636,15 @@ def schedule_visit_followups(visit_id: str):
         logger.warning(f"Cannot schedule follow-ups - visit #{visit_id} not found")
         return
 
-    # Obter datetime da visita
+    # Datetime da visita (parseado uma vez na criacao/carga da visita)
     visit_dt = visit.get("scheduled_datetime")
     if not visit_dt:
-        # Tentar construir a partir de date/time strings
-        try:
-            date_str = visit.get("scheduled_date", "")
-            time_str = visit.get("scheduled_time", "10:00")
-            if "/" in date_str:
-                day, month, year = date_str.split("/")
-                if len(year) == 2:
-                    year = "20" + year
-                hour, minute = time_str.replace("h", ":").split(":")[:2]
-                minute = minute if minute else "00"
-                visit_dt = datetime(int(year), int(month), int(day), int(hour), int(minute))
-                visit["scheduled_datetime"] = visit_dt
-        except Exception as e:
-            logger.warning(f"Could not parse visit datetime for #{visit_id}: {e}")
-            return
+        logger.warning(f"Cannot schedule follow-ups - visit #{visit_id} has no scheduled datetime")
+        return
 
     now = datetime.now()
 
-    # Inicializar lista de timers se não existir
+    # Inicializar lista de jobs (nome, job_id do followup_scheduler) se não existir
     if "follow_up_timers" not in visit:
         visit["follow_up_timers"] = []
 
@@ -300,33 +656,33 @@ def schedule_visit_followups(visit_id: str):
 
     if lead_confirm_time > now:
         delay = (lead_confirm_time - now).total_seconds()
-        timer = threading.Timer(delay, send_lead_confirmation_request, args=[visit_id])
-        timer.daemon = True
-        timer.start()
-        visit["follow_up_timers"].append(("lead_confirm", timer))
+        job_id = followup_scheduler.schedule(delay, send_visit_followup, "lead_confirm", visit_id)
+        visit["follow_up_timers"].append(("lead_confirm", job_id))
         logger.info(f"Scheduled lead confirmation for visit #{visit_id} at {lead_confirm_time} (in {delay/3600:.1f}h)")
 
-    # 2. Confirmação com corretor (mesmo horário + 1 min para não enviar simultaneamente)
-    broker_confirm_time = lead_confirm_time + timedelta(minutes=1)
+    # 2. Confirmação com corretor (mesmo horário; os envios saem em paralelo pelo pool)
+    broker_confirm_time = lead_confirm_time
     if broker_confirm_time > now:
         delay = (broker_confirm_time - now).total_seconds()
-        timer = threading.Timer(delay, send_broker_confirmation_request, args=[visit_id])
-        timer.daemon = True
-        timer.start()
-        visit["follow_up_timers"].append(("broker_confirm", timer))
+        job_id = followup_scheduler.schedule(delay, send_visit_followup, "broker_confirm", visit_id)
+        visit["follow_up_timers"].append(("broker_confirm", job_id))
         logger.info(f"Scheduled broker confirmation for visit #{visit_id}")
 
     # 3. Feedback após visita (2 horas depois)
     feedback_time = visit_dt + timedelta(hours=2)
     if feedback_time > now:
         delay = (feedback_time - now).total_seconds()
-        timer = threading.Timer(delay, send_feedback_request, args=[visit_id])
-        timer.daemon = True
-        timer.start()
-        visit["follow_up_timers"].append(("feedback", timer))
+        job_id = followup_scheduler.schedule(delay, send_visit_followup, "feedback", visit_id)
+        visit["follow_up_timers"].append(("feedback", job_id))
         logger.info(f"Scheduled feedback request for visit #{visit_id} at {feedback_time} (in {delay/3600:.1f}h)")
 
 
+def cancel_visit_followups(visit: dict) -> None:
+    """Cancela os follow-ups pendentes de uma visita no followup_scheduler."""
+    for _, job_id in visit.pop("follow_up_timers", []):
+        followup_scheduler.cancel(job_id)
+
+
 # ============================================
 # DATABASE FUNCTIONS FOR LANDING PAGE LEADS
 # ============================================
@@ -334,173 +690,295 @@ def schedule_visit_followups(visit_id: str):
 def init_database():
     """Inicializa banco de dados SQLite para landing page leads."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-
-        # Tabela UNICA - lead com dados do imovel embutidos (SIMPLIFICADO)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS landing_leads_v2 (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                phone TEXT NOT NULL,
-                name TEXT,
-                source_url TEXT,
-                -- Dados do imovel (inline)
-                property_title TEXT NOT NULL,
-                property_price REAL,
-                property_price_formatted TEXT,
-                property_neighborhood TEXT,
-                property_bedrooms INTEGER,
-                property_area REAL,
-                property_image_url TEXT,
-                property_link TEXT,
-                property_description TEXT,
-                -- Timestamps e status
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                contacted_at TIMESTAMP,
-                first_message_at TIMESTAMP,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
-
-        # Indices para busca rapida
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_v2_phone ON landing_leads_v2(phone)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_v2_status ON landing_leads_v2(status)')
-
-        # ============================================
-        # TABELA DE VISITAS PERSISTENTE
-        # ============================================
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS property_visits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                visit_uuid TEXT UNIQUE NOT NULL,
-                lead_number TEXT NOT NULL,
-                lead_phone TEXT,
-                lead_name TEXT,
-                lead_data TEXT,
-                property_title TEXT,
-                property_info TEXT,
-                scheduled_date TEXT,
-                scheduled_time TEXT,
-                scheduled_datetime TIMESTAMP,
-                status TEXT DEFAULT 'pending',
-                session TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                confirmation_sent INTEGER DEFAULT 0,
-                lead_confirmed INTEGER DEFAULT 0,
-                lead_confirmed_at TIMESTAMP,
-                broker_confirmed INTEGER DEFAULT 0,
-                broker_confirmed_at TIMESTAMP,
-                feedback_requested INTEGER DEFAULT 0,
-                feedback_score INTEGER,
-                feedback_at TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Indices para visitas
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_lead_number ON property_visits(lead_number)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_lead_phone ON property_visits(lead_phone)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_status ON property_visits(status)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_uuid ON property_visits(visit_uuid)')
-
-        # ============================================
-        # TABELA DE HISTORICO DE CONVERSAS
-        # ============================================
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversation_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Indices para mensagens
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON conversation_messages(conversation_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON conversation_messages(created_at)')
-
-        # ============================================
-        # TABELA DE CORRETORES (BROKERS)
-        # ============================================
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS brokers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT,
-                phone TEXT,
-                creci TEXT,
-                active INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        with get_db() as conn:
+            _create_schema(conn)
+        logger.info(f"Database initialized at {DATABASE_PATH}")
 
-        # Indices para corretores
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_brokers_active ON brokers(active)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_brokers_phone ON brokers(phone)')
+        # Carregar visitas pendentes do banco para memoria
+        load_visits_from_db()
 
-        # ============================================
-        # ADICIONAR COLUNAS DE QUALIFICACAO E BROKER
-        # ============================================
-        # Adicionar broker_id a property_visits (se nao existir)
-        try:
-            cursor.execute('ALTER TABLE property_visits ADD COLUMN broker_id INTEGER')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
+        # Reagendar follow-ups de leads frios gravados antes do restart
+        load_cold_lead_schedule()
+    except Exception as e:
+        logger.exception(f"Error initializing database: {e}")
 
-        # Adicionar campos de qualificacao a landing_leads_v2 (se nao existirem)
-        try:
-            cursor.execute('ALTER TABLE landing_leads_v2 ADD COLUMN qualification_score INTEGER')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
 
-        try:
-            cursor.execute('ALTER TABLE landing_leads_v2 ADD COLUMN qualification_budget TEXT')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
+# Colunas so para indexacao/busca interna: nao fazem parte das respostas da API
+# (SELECT * inclui colunas geradas VIRTUAL)
+LANDING_LEAD_INTERNAL_COLUMNS = ("phone_normalized",)
+VISIT_INTERNAL_COLUMNS = ("lead_phone_norm",)
+
+
+def public_row(row: sqlite3.Row, internal_columns: tuple[str, ...]) -> dict:
+    """Converte uma linha do banco em dict para a API, sem as colunas internas."""
+    data = dict(row)
+    for column in internal_columns:
+        data.pop(column, None)
+    return data
+
+
+def _create_schema(conn: sqlite3.Connection):
+    """Cria tabelas, indices e colunas adicionais (idempotente)."""
+    cursor = conn.cursor()
+
+    # Tabela UNICA - lead com dados do imovel embutidos (SIMPLIFICADO)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS landing_leads_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT NOT NULL,
+            name TEXT,
+            source_url TEXT,
+            -- Dados do imovel (inline)
+            property_title TEXT NOT NULL,
+            property_price REAL,
+            property_price_formatted TEXT,
+            property_neighborhood TEXT,
+            property_bedrooms INTEGER,
+            property_area REAL,
+            property_image_url TEXT,
+            property_link TEXT,
+            property_description TEXT,
+            -- Timestamps e status
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            contacted_at TIMESTAMP,
+            first_message_at TIMESTAMP,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+    # Indices para busca rapida
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_v2_phone ON landing_leads_v2(phone)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_v2_status ON landing_leads_v2(status)')
+
+    # ============================================
+    # TABELA DE VISITAS PERSISTENTE
+    # ============================================
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS property_visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            visit_uuid TEXT UNIQUE NOT NULL,
+            lead_number TEXT NOT NULL,
+            lead_phone TEXT,
+            lead_name TEXT,
+            lead_data TEXT,
+            property_title TEXT,
+            property_info TEXT,
+            scheduled_date TEXT,
+            scheduled_time TEXT,
+            scheduled_datetime TIMESTAMP,
+            status TEXT DEFAULT 'pending',
+            session TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            confirmation_sent INTEGER DEFAULT 0,
+            lead_confirmed INTEGER DEFAULT 0,
+            lead_confirmed_at TIMESTAMP,
+            broker_confirmed INTEGER DEFAULT 0,
+            broker_confirmed_at TIMESTAMP,
+            feedback_requested INTEGER DEFAULT 0,
+            feedback_score INTEGER,
+            feedback_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Indices para visitas
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_lead_number ON property_visits(lead_number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_lead_phone ON property_visits(lead_phone)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_status ON property_visits(status)')
+    # Compostos: carga de visitas ativas (status IN ... ORDER BY created_at) e varreduras por horario
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_status_created ON property_visits(status, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_status_sched ON property_visits(status, scheduled_datetime)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_uuid ON property_visits(visit_uuid)')
+
+    # ============================================
+    # TABELA DE HISTORICO DE CONVERSAS
+    # ============================================
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Indices para mensagens
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON conversation_messages(conversation_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON conversation_messages(created_at)')
+
+    # ============================================
+    # TABELA DE FOLLOW-UPS DE LEADS FRIOS (sobrevive a restart)
+    # ============================================
+    # fire_at: epoch (time.time()) do proximo envio; linhas vencidas no startup expiram
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cold_lead_schedule (
+            conversation_id TEXT PRIMARY KEY,
+            tier INTEGER NOT NULL,
+            fire_at REAL NOT NULL
+        )
+    ''')
+
+    # ============================================
+    # TABELA DE CORRETORES (BROKERS)
+    # ============================================
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS brokers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT,
+            phone TEXT,
+            creci TEXT,
+            active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Indices para corretores
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_brokers_active ON brokers(active)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_brokers_phone ON brokers(phone)')
+
+    # ============================================
+    # ADICIONAR COLUNAS DE QUALIFICACAO E BROKER
+    # ============================================
+    # Uma consulta ao schema por tabela em vez de tentar cada ALTER e capturar o erro
+    added_columns = {
+        "property_visits": [
+            ("broker_id", "INTEGER"),
+            ("lead_phone_norm", "TEXT"),  # Telefone normalizado (normalize_phone) para busca indexada
+        ],
+        "landing_leads_v2": [
+            # Telefone so com digitos, calculado pelo SQLite (VIRTUAL: ALTER TABLE nao aceita STORED)
+            ("phone_normalized", "TEXT GENERATED ALWAYS AS ("
+                                 "replace(replace(replace(replace(replace(phone, ' ', ''), '-', ''), '(', ''), ')', ''), '+', '')"
+                                 ") VIRTUAL"),
+            ("qualification_score", "INTEGER"),
+            ("qualification_budget", "TEXT"),
+            ("qualification_region", "TEXT"),
+            ("qualification_intent", "TEXT"),
+            ("last_interaction_at", "TIMESTAMP"),
+        ],
+    }
+    for table, columns in added_columns.items():
+        # table_xinfo tambem lista colunas geradas (table_info as omite)
+        existing = {row["name"] for row in cursor.execute(f"PRAGMA table_xinfo({table})")}
+        for column, ddl in columns:
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+    # Composto para get_landing_lead_by_phone (phone_normalized = ? AND status IN ... ORDER BY registered_at DESC)
+    cursor.execute('DROP INDEX IF EXISTS idx_leads_v2_phone_status')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_leads_v2_phone_norm_status '
+        'ON landing_leads_v2(phone_normalized, status, registered_at DESC)'
+    )
 
-        try:
-            cursor.execute('ALTER TABLE landing_leads_v2 ADD COLUMN qualification_region TEXT')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
+    # Indice do telefone normalizado (busca por igualdade em vez de LIKE)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_lead_phone_norm ON property_visits(lead_phone_norm)')
+
+    # Backfill das visitas gravadas antes da coluna existir
+    pending_norm = cursor.execute('''
+        SELECT id, lead_phone FROM property_visits
+        WHERE lead_phone_norm IS NULL AND lead_phone IS NOT NULL AND lead_phone != ''
+    ''').fetchall()
+    if pending_norm:
+        cursor.executemany(
+            'UPDATE property_visits SET lead_phone_norm = ? WHERE id = ?',
+            [(normalize_phone(row["lead_phone"]) or None, row["id"]) for row in pending_norm]
+        )
 
-        try:
-            cursor.execute('ALTER TABLE landing_leads_v2 ADD COLUMN qualification_intent TEXT')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
+    conn.commit()
 
-        try:
-            cursor.execute('ALTER TABLE landing_leads_v2 ADD COLUMN last_interaction_at TIMESTAMP')
-        except sqlite3.OperationalError:
-            pass  # Coluna ja existe
 
-        conn.commit()
-        conn.close()
-        logger.info(f"Database initialized at {DATABASE_PATH}")
+def _open_db_connection() -> sqlite3.Connection:
+    """
+    Abre uma conexao SQLite configurada para o pool.
 
-        # Carregar visitas pendentes do banco para memoria
-        load_visits_from_db()
-    except Exception as e:
-        logger.exception(f"Error initializing database: {e}")
+    Os PRAGMAs rodam uma vez por conexao; WAL permite leitores concorrentes
+    enquanto outra conexao escreve. O cache de statements cobre todas as queries
+    do servidor, entao SQL repetido reaproveita o plano preparado em vez de recompilar.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, cached_statements=256, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20MB de page cache por conexao
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
 
 
 @contextmanager
 def get_db():
-    """Context manager para conexao com banco de dados."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """Context manager para conexao com banco de dados (emprestada do pool de conexoes)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        # Chamada aninhada na mesma thread: usa a conexao ja emprestada (mesma transacao)
+        yield conn
+        return
+
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _open_db_connection()
+    _db_local.conn = conn
     try:
         yield conn
     finally:
-        conn.close()
+        _db_local.conn = None
+        # Descarta transacao nao commitada, como acontecia ao fechar a conexao
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def close_db_pool() -> None:
+    """
+    Fecha as conexoes ociosas do pool ao encerrar o processo.
+
+    Registrado antes de flush_pending_messages: atexit roda em ordem inversa, entao o
+    flush final ainda usa o pool. Fechar a ultima conexao faz o checkpoint do WAL.
+    """
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+atexit.register(close_db_pool)
+
+
+# Timestamp ISO local reaproveitado por ISO_NOW_RESOLUTION segundos: rajadas de escritas
+# (ex: onda de confirmacoes das 8h) formatam a data uma vez em vez de uma por UPDATE
+ISO_NOW_RESOLUTION = 0.25
+_iso_now_cache: tuple[float, str] = (0.0, "")
+
+
+def iso_now() -> str:
+    """Equivalente a datetime.now().isoformat(), com cache de ISO_NOW_RESOLUTION segundos."""
+    global _iso_now_cache
+    now = time.time()
+    cached_at, cached = _iso_now_cache
+    if now - cached_at > ISO_NOW_RESOLUTION:
+        cached = datetime.fromtimestamp(now).isoformat()
+        _iso_now_cache = (now, cached)
+    return cached
 
 
 # ============================================
 # VISIT DATABASE FUNCTIONS
 # ============================================
 
-import json
+def to_json_column(value: Any) -> str:
+    """Serializa dict para coluna TEXT (UTF-8 sem escapes, como json.dumps(ensure_ascii=False))."""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
 
 def save_visit_to_db(visit: dict) -> int:
     """
@@ -515,8 +993,8 @@ def save_visit_to_db(visit: dict) -> int:
     try:
         with get_db() as conn:
             # Serializar dicts para JSON
-            lead_data_json = json.dumps(visit.get("lead_data", {}), ensure_ascii=False)
-            property_info_json = json.dumps(visit.get("property_info", {}), ensure_ascii=False)
+            lead_data_json = to_json_column(visit.get("lead_data", {}))
+            property_info_json = to_json_column(visit.get("property_info", {}))
 
             # Extrair dados
             lead_phone = visit.get("lead_data", {}).get("phone", "")
@@ -527,16 +1005,17 @@ def save_visit_to_db(visit: dict) -> int:
             scheduled_dt = visit.get("scheduled_datetime")
             scheduled_dt_str = scheduled_dt.isoformat() if scheduled_dt else None
 
-            conn.execute('''
+            cursor = conn.execute('''
                 INSERT INTO property_visits
-                (visit_uuid, lead_number, lead_phone, lead_name, lead_data,
+                (visit_uuid, lead_number, lead_phone, lead_phone_norm, lead_name, lead_data,
                  property_title, property_info, scheduled_date, scheduled_time,
                  scheduled_datetime, status, session, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 visit.get("id"),
                 visit.get("lead_number"),
                 lead_phone,
+                normalize_phone(lead_phone) or None,
                 lead_name,
                 lead_data_json,
                 property_title,
@@ -546,10 +1025,11 @@ def save_visit_to_db(visit: dict) -> int:
                 scheduled_dt_str,
                 visit.get("status", "pending"),
                 visit.get("session"),
-                visit.get("created_at", datetime.now().isoformat())
+                visit.get("created_at") or iso_now()
             ))
             conn.commit()
-            db_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            invalidate_visit_history_cache()
+            db_id = cursor.lastrowid
             logger.info(f"Visit {visit.get('id')} saved to database with ID {db_id}")
             return db_id
     except Exception as e:
@@ -577,7 +1057,7 @@ def update_visit_in_db(visit_uuid: str, updates: dict):
 
             # Adicionar updated_at
             set_clauses.append("updated_at = ?")
-            values.append(datetime.now().isoformat())
+            values.append(iso_now())
 
             # Adicionar visit_uuid para WHERE
             values.append(visit_uuid)
@@ -585,11 +1065,75 @@ def update_visit_in_db(visit_uuid: str, updates: dict):
             query = f"UPDATE property_visits SET {', '.join(set_clauses)} WHERE visit_uuid = ?"
             conn.execute(query, values)
             conn.commit()
+            invalidate_visit_history_cache()
             logger.info(f"Visit {visit_uuid} updated in database: {list(updates.keys())}")
     except Exception as e:
         logger.error(f"Error updating visit {visit_uuid} in database: {e}")
 
 
+# Colunas de property_visits lidas para as visitas em memoria (scheduled_visits)
+VISIT_COLUMNS = """
+    id, visit_uuid, lead_number, lead_phone, lead_name, lead_data, property_title, property_info,
+    scheduled_date, scheduled_time, scheduled_datetime, status, session, created_at,
+    confirmation_sent, lead_confirmed, lead_confirmed_at, broker_confirmed, feedback_requested, feedback_score
+"""
+
+
+# Pre-ligado: evita LOAD_GLOBAL + LOAD_ATTR a cada coluna desserializada
+_json_loads = orjson.loads
+
+
+def load_json_column(value) -> dict:
+    """Deserializa uma coluna JSON (lead_data/property_info); vazia ou invalida vira {}."""
+    if not value:
+        return {}
+    try:
+        return _json_loads(value)
+    except (ValueError, TypeError):
+        return {}
+
+
+def visit_from_row(row: sqlite3.Row) -> dict:
+    """Monta o dict da visita direto da linha (SELECT VISIT_COLUMNS), sem dict(row) + renomear."""
+    visit = {
+        "id": row["visit_uuid"],
+        "db_id": row["id"],
+        "lead_number": row["lead_number"],
+        "lead_phone": row["lead_phone"],
+        "lead_name": row["lead_name"],
+        "lead_data": load_json_column(row["lead_data"]),
+        "property_title": row["property_title"],
+        "property_info": load_json_column(row["property_info"]),
+        "scheduled_date": row["scheduled_date"],
+        "scheduled_time": row["scheduled_time"],
+        "scheduled_datetime": row["scheduled_datetime"],
+        "status": row["status"],
+        "session": row["session"],
+        "created_at": row["created_at"],
+        "confirmation_sent": bool(row["confirmation_sent"]),
+        "lead_confirmed": bool(row["lead_confirmed"]),
+        "lead_confirmed_at": row["lead_confirmed_at"],
+        "broker_confirmed": bool(row["broker_confirmed"]),
+        "feedback_requested": bool(row["feedback_requested"]),
+        "feedback_score": row["feedback_score"],
+    }
+    restore_visit_datetime(visit)
+    return visit
+
+
+def visit_lead_filter(lead_number: str = None, lead_phone: str = None) -> tuple[str, list]:
+    """Monta o filtro por lead (lead_number/lead_phone_norm) so com os predicados informados."""
+    conds, params = [], []
+    if lead_number:
+        conds.append("lead_number = ?")
+        params.append(lead_number)
+    phone_norm = normalize_phone(lead_phone)
+    if phone_norm:
+        conds.append("lead_phone_norm = ?")
+        params.append(phone_norm)
+    return " OR ".join(conds), params
+
+
 def get_active_visit_from_db(lead_number: str = None, lead_phone: str = None) -> dict | None:
     """
     Busca visita ativa (pending/confirmed) de um lead no banco.
@@ -601,33 +1145,23 @@ def get_active_visit_from_db(lead_number: str = None, lead_phone: str = None) ->
     Returns:
         Dict da visita ou None
     """
+    lead_filter, params = visit_lead_filter(lead_number, lead_phone)
+    if not lead_filter:
+        return None
     try:
         with get_db() as conn:
-            # Buscar por lead_number ou lead_phone
-            cursor = conn.execute('''
-                SELECT * FROM property_visits
-                WHERE (lead_number = ? OR lead_phone = ? OR lead_phone LIKE ?)
+            # Buscar por lead_number e/ou telefone normalizado (ambos indexados)
+            cursor = conn.execute(f'''
+                SELECT {VISIT_COLUMNS} FROM property_visits
+                WHERE ({lead_filter})
                 AND status IN ('pending', 'confirmed')
                 ORDER BY created_at DESC
                 LIMIT 1
-            ''', (lead_number, lead_phone, f"%{lead_phone}%" if lead_phone else ""))
+            ''', params)
 
             row = cursor.fetchone()
             if row:
-                visit = dict(row)
-                # Deserializar JSON
-                if visit.get("lead_data"):
-                    try:
-                        visit["lead_data"] = json.loads(visit["lead_data"])
-                    except:
-                        visit["lead_data"] = {}
-                if visit.get("property_info"):
-                    try:
-                        visit["property_info"] = json.loads(visit["property_info"])
-                    except:
-                        visit["property_info"] = {}
-                # Renomear visit_uuid para id
-                visit["id"] = visit.pop("visit_uuid", visit.get("id"))
+                visit = visit_from_row(row)
                 return visit
     except Exception as e:
         logger.error(f"Error getting active visit from database: {e}")
@@ -646,31 +1180,32 @@ def get_lead_visit_history(lead_number: str = None, lead_phone: str = None) -> l
         Lista de visitas ordenadas por data (mais recente primeiro)
     """
     visits = []
+    lead_filter, params = visit_lead_filter(lead_number, lead_phone)
+    if not lead_filter:
+        return visits
     try:
         with get_db() as conn:
-            cursor = conn.execute('''
-                SELECT * FROM property_visits
-                WHERE lead_number = ? OR lead_phone = ? OR lead_phone LIKE ?
+            # Apenas os campos usados por format_visit_history_for_ai; o titulo cai para
+            # property_info.title via JSON1 no proprio SQLite, sem desserializar o blob em Python
+            cursor = conn.execute(f'''
+                SELECT visit_uuid,
+                       COALESCE(NULLIF(property_title, ''), json_extract(property_info, '$.title')),
+                       scheduled_date, scheduled_time, status, feedback_score
+                FROM property_visits
+                WHERE {lead_filter}
                 ORDER BY created_at DESC
                 LIMIT 10
-            ''', (lead_number, lead_phone, f"%{lead_phone}%" if lead_phone else ""))
-
-            for row in cursor:
-                visit = dict(row)
-                # Deserializar JSON
-                if visit.get("lead_data"):
-                    try:
-                        visit["lead_data"] = json.loads(visit["lead_data"])
-                    except:
-                        visit["lead_data"] = {}
-                if visit.get("property_info"):
-                    try:
-                        visit["property_info"] = json.loads(visit["property_info"])
-                    except:
-                        visit["property_info"] = {}
-                # Renomear visit_uuid para id
-                visit["id"] = visit.pop("visit_uuid", visit.get("id"))
-                visits.append(visit)
+            ''', params)
+
+            for visit_uuid, title, sched_date, sched_time, status, score in cursor:
+                visits.append({
+                    "id": visit_uuid,
+                    "property_title": title,
+                    "scheduled_date": sched_date,
+                    "scheduled_time": sched_time,
+                    "status": status,
+                    "feedback_score": score,
+                })
     except Exception as e:
         logger.error(f"Error getting lead visit history: {e}")
     return visits
@@ -683,39 +1218,19 @@ def load_visits_from_db():
     global scheduled_visits
     try:
         with get_db() as conn:
-            cursor = conn.execute('''
-                SELECT * FROM property_visits
+            cursor = conn.execute(f'''
+                SELECT {VISIT_COLUMNS} FROM property_visits
                 WHERE status IN ('pending', 'confirmed')
-                ORDER BY created_at DESC
+                ORDER BY created_at ASC
             ''')
 
+            # Ordem crescente: a visita mais recente de cada lead e indexada por ultimo
             count = 0
+            from_row, index = visit_from_row, index_visit
             for row in cursor:
-                visit = dict(row)
-                visit_uuid = visit.pop("visit_uuid", None)
-                if not visit_uuid:
+                if not row["visit_uuid"]:
                     continue
-
-                # Deserializar JSON
-                if visit.get("lead_data"):
-                    try:
-                        visit["lead_data"] = json.loads(visit["lead_data"])
-                    except:
-                        visit["lead_data"] = {}
-                if visit.get("property_info"):
-                    try:
-                        visit["property_info"] = json.loads(visit["property_info"])
-                    except:
-                        visit["property_info"] = {}
-
-                # Restaurar formato esperado
-                visit["id"] = visit_uuid
-                visit["lead_confirmed"] = bool(visit.get("lead_confirmed"))
-                visit["broker_confirmed"] = bool(visit.get("broker_confirmed"))
-                visit["confirmation_sent"] = bool(visit.get("confirmation_sent"))
-                visit["feedback_requested"] = bool(visit.get("feedback_requested"))
-
-                scheduled_visits[visit_uuid] = visit
+                index(from_row(row))
                 count += 1
 
             logger.info(f"Loaded {count} pending visits from database")
@@ -754,13 +1269,112 @@ def format_visit_history_for_ai(visits: list[dict]) -> str:
     return "\n".join(lines)
 
 
+# Cache do contexto de historico de visitas por lead (texto pronto para a AI).
+# Escritas em property_visits sao raras perto dos turnos de AI: qualquer escrita
+# incrementa a versao e invalida todas as entradas (inclusive leads sem visitas).
+# O incremento fica sob lock: sem ele dois workers gravando juntos podiam ler a mesma
+# versao e uma das invalidacoes se perdia (cache servindo historico antigo).
+_visit_history_version = 0
+_visit_history_version_lock = threading.Lock()
+_visit_history_cache: dict[str, tuple[int, str]] = {}
+
+
+def invalidate_visit_history_cache() -> None:
+    """Invalida o contexto de historico em cache (chamar apos gravar em property_visits)."""
+    global _visit_history_version
+    with _visit_history_version_lock:
+        _visit_history_version += 1
+
+
+def get_cached_visit_history_context(lead_number: str) -> str:
+    """
+    Retorna o historico de visitas do lead formatado para a AI, usando cache.
+
+    Args:
+        lead_number: Numero do lead com @c.us/@lid
+
+    Returns:
+        String formatada (vazia se o lead nao tem visitas)
+    """
+    version = _visit_history_version
+    cached = _visit_history_cache.get(lead_number)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    visit_history = get_lead_visit_history(lead_number, strip_chat_suffix(lead_number))
+    context = format_visit_history_for_ai(visit_history)
+    if len(_visit_history_cache) >= MAX_CACHED_CONVERSATIONS:
+        _visit_history_cache.clear()
+    _visit_history_cache[lead_number] = (version, context)
+    return context
+
+
 # ============================================
 # CONVERSATION HISTORY DATABASE FUNCTIONS
 # ============================================
 
+# Write-behind das mensagens: save_message_to_db so enfileira e o flusher grava tudo
+# numa unica transacao (executemany) a cada MESSAGE_FLUSH_INTERVAL ou MESSAGE_FLUSH_BATCH msgs
+MESSAGE_FLUSH_INTERVAL = 0.5
+MESSAGE_FLUSH_BATCH = 32
+_pending_messages: list[tuple[str, str, str, str]] = []
+_pending_messages_lock = threading.Lock()
+_message_flush_lock = threading.Lock()  # Serializa flushes para manter a ordem de insercao
+_message_flush_event = threading.Event()
+_message_seq = itertools.count(1)
+# Flush falho devolve o lote para a frente da fila; apos MESSAGE_FLUSH_MAX_RETRIES falhas
+# seguidas (banco indisponivel) o lote e descartado para a fila nao crescer sem limite
+MESSAGE_FLUSH_MAX_RETRIES = 5
+_message_flush_failures = 0
+
+
+def flush_pending_messages() -> None:
+    """Grava no banco as mensagens enfileiradas por save_message_to_db."""
+    global _message_flush_failures
+    with _message_flush_lock:
+        with _pending_messages_lock:
+            if not _pending_messages:
+                return
+            batch = _pending_messages[:]
+            _pending_messages.clear()
+        try:
+            with get_db() as conn:
+                conn.executemany('''
+                    INSERT INTO conversation_messages (conversation_id, role, content, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', batch)
+                conn.commit()
+        except Exception as e:
+            _message_flush_failures += 1
+            if _message_flush_failures > MESSAGE_FLUSH_MAX_RETRIES:
+                _message_flush_failures = 0
+                logger.error(f"Dropping {len(batch)} messages after {MESSAGE_FLUSH_MAX_RETRIES} failed flushes: {e}")
+                return
+            logger.warning(
+                f"Error flushing {len(batch)} messages to database "
+                f"(attempt {_message_flush_failures}), will retry: {e}"
+            )
+            # Devolve o lote na frente, antes das mensagens enfileiradas nesse meio tempo
+            with _pending_messages_lock:
+                _pending_messages[:0] = batch
+        else:
+            _message_flush_failures = 0
+
+
+def _message_flusher() -> None:
+    while True:
+        _message_flush_event.wait(MESSAGE_FLUSH_INTERVAL)
+        _message_flush_event.clear()
+        flush_pending_messages()
+
+
+threading.Thread(target=_message_flusher, name="message-flusher", daemon=True).start()
+atexit.register(flush_pending_messages)
+
+
 def save_message_to_db(conversation_id: str, role: str, content: str) -> int:
     """
-    Salva mensagem no banco de dados.
+    Enfileira mensagem para gravacao no banco (write-behind).
 
     Args:
         conversation_id: ID da conversa (ex: whatsapp_5585999999999@c.us)
@@ -768,19 +1382,16 @@ def save_message_to_db(conversation_id: str, role: str, content: str) -> int:
         content: Conteudo da mensagem
 
     Returns:
-        ID da mensagem inserida
+        Numero sequencial da mensagem (o id real e atribuido no flush)
     """
-    try:
-        with get_db() as conn:
-            cursor = conn.execute('''
-                INSERT INTO conversation_messages (conversation_id, role, content)
-                VALUES (?, ?, ?)
-            ''', (conversation_id, role, content))
-            conn.commit()
-            return cursor.lastrowid
-    except Exception as e:
-        logger.error(f"Error saving message to database: {e}")
-        raise
+    # Mesmo formato do DEFAULT CURRENT_TIMESTAMP (UTC), usado nas comparacoes de limpeza
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with _pending_messages_lock:
+        _pending_messages.append((conversation_id, role, content, created_at))
+        pending = len(_pending_messages)
+    if pending >= MESSAGE_FLUSH_BATCH:
+        _message_flush_event.set()
+    return next(_message_seq)
 
 
 def get_conversation_history_from_db(conversation_id: str, limit: int = 20) -> list[dict]:
@@ -794,12 +1405,13 @@ def get_conversation_history_from_db(conversation_id: str, limit: int = 20) -> l
     Returns:
         Lista de mensagens em ordem cronologica
     """
+    flush_pending_messages()  # Inclui mensagens ainda no buffer de write-behind
     try:
         with get_db() as conn:
             cursor = conn.execute('''
                 SELECT role, content FROM conversation_messages
                 WHERE conversation_id = ?
-                ORDER BY created_at DESC
+                ORDER BY created_at DESC, id DESC
                 LIMIT ?
             ''', (conversation_id, limit))
             # Inverter para ordem cronologica (mais antigas primeiro)
@@ -818,16 +1430,25 @@ def clear_old_messages_from_db(conversation_id: str, keep_last: int = 50):
         conversation_id: ID da conversa
         keep_last: Numero de mensagens a manter
     """
+    flush_pending_messages()
     try:
         with get_db() as conn:
-            conn.execute('''
-                DELETE FROM conversation_messages
-                WHERE conversation_id = ? AND id NOT IN (
+            # id da N-esima mensagem mais recente: tudo abaixo dele e apagado num unico range.
+            # idx_messages_conversation_id ja cobre (conversation_id, id), pois o rowid faz parte do indice
+            if keep_last > 0:
+                threshold = conn.execute('''
                     SELECT id FROM conversation_messages
                     WHERE conversation_id = ?
-                    ORDER BY created_at DESC LIMIT ?
+                    ORDER BY id DESC LIMIT 1 OFFSET ?
+                ''', (conversation_id, keep_last - 1)).fetchone()
+                if not threshold:
+                    return
+                conn.execute(
+                    "DELETE FROM conversation_messages WHERE conversation_id = ? AND id < ?",
+                    (conversation_id, threshold[0]),
                 )
-            ''', (conversation_id, conversation_id, keep_last))
+            else:
+                conn.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
             conn.commit()
     except Exception as e:
         logger.error(f"Error cleaning old messages: {e}")
@@ -867,18 +1488,11 @@ def schedule_followup(lead_id: int, phone: str, delay_seconds: int = 300):
         phone: Telefone do lead
         delay_seconds: Tempo de espera (default 5 min)
     """
-    # Cancela timer anterior se existir
-    if lead_id in followup_timers:
-        followup_timers[lead_id].cancel()
+    # Cancela job anterior se existir
+    followup_scheduler.cancel(followup_timers.get(lead_id))
 
-    # Cria novo timer
-    timer = threading.Timer(
-        delay_seconds,
-        execute_followup,
-        args=[lead_id, phone]
-    )
-    followup_timers[lead_id] = timer
-    timer.start()
+    # Agenda novo job
+    followup_timers[lead_id] = followup_scheduler.schedule(delay_seconds, execute_followup, lead_id, phone)
 
     logger.info(f"Follow-up scheduled for lead {lead_id} in {delay_seconds}s")
 
@@ -886,8 +1500,7 @@ def schedule_followup(lead_id: int, phone: str, delay_seconds: int = 300):
 def cancel_followup(lead_id: int):
     """Cancela follow-up agendado (lead iniciou conversa)."""
     if lead_id in followup_timers:
-        followup_timers[lead_id].cancel()
-        del followup_timers[lead_id]
+        followup_scheduler.cancel(followup_timers.pop(lead_id))
         logger.info(f"Follow-up cancelled for lead {lead_id}")
 
 
@@ -905,51 +1518,39 @@ def format_delay(seconds: int) -> str:
         return f"{seconds // 86400} dias"
 
 
-def schedule_cold_lead_followup(conversation_id: str, last_response: str = None) -> None:
+def schedule_cold_lead_followup(conversation_id: str) -> None:
     """
     Agenda follow-up para lead que não respondeu.
     Usa sistema de tiers com delays progressivos.
 
     Args:
         conversation_id: ID da conversa (ex: whatsapp_5585999999999@c.us)
-        last_response: Última resposta do agent (opcional)
     """
-    global cold_lead_timers
-
-    # Determinar tier atual
-    current = cold_lead_timers.get(conversation_id, {})
-    current_tier = current.get("tier", 0)
-
-    # Já atingiu máximo de tiers
-    if current_tier >= len(COLD_LEAD_FOLLOWUP_TIERS):
-        logger.info(f"Max follow-up tiers reached for {conversation_id}")
-        return
-
-    # Cancelar timer existente
-    if conversation_id in cold_lead_timers:
-        old_timer = cold_lead_timers[conversation_id].get("timer")
-        if old_timer:
-            old_timer.cancel()
+    with cold_lead_lock:
+        # Determinar tier atual
+        current = cold_lead_timers.get(conversation_id)
+        current_tier = current.tier if current is not None else 0
+
+        # Já atingiu máximo de tiers
+        if current_tier >= len(COLD_LEAD_FOLLOWUP_TIERS):
+            logger.info(f"Max follow-up tiers reached for {conversation_id}")
+            return
 
-    # Determinar delay baseado no tier
-    delay = COLD_LEAD_FOLLOWUP_TIERS[current_tier]
+        # Cancelar job existente
+        if current is not None:
+            followup_scheduler.cancel(current.job_id)
 
-    # Criar novo timer
-    timer = threading.Timer(
-        delay,
-        execute_cold_lead_followup,
-        args=[conversation_id]
-    )
-    timer.daemon = True
+        # Determinar delay baseado no tier
+        delay = COLD_LEAD_FOLLOWUP_TIERS[current_tier]
 
-    cold_lead_timers[conversation_id] = {
-        "timer": timer,
-        "tier": current_tier,
-        "last_agent_response": last_response[:200] if last_response else "",
-        "scheduled_at": datetime.now()
-    }
+        # Agendar novo job
+        cold_lead_timers[conversation_id] = ColdLeadEntry(
+            job_id=followup_scheduler.schedule(delay, execute_cold_lead_followup, conversation_id),
+            tier=current_tier,
+            scheduled_at=time.monotonic(),
+        )
 
-    timer.start()
+    save_cold_lead_schedule(conversation_id, current_tier, time.time() + delay)
 
     # Log legível
     delay_text = format_delay(delay)
@@ -961,14 +1562,12 @@ def execute_cold_lead_followup(conversation_id: str) -> None:
     Executa follow-up para lead que não respondeu.
     Usa mensagem do tier atual e agenda próximo tier.
     """
-    global cold_lead_timers
-
     try:
-        if conversation_id not in cold_lead_timers:
-            return
-
-        data = cold_lead_timers[conversation_id]
-        current_tier = data.get("tier", 0)
+        with cold_lead_lock:
+            data = cold_lead_timers.get(conversation_id)
+            if data is None:
+                return
+            current_tier = data.tier
 
         # Extrair número do WhatsApp
         chat_id = conversation_id.replace("whatsapp_", "")
@@ -978,7 +1577,7 @@ def execute_cold_lead_followup(conversation_id: str) -> None:
         message = COLD_LEAD_MESSAGES.get(current_tier, COLD_LEAD_MESSAGES[0])
 
         # Enviar mensagem
-        send_waha_message_sync(session, chat_id, message)
+        send_followup_message_sync(session, chat_id, message)
 
         # Adicionar ao histórico da conversa
         add_to_history(conversation_id, "assistant", message)
@@ -988,15 +1587,25 @@ def execute_cold_lead_followup(conversation_id: str) -> None:
         # Avançar para próximo tier
         next_tier = current_tier + 1
 
-        if next_tier < len(COLD_LEAD_FOLLOWUP_TIERS):
-            # Atualizar tier e agendar próximo
-            cold_lead_timers[conversation_id]["tier"] = next_tier
-            cold_lead_timers[conversation_id]["timer"] = None
+        with cold_lead_lock:
+            # Lead respondeu (follow-up cancelado) durante o envio: nao reagendar
+            if cold_lead_timers.get(conversation_id) is not data:
+                return
+            has_next_tier = next_tier < len(COLD_LEAD_FOLLOWUP_TIERS)
+            if has_next_tier:
+                # Atualizar tier (atomico para quem le cold_lead_timers)
+                data.tier = next_tier
+                data.job_id = None
+            else:
+                # Último tier alcançado - limpar da memória
+                del cold_lead_timers[conversation_id]
+
+        if has_next_tier:
             schedule_cold_lead_followup(conversation_id)
-        else:
-            # Último tier alcançado - limpar da memória
-            del cold_lead_timers[conversation_id]
-            logger.info(f"All {len(COLD_LEAD_FOLLOWUP_TIERS)} follow-up tiers completed for {conversation_id}")
+            return
+
+        delete_cold_lead_schedule(conversation_id)
+        logger.info(f"All {len(COLD_LEAD_FOLLOWUP_TIERS)} follow-up tiers completed for {conversation_id}")
 
     except Exception as e:
         logger.exception(f"Error executing cold lead follow-up: {e}")
@@ -1007,31 +1616,87 @@ def cancel_cold_lead_followup(conversation_id: str) -> None:
     Cancela follow-up quando lead responde.
     Reseta contador para começar de novo se parar de responder.
     """
-    global cold_lead_timers
-
-    if conversation_id in cold_lead_timers:
-        timer = cold_lead_timers[conversation_id].get("timer")
-        if timer:
-            timer.cancel()
-        del cold_lead_timers[conversation_id]
+    with cold_lead_lock:
+        data = cold_lead_timers.pop(conversation_id, None)
+    if data is not None:
+        followup_scheduler.cancel(data.job_id)
+        delete_cold_lead_schedule(conversation_id)
         logger.info(f"Cold lead follow-up cancelled for {conversation_id}")
 
 
+def save_cold_lead_schedule(conversation_id: str, tier: int, fire_at: float) -> None:
+    """Grava (UPSERT) o proximo follow-up do lead frio; fire_at em epoch (time.time())."""
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                INSERT INTO cold_lead_schedule (conversation_id, tier, fire_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(conversation_id) DO UPDATE SET
+                    tier = excluded.tier, fire_at = excluded.fire_at
+            ''', (conversation_id, tier, fire_at))
+            conn.commit()
+    except Exception as e:
+        logger.warning(f"Error persisting cold lead schedule for {conversation_id}: {e}")
+
+
+def delete_cold_lead_schedule(conversation_id: str) -> None:
+    """Remove o follow-up persistido do lead frio."""
+    try:
+        with get_db() as conn:
+            conn.execute("DELETE FROM cold_lead_schedule WHERE conversation_id = ?", (conversation_id,))
+            conn.commit()
+    except Exception as e:
+        logger.warning(f"Error deleting cold lead schedule for {conversation_id}: {e}")
+
+
+def load_cold_lead_schedule() -> None:
+    """
+    Reagenda no startup os follow-ups de leads frios ainda nao vencidos.
+    Os que venceram com o servidor parado expiram (nao sao enviados atrasados).
+    """
+    now = time.time()
+    try:
+        with get_db() as conn:
+            expired = conn.execute("DELETE FROM cold_lead_schedule WHERE fire_at <= ?", (now,)).rowcount
+            conn.commit()
+            rows = conn.execute(
+                "SELECT conversation_id, tier, fire_at FROM cold_lead_schedule"
+            ).fetchall()
+
+        with cold_lead_lock:
+            for conversation_id, tier, fire_at in rows:
+                cold_lead_timers[conversation_id] = ColdLeadEntry(
+                    job_id=followup_scheduler.schedule(
+                        max(0.0, fire_at - now), execute_cold_lead_followup, conversation_id
+                    ),
+                    tier=tier,
+                    scheduled_at=time.monotonic(),
+                )
+        logger.info(f"Restored {len(rows)} cold lead follow-ups ({expired} expired)")
+    except Exception as e:
+        logger.error(f"Error loading cold lead schedule: {e}")
+
+
 def execute_followup(lead_id: int, phone: str):
     """
     Executa follow-up proativo - dados do imovel ja estao no lead (SIMPLIFICADO).
     """
+    # O job ja saiu do followup_scheduler; remove a referencia mesmo se o envio for pulado ou falhar
+    followup_timers.pop(lead_id, None)
     try:
-        # Verifica se lead ja iniciou conversa - dados do imovel ja estao na tabela
+        # Reivindica o lead numa unica transacao (UPDATE ... RETURNING): so um follow-up
+        # passa do pending para contacted, e os dados do imovel ja voltam na mesma query
         with get_db() as conn:
             lead = conn.execute(
-                "SELECT * FROM landing_leads_v2 WHERE id = ? AND status = 'pending'",
-                (lead_id,)
+                "UPDATE landing_leads_v2 SET status = 'contacted', contacted_at = ? "
+                "WHERE id = ? AND status = 'pending' RETURNING *",
+                (iso_now(), lead_id)
             ).fetchone()
+            conn.commit()
 
-            if not lead:
-                logger.info(f"Lead {lead_id} already contacted or not pending, skipping followup")
-                return
+        if not lead:
+            logger.info(f"Lead {lead_id} already contacted or not pending, skipping followup")
+            return
 
         # Formata numero para WhatsApp
         chat_id = f"{phone}@c.us"
@@ -1044,16 +1709,17 @@ Esse imovel tem {lead['property_bedrooms']} quartos{area_text}, localizado em {l
 
 Posso te ajudar a agendar uma visita?"""
 
-        # Envia mensagem
-        send_waha_message_sync("corretores", chat_id, followup_msg)
-
-        # Atualiza status do lead
-        with get_db() as conn:
-            conn.execute(
-                "UPDATE landing_leads_v2 SET status = 'contacted', contacted_at = ? WHERE id = ?",
-                (datetime.now().isoformat(), lead_id)
-            )
-            conn.commit()
+        # Envia mensagem; se falhar, devolve o lead para pending (como antes, quando o status so mudava apos o envio)
+        try:
+            send_followup_message_sync("corretores", chat_id, followup_msg)
+        except Exception:
+            with get_db() as conn:
+                conn.execute(
+                    "UPDATE landing_leads_v2 SET status = 'pending', contacted_at = NULL WHERE id = ? AND status = 'contacted'",
+                    (lead_id,)
+                )
+                conn.commit()
+            raise
 
         # Armazena contexto do imovel para proximas mensagens
         conversation_id = f"whatsapp_{chat_id}"
@@ -1075,10 +1741,6 @@ Posso te ajudar a agendar uma visita?"""
 
         logger.info(f"Follow-up sent to lead {lead_id} ({phone}) for property {lead['property_title']}")
 
-        # Remove timer da lista
-        if lead_id in followup_timers:
-            del followup_timers[lead_id]
-
     except Exception as e:
         logger.exception(f"Error executing followup for lead {lead_id}: {e}")
 
@@ -1090,15 +1752,17 @@ def get_landing_lead_by_phone(phone: str) -> dict | None:
     Returns:
         Dict com dados do lead e imovel, ou None
     """
-    # Normaliza telefone
-    phone_clean = re.sub(r'\D', '', phone)
+    # Normaliza telefone (mesmo formato gravado no registro: digitos com DDI 55)
+    phone_clean = normalize_phone(phone)
+    if not phone_clean:
+        return None
 
     try:
         with get_db() as conn:
             # Busca lead pendente ou recentemente contatado - dados do imovel ja estao na tabela
             lead = conn.execute('''
                 SELECT * FROM landing_leads_v2
-                WHERE phone = ? AND status IN ('pending', 'contacted')
+                WHERE phone_normalized = ? AND status IN ('pending', 'contacted')
                 ORDER BY registered_at DESC
                 LIMIT 1
             ''', (phone_clean,)).fetchone()
@@ -1170,50 +1834,114 @@ OBJETIVO: Agendar visita para o imovel da landing page."""
         return None
 
 
+def _cache_conversation(conversation_id: str, messages) -> deque[tuple[str, str]]:
+    """
+    Coloca historico no cache LRU, removendo as conversas menos usadas se necessario.
+
+    Args:
+        conversation_id: ID da conversa
+        messages: Iteravel de tuplas (role, content) em ordem cronologica
+
+    Returns:
+        Deque armazenado no cache
+    """
+    history = deque(messages, maxlen=MAX_HISTORY_MESSAGES)
+    with conversation_history_lock:
+        conversation_history[conversation_id] = history
+        conversation_history.move_to_end(conversation_id)
+        bump_history_version(conversation_id)
+        while len(conversation_history) > MAX_CACHED_CONVERSATIONS:
+            evicted_id, _ = conversation_history.popitem(last=False)
+            _history_versions.pop(evicted_id, None)
+            conversation_state.pop(evicted_id, None)
+            selected_property_context.pop(evicted_id, None)
+    return history
+
+
+def bump_history_version(conversation_id: str) -> None:
+    """Marca o historico da conversa como alterado (invalida o estado do lead se nao acompanhar)."""
+    _history_versions[conversation_id] = next(_history_version_counter)
+
+
 def get_conversation_history(conversation_id: str) -> list[dict]:
     """
-    Retorna historico da conversa (memoria ou banco).
+    Retorna historico da conversa (memoria ou banco) no formato da API de chat.
 
     1. Primeiro tenta memoria (cache rapido)
     2. Se nao encontrar, busca no banco de dados
     3. Se encontrar no banco, recarrega para memoria (cache)
     """
     # 1. Primeiro tenta memoria
-    if conversation_id in conversation_history and conversation_history[conversation_id]:
-        return conversation_history[conversation_id].copy()
+    with conversation_history_lock:
+        history = conversation_history.get(conversation_id)
+        if history:
+            conversation_history.move_to_end(conversation_id)
+            return [{"role": role, "content": content} for role, content in history]
 
     # 2. Se nao estiver em memoria, busca no banco de dados
     try:
         db_history = get_conversation_history_from_db(conversation_id, MAX_HISTORY_MESSAGES)
         if db_history:
             # Recarregar para memoria (cache)
-            conversation_history[conversation_id] = db_history
+            _cache_conversation(conversation_id, ((msg["role"], msg["content"]) for msg in db_history))
             logger.info(f"Loaded {len(db_history)} messages from database for {conversation_id}")
-            return db_history.copy()
+            return db_history
     except Exception as e:
         logger.warning(f"Error loading history from database: {e}")
 
     return []
 
 
+def get_conversation_history_view(conversation_id: str) -> tuple[tuple[str, str], ...]:
+    """
+    Retorna historico como tuplas (role, content), para leitura.
+
+    Evita montar um dict por mensagem como get_conversation_history; o snapshot em
+    tupla protege a iteracao contra appends concorrentes no deque.
+    """
+    with conversation_history_lock:
+        history = conversation_history.get(conversation_id)
+        if history is not None:
+            conversation_history.move_to_end(conversation_id)
+            return tuple(history)
+
+    get_conversation_history(conversation_id)  # Recarrega do banco para o cache, se existir
+    with conversation_history_lock:
+        history = conversation_history.get(conversation_id)
+        return tuple(history) if history is not None else ()
+
+
 def add_to_history(conversation_id: str, role: str, content: str) -> None:
     """
     Adiciona mensagem ao historico da conversa (memoria + banco).
 
-    1. Adiciona a memoria para acesso rapido
+    1. Adiciona a memoria para acesso rapido (deque ja limita o tamanho)
     2. Persiste no banco para permanencia
     """
-    if conversation_id not in conversation_history:
-        conversation_history[conversation_id] = []
-
-    conversation_history[conversation_id].append({
-        "role": role,
-        "content": content
-    })
-
-    # Limita tamanho do historico em memoria para evitar overflow de tokens
-    if len(conversation_history[conversation_id]) > MAX_HISTORY_MESSAGES:
-        conversation_history[conversation_id] = conversation_history[conversation_id][-MAX_HISTORY_MESSAGES:]
+    with conversation_history_lock:
+        history = conversation_history.get(conversation_id)
+        if history is None:
+            history = _cache_conversation(conversation_id, ())
+        else:
+            conversation_history.move_to_end(conversation_id)
+
+        previous_version = _history_versions.get(conversation_id)
+        # Deque cheio: o append descarta a mensagem mais antiga da janela
+        dropped_role = history[0][0] if len(history) == history.maxlen else None
+        history.append((role, content))
+        bump_history_version(conversation_id)
+
+        state = conversation_state.get(conversation_id)
+        if state is not None:
+            if dropped_role == "user":
+                # Valores de "primeira ocorrencia" podem ter saido da janela: o estado e
+                # reconstruido do historico retido na proxima leitura (igual ao estado frio)
+                del conversation_state[conversation_id]
+            elif state["version"] == previous_version:
+                # Estado em dia com o historico: incorpora so a mensagem nova
+                if role == "user":
+                    _update_state_from_message(state, content)
+                state["version"] = _history_versions[conversation_id]
 
     # Persistir no banco de dados
     try:
@@ -1224,121 +1952,182 @@ def add_to_history(conversation_id: str, role: str, content: str) -> None:
 
 def clear_conversation_history(conversation_id: str) -> None:
     """Limpa historico de uma conversa."""
-    if conversation_id in conversation_history:
-        del conversation_history[conversation_id]
+    with conversation_history_lock:
+        conversation_history.pop(conversation_id, None)
+        _history_versions.pop(conversation_id, None)
+        conversation_state.pop(conversation_id, None)
+
+
+# Lista de bairros conhecidos de Fortaleza/CE
+BAIRROS = [
+    "aldeota", "meireles", "cocó", "coco", "dionisio torres", "papicu",
+    "benfica", "centro", "fatima", "joaquim tavora", "mucuripe",
+    "praia de iracema", "varjota", "guararapes", "edson queiroz",
+    "agua fria", "luciano cavalcante", "cambeba", "messejana",
+    "parquelandia", "montese", "parangaba", "maraponga"
+]
+# Alternancia unica (mais longos primeiro): uma passada no texto em vez de um rfind por bairro
+BAIRROS_RE = re.compile("|".join(re.escape(b) for b in sorted(BAIRROS, key=len, reverse=True)))
 
+# Padroes de extracao de filtros/nome/data (compilados no import; aplicados a cada mensagem)
+BEDROOMS_RE = re.compile(r'(\d+)\s*(?:quarto|quartos|qts|qto)')
+INCOME_THOUSANDS_RE = re.compile(r'(\d+)\s*(?:mil|k)\b')
+INCOME_FULL_RE = re.compile(r'(?:r\$\s*)?(\d{1,2}[.\s]?\d{3})(?!\d)')
+NAME_INTRO_RE = re.compile(r'(?:meu nome [eé]|me chamo)\s+([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)?)', re.IGNORECASE)
+NAME_SOU_RE = re.compile(r'sou\s+[oa]?\s*([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)?)', re.IGNORECASE)
+NAME_GREETING_RE = re.compile(r'(?:oi|ola|olá),?\s+(?:aqui [eé] [oa]?\s*)?([A-Z][a-zà-ú]+)', re.IGNORECASE)
 
-def extract_filters_from_history(conversation_id: str) -> dict:
+
+# Caracteres finais do texto ja processado reaproveitados na proxima mensagem,
+# para padroes que atravessam a juncao (ex.: "2" + "quartos")
+LEAD_STATE_CARRY_CHARS = 32
+
+
+def _new_lead_state() -> dict:
+    return {
+        "version": None,
+        "name": None,
+        "neighborhood": None,
+        "bedrooms": None,
+        "renda_thousands": None,  # Padrao 1 ("9 mil") tem prioridade sobre o padrao 2 ("9500")
+        "renda_full": None,
+        "carry": "",
+    }
+
+
+def _update_state_from_message(state: dict, content: str) -> None:
     """
-    Analisa historico da conversa e extrai filtros de busca.
-    Retorna dict com: neighborhood, bedrooms, max_price
+    Aplica os padroes de extracao apenas a uma nova mensagem do usuario.
+
+    Mesma semantica da varredura do historico completo: bairro e o ultimo mencionado;
+    quartos, renda e nome ficam com a primeira ocorrencia.
     """
-    history = get_conversation_history(conversation_id)
+    text = content.lower()
+    carry = state["carry"]
+    window = f"{carry} {text}" if carry else text
+    new_start = len(window) - len(text)
 
-    # Junta todas as mensagens do usuario
-    user_messages = " ".join([
-        msg["content"].lower()
-        for msg in history
-        if msg["role"] == "user"
-    ])
+    last_match = None
+    for match in BAIRROS_RE.finditer(window):
+        last_match = match
+    if last_match and last_match.end() > new_start:
+        state["neighborhood"] = last_match.group(0)
+
+    if state["bedrooms"] is None:
+        match = BEDROOMS_RE.search(window)
+        if match:
+            state["bedrooms"] = match.group(1)
+
+    if state["renda_thousands"] is None:
+        match = INCOME_THOUSANDS_RE.search(window)
+        if match:
+            state["renda_thousands"] = int(match.group(1)) * 1000
+
+    if state["renda_full"] is None:
+        match = INCOME_FULL_RE.search(window)
+        if match:
+            state["renda_full"] = int(match.group(1).replace(".", "").replace(" ", ""))
 
+    if state["name"] is None:
+        name = _find_lead_name((("user", content),))
+        if name != "Nao informado":
+            state["name"] = name
+
+    state["carry"] = window[-LEAD_STATE_CARRY_CHARS:]
+
+
+def get_lead_state(conversation_id: str, history: tuple[tuple[str, str], ...] | None = None) -> dict:
+    """
+    Retorna o estado do lead da conversa (copia).
+
+    Em regime o estado e mantido por add_to_history; se estiver frio (conversa recarregada
+    do banco, ainda nao lida ou com mensagem do usuario descartada da janela) e reconstruido
+    a partir do historico retido (ultimas MAX_HISTORY_MESSAGES mensagens).
+
+    history: snapshot de get_conversation_history_view ja carregado pelo chamador (opcional)
+    """
+    with conversation_history_lock:
+        state = conversation_state.get(conversation_id)
+        if state is not None and state["version"] == _history_versions.get(conversation_id):
+            return dict(state)
+
+    if history is None:
+        get_conversation_history_view(conversation_id)  # Recarrega do banco, se preciso
+    with conversation_history_lock:
+        # Versao e snapshot lidos juntos: appends posteriores sao incorporados por add_to_history
+        version = _history_versions.get(conversation_id)
+        cached = conversation_history.get(conversation_id)
+        if cached is not None:
+            history = tuple(cached)
+
+    state = _new_lead_state()
+    for role, content in history or ():
+        if role == "user":
+            _update_state_from_message(state, content)
+    state["version"] = version
+
+    with conversation_history_lock:
+        if version is not None and _history_versions.get(conversation_id) == version:
+            conversation_state[conversation_id] = state
+    return dict(state)
+
+
+def extract_filters_from_history(conversation_id: str, history: tuple[tuple[str, str], ...] | None = None) -> dict:
+    """
+    Retorna filtros de busca extraidos da conversa.
+    Retorna dict com: neighborhood, bedrooms, max_price, renda
+
+    Lidos do estado incremental do lead (ver get_lead_state).
+    """
+    state = get_lead_state(conversation_id, history)
     filters = {}
 
-    # Lista de bairros conhecidos de Fortaleza/CE
-    bairros = [
-        "aldeota", "meireles", "cocó", "coco", "dionisio torres", "papicu",
-        "benfica", "centro", "fatima", "joaquim tavora", "mucuripe",
-        "praia de iracema", "varjota", "guararapes", "edson queiroz",
-        "agua fria", "luciano cavalcante", "cambeba", "messejana",
-        "parquelandia", "montese", "parangaba", "maraponga"
-    ]
+    if state["neighborhood"]:
+        filters["neighborhood"] = state["neighborhood"].title()
 
-    # CORREÇÃO: Pegar o ÚLTIMO bairro mencionado (mais recente na conversa)
-    last_bairro = None
-    last_position = -1
-    for bairro in bairros:
-        pos = user_messages.rfind(bairro)  # rfind = última ocorrência
-        if pos > last_position:
-            last_position = pos
-            last_bairro = bairro
-
-    if last_bairro:
-        filters["neighborhood"] = last_bairro.title()
-        logger.info(f"Extracted neighborhood: {last_bairro.title()} (last mentioned at pos {last_position})")
-
-    # Extrai quartos (padroes: "2 quartos", "3 qts", "2")
-    quartos_match = re.search(r'(\d+)\s*(?:quarto|quartos|qts|qto)', user_messages)
-    if quartos_match:
-        filters["bedrooms"] = quartos_match.group(1)
-        logger.info(f"Extracted bedrooms: {filters['bedrooms']}")
-
-    # CORREÇÃO: Melhorar detecção de renda
-    renda = None
-
-    # Padrão 1: "9 mil", "9k", "9mil"
-    renda_match = re.search(r'(\d+)\s*(?:mil|k)\b', user_messages)
-    if renda_match:
-        renda = int(renda_match.group(1)) * 1000
-        logger.info(f"Detected renda pattern 1: {renda_match.group(0)} -> R$ {renda:,.0f}")
-    else:
-        # Padrão 2: número grande (1000-99999) - provavelmente renda
-        # Exemplos: "9500", "9.500", "R$ 9500"
-        renda_match = re.search(r'(?:r\$\s*)?(\d{1,2}[.\s]?\d{3})(?!\d)', user_messages)
-        if renda_match:
-            renda_str = renda_match.group(1).replace(".", "").replace(" ", "")
-            renda = int(renda_str)
-            logger.info(f"Detected renda pattern 2: {renda_match.group(0)} -> R$ {renda:,.0f}")
+    if state["bedrooms"]:
+        filters["bedrooms"] = state["bedrooms"]
 
+    renda = state["renda_thousands"] if state["renda_thousands"] is not None else state["renda_full"]
     if renda and renda >= 1000:
-        max_price = renda * 0.30 * 360  # Formula de financiamento
-        filters["max_price"] = max_price
+        filters["max_price"] = renda * 0.30 * 360  # Formula de financiamento
         filters["renda"] = renda  # Renda bruta para notificacao ao corretor
-        logger.info(f"Extracted max_price: R$ {max_price:,.2f} (from renda R$ {renda:,.0f})")
 
+    logger.info(f"Extracted filters for {conversation_id}: {filters}")
     return filters
 
 
-def extract_lead_name(conversation_id: str) -> str:
+def extract_lead_name(conversation_id: str, history: tuple[tuple[str, str], ...] | None = None) -> str:
     """
-    Extrai nome do lead do historico da conversa.
+    Extrai nome do lead da conversa.
 
     Procura padroes como:
     - "meu nome e X", "me chamo X", "sou o X", "sou a X"
     - "oi, X aqui", "ola, sou X"
 
     Returns:
-        Nome do lead ou "Nao informado"
+        Nome do lead ou "Nao informado" (lido do estado incremental do lead)
     """
-    history = get_conversation_history(conversation_id)
+    return get_lead_state(conversation_id, history)["name"] or "Nao informado"
 
-    for msg in history:
-        if msg["role"] == "user":
-            text = msg["content"]
+
+def _find_lead_name(history: tuple[tuple[str, str], ...]) -> str:
+    """Aplica os padroes de nome as mensagens do usuario, na ordem da conversa."""
+    for role, text in history:
+        if role == "user":
 
             # Padrao 1: "meu nome e X", "me chamo X"
-            match = re.search(
-                r'(?:meu nome [eé]|me chamo)\s+([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)?)',
-                text,
-                re.IGNORECASE
-            )
+            match = NAME_INTRO_RE.search(text)
             if match:
                 return match.group(1).title()
 
             # Padrao 2: "sou o/a X"
-            match = re.search(
-                r'sou\s+[oa]?\s*([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)?)',
-                text,
-                re.IGNORECASE
-            )
+            match = NAME_SOU_RE.search(text)
             if match:
                 return match.group(1).title()
 
             # Padrao 3: "oi, X aqui" ou "ola, sou X"
-            match = re.search(
-                r'(?:oi|ola|olá),?\s+(?:aqui [eé] [oa]?\s*)?([A-Z][a-zà-ú]+)',
-                text,
-                re.IGNORECASE
-            )
+            match = NAME_GREETING_RE.search(text)
             if match:
                 return match.group(1).title()
 
@@ -1361,6 +2150,7 @@ def validate_lead_data_for_scheduling(conversation_id: str) -> dict:
             "collected_data": dict
         }
     """
+    # Ambos leem o estado incremental do lead, sem varrer o historico a cada turno
     filters = extract_filters_from_history(conversation_id)
     lead_name = extract_lead_name(conversation_id)
 
@@ -1388,19 +2178,69 @@ def validate_lead_data_for_scheduling(conversation_id: str) -> dict:
     }
 
 
-def extract_lead_data_with_ai(conversation_id: str) -> dict:
+_JSON_DECODER = json.JSONDecoder()
+
+
+def find_json_object(text: str) -> dict | None:
+    """Decodifica o primeiro objeto JSON embutido no texto (ex: resposta da AI com markdown ao redor)."""
+    start = text.find("{")
+    while start != -1:
+        try:
+            value, _ = _JSON_DECODER.raw_decode(text, start)
+            if isinstance(value, dict):
+                return value
+        except ValueError:
+            pass
+        start = text.find("{", start + 1)
+    return None
+
+
+def extract_lead_data_with_ai(conversation_id: str, wait: bool = False) -> dict:
     """
     Usa AI para extrair dados estruturados do histórico.
     Mais preciso que regex para variações de linguagem natural.
+
+    Sem `wait`, nao bloqueia a thread da mensagem: se o historico mudou desde a ultima
+    extracao, dispara uma nova em segundo plano e retorna o ultimo resultado conhecido
+    (ou {}). Quem precisa do dado atualizado (ex: validacao do agendamento) passa wait=True.
     """
-    history = get_conversation_history(conversation_id)
-    if not history:
-        return {}
+    version = _history_versions.get(conversation_id)
+    with ai_extraction_lock:
+        cached = _ai_extraction_cache.get(conversation_id)
+        if cached is not None and cached[0] == version:
+            return dict(cached[1])
+        previous = dict(cached[1]) if cached is not None else {}
+        if not wait:
+            if conversation_id not in _ai_extraction_pending:
+                _ai_extraction_pending.add(conversation_id)
+                ai_extraction_pool.submit(_refresh_ai_extraction, conversation_id)
+            return previous
+
+    return _refresh_ai_extraction(conversation_id)
+
+
+def _refresh_ai_extraction(conversation_id: str) -> dict:
+    """Executa a extracao via AI sobre o historico atual e guarda o resultado por versao."""
+    try:
+        version = _history_versions.get(conversation_id)  # lida antes: mudanca concorrente so causa nova extracao
+        history = get_conversation_history_view(conversation_id)
+        extracted = _request_ai_extraction(history) if history else {}
+        with ai_extraction_lock:
+            if len(_ai_extraction_cache) >= 2 * MAX_CACHED_CONVERSATIONS:
+                _ai_extraction_cache.clear()
+            _ai_extraction_cache[conversation_id] = (version, extracted)
+        return dict(extracted)
+    finally:
+        with ai_extraction_lock:
+            _ai_extraction_pending.discard(conversation_id)
 
+
+def _request_ai_extraction(history: tuple[tuple[str, str], ...]) -> dict:
+    """Chama o modelo de extracao do OpenRouter com as ultimas mensagens do historico."""
     # Formatar histórico para o prompt
     formatted = "\n".join([
-        f"{'Lead' if m['role']=='user' else 'Assistente'}: {m['content']}"
-        for m in history[-10:]  # Últimas 10 mensagens
+        f"{'Lead' if role == 'user' else 'Assistente'}: {content}"
+        for role, content in history[-10:]  # Últimas 10 mensagens
     ])
 
     extraction_prompt = """Analise o historico de conversa abaixo e extraia os dados do cliente.
@@ -1419,35 +2259,30 @@ HISTORICO:
 """ + formatted
 
     try:
-        import httpx
-        import json
-
-        with httpx.Client(timeout=15.0) as client:
-            response = client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "google/gemini-2.0-flash-001",
-                    "messages": [{"role": "user", "content": extraction_prompt}],
-                    "temperature": 0.2,
-                    "max_tokens": 200
-                }
-            )
-            response.raise_for_status()
+        response = openrouter_client.post(
+            f"{OPENROUTER_BASE_URL}/chat/completions",
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            timeout=15.0,
+            content=orjson.dumps({
+                "model": AI_EXTRACTION_MODEL,
+                "messages": [{"role": "user", "content": extraction_prompt}],
+                "temperature": 0.2,
+                "max_tokens": 200
+            })
+        )
+        response.raise_for_status()
 
-            ai_text = response.json()["choices"][0]["message"]["content"]
-            logger.info(f"AI extraction response: {ai_text[:200]}")
+        ai_text = orjson.loads(response.content)["choices"][0]["message"]["content"]
+        logger.info(f"AI extraction response: {ai_text[:200]}")
 
-            # Extrair JSON da resposta
-            import re
-            json_match = re.search(r'\{[^{}]*\}', ai_text, re.DOTALL)
-            if json_match:
-                extracted = json.loads(json_match.group())
-                logger.info(f"AI extracted lead data: {extracted}")
-                return extracted
+        # Extrair JSON da resposta (primeiro objeto valido, aceita objetos aninhados)
+        extracted = find_json_object(ai_text)
+        if extracted is not None:
+            logger.info(f"AI extracted lead data: {extracted}")
+            return extracted
 
     except Exception as e:
         logger.warning(f"AI extraction failed: {e}")
@@ -1455,6 +2290,15 @@ HISTORICO:
     return {}
 
 
+# Palavras de selecao/interesse/agendamento/mais opcoes: uma busca por categoria,
+# casando palavras inteiras ("ver" nao casa em "verdade", "mais" nao casa em "demais"),
+# com plural opcional ("esses", "visitas", "outros") como a busca por substring anterior
+SELECTION_WORDS_RE = re.compile(r'\b(?:esses?|estes?|aqueles?|ali|aí)\b')
+INTEREST_WORDS_RE = re.compile(r'\b(?:quero|gostei|interessei|gosto|prefiro|escolho)\b')
+SCHEDULE_WORDS_RE = re.compile(r'\b(?:agendar|visitas?|visitar|ver|conhecer|marcar|quando)\b')
+MORE_OPTIONS_WORDS_RE = re.compile(r'\b(?:outros?|outras?|mais|diferentes?|opcoes|opções)\b')
+
+
 def detect_property_selection(message_text: str, has_quoted: bool, quoted_msg: dict = None) -> dict:
     """
     Detecta quando usuario seleciona um imovel especifico.
@@ -1479,17 +2323,12 @@ def detect_property_selection(message_text: str, has_quoted: bool, quoted_msg: d
         "intent": "none"
     }
 
-    # Palavras que indicam selecao de imovel especifico
-    selection_words = ["esse", "este", "aquele", "esse ai", "esse aí", "ali", "aí"]
-    interest_words = ["quero", "gostei", "interessei", "gosto", "prefiro", "escolho"]
-    schedule_words = ["agendar", "visita", "visitar", "ver", "conhecer", "marcar", "quando"]
-
     # TIPO 1: Mensagem citando/respondendo a imovel (maior confianca)
     if has_quoted and quoted_msg:
         result["has_selection"] = True
         result["selection_type"] = "quoted"
 
-        if any(w in message_lower for w in schedule_words):
+        if SCHEDULE_WORDS_RE.search(message_lower):
             result["intent"] = "schedule"
         else:
             result["intent"] = "interest"
@@ -1498,19 +2337,13 @@ def detect_property_selection(message_text: str, has_quoted: bool, quoted_msg: d
         return result
 
     # TIPO 2: Palavras-chave de selecao sem citacao
-    has_selection_word = any(w in message_lower for w in selection_words)
-    has_interest_word = any(w in message_lower for w in interest_words)
-
-    if has_selection_word or has_interest_word:
+    if SELECTION_WORDS_RE.search(message_lower) or INTEREST_WORDS_RE.search(message_lower):
         # Verificar se NAO esta pedindo mais opcoes
-        more_options_words = ["outro", "mais", "diferente", "opcoes", "opções", "outras"]
-        wants_more = any(w in message_lower for w in more_options_words)
-
-        if not wants_more:
+        if not MORE_OPTIONS_WORDS_RE.search(message_lower):
             result["has_selection"] = True
             result["selection_type"] = "keyword"
 
-            if any(w in message_lower for w in schedule_words):
+            if SCHEDULE_WORDS_RE.search(message_lower):
                 result["intent"] = "schedule"
             else:
                 result["intent"] = "interest"
@@ -1520,6 +2353,23 @@ def detect_property_selection(message_text: str, has_quoted: bool, quoted_msg: d
     return result
 
 
+TOMORROW_RE = re.compile(r'amanh[aã]')
+DAY_OF_MONTH_RE = re.compile(r'dia\s+(\d{1,2})')
+CLOCK_TIME_RE = re.compile(r'(\d{1,2})[h:](\d{2})?')
+# Dia da semana e periodo: uma varredura cada; se houver varios, vale o de menor
+# prioridade (segunda..domingo; manha > tarde > noite), como no if/elif anterior.
+# Plural opcional: "aos sabados", "segundas de manha", "nas tardes"
+WEEKDAYS = {
+    "segunda": 0, "terca": 1, "terça": 1, "quarta": 2,
+    "quinta": 3, "sexta": 4, "sabado": 5, "sábado": 5, "domingo": 6
+}
+WEEKDAY_RE = re.compile(r'\b(' + '|'.join(WEEKDAYS) + r')s?\b')
+# periodo -> (prioridade, horario padrao)
+DAY_PERIODS = {"manha": (0, "09:00"), "manhã": (0, "09:00"), "tarde": (1, "14:00"), "noite": (2, "19:00")}
+DAY_PERIOD_RE = re.compile(r'\b(manh[aã]|tarde|noite)s?\b')
+DIGITS_RE = re.compile(r'\d+')
+
+
 def parse_portuguese_datetime(message: str) -> dict | None:
     """
     Parse Portuguese date/time expressions from user message.
@@ -1549,11 +2399,11 @@ def parse_portuguese_datetime(message: str) -> dict | None:
         result["date"] = today.date()
 
     # Pattern 2: "amanha" / "amanhã"
-    elif re.search(r'amanh[aã]', message_lower):
+    elif TOMORROW_RE.search(message_lower):
         result["date"] = (today + timedelta(days=1)).date()
 
     # Pattern 3: "dia X" (e.g., "dia 26", "dia 15")
-    dia_match = re.search(r'dia\s+(\d{1,2})', message_lower)
+    dia_match = DAY_OF_MONTH_RE.search(message_lower)
     if dia_match:
         day = int(dia_match.group(1))
         try:
@@ -1569,41 +2419,30 @@ def parse_portuguese_datetime(message: str) -> dict | None:
             pass  # Invalid day for month
 
     # Pattern 4: Day of week (segunda, terça, quarta, quinta, sexta, sábado, domingo)
-    weekdays = {
-        "segunda": 0, "terca": 1, "terça": 1, "quarta": 2,
-        "quinta": 3, "sexta": 4, "sabado": 5, "sábado": 5, "domingo": 6
-    }
-    for name, target_weekday in weekdays.items():
-        if name in message_lower:
-            days_ahead = target_weekday - today.weekday()
-            if days_ahead <= 0:
-                days_ahead += 7
-            result["date"] = (today + timedelta(days=days_ahead)).date()
-            break
+    target_weekday = min((WEEKDAYS[m.group(1)] for m in WEEKDAY_RE.finditer(message_lower)), default=None)
+    if target_weekday is not None:
+        days_ahead = target_weekday - today.weekday()
+        if days_ahead <= 0:
+            days_ahead += 7
+        result["date"] = (today + timedelta(days=days_ahead)).date()
 
     # === TIME PATTERNS ===
 
     # Pattern 1: Exact time "14h", "14:00", "14h30", "14:30", "às 14h"
-    time_match = re.search(r'(\d{1,2})[h:](\d{2})?', message_lower)
+    time_match = CLOCK_TIME_RE.search(message_lower)
     if time_match:
         hour = int(time_match.group(1))
         minute = int(time_match.group(2)) if time_match.group(2) else 0
         if 0 <= hour <= 23 and 0 <= minute <= 59:
             result["time"] = f"{hour:02d}:{minute:02d}"
 
-    # Pattern 2: Period of day (manhã, tarde, noite)
-    if re.search(r'manh[aã]', message_lower):
-        result["period"] = "manha"
-        if not result["time"]:
-            result["time"] = "09:00"  # Default morning time
-    elif "tarde" in message_lower:
-        result["period"] = "tarde"
+    # Pattern 2: Period of day (manhã, tarde, noite) - "amanhã" nao conta como manhã
+    period = min((DAY_PERIODS[m.group(1)] for m in DAY_PERIOD_RE.finditer(message_lower)), default=None)
+    if period is not None:
+        priority, default_time = period
+        result["period"] = ("manha", "tarde", "noite")[priority]
         if not result["time"]:
-            result["time"] = "14:00"  # Default afternoon time
-    elif "noite" in message_lower:
-        result["period"] = "noite"
-        if not result["time"]:
-            result["time"] = "19:00"  # Default evening time
+            result["time"] = default_time
 
     # Only return if we found at least a date or time
     if result["date"] or result["time"]:
@@ -1687,12 +2526,13 @@ def store_and_notify_visit(
         "property_info": property_ctx or {},
         "scheduled_date": scheduled_date,
         "scheduled_time": scheduled_time,
+        "scheduled_datetime": parse_visit_datetime(scheduled_date, scheduled_time),
         "status": "pending",  # pending, confirmed, cancelled
-        "created_at": datetime.now().isoformat(),
+        "created_at": iso_now(),
         "session": session
     }
 
-    scheduled_visits[visit_id] = visit
+    index_visit(visit)
     logger.info(f"Stored scheduled visit {visit_id} for {lead_number} on {scheduled_date} {scheduled_time}")
 
     # === PERSISTIR NO BANCO DE DADOS ===
@@ -1705,7 +2545,7 @@ def store_and_notify_visit(
 
     # === NOTIFY BROKER WITH COMPLETE LEAD DATA ===
     # Usa phone do lead_data (ja contem numero real extraido de participant para @lid)
-    lead_phone = lead_data.get("phone", lead_number.replace("@c.us", "").replace("@lid", "")) if lead_data else lead_number.replace("@c.us", "").replace("@lid", "")
+    lead_phone = (lead_data.get("phone") if lead_data else None) or strip_chat_suffix(lead_number)
 
     # Extrai dados do lead
     lead_name = lead_data.get("name", "Nao informado") if lead_data else "Nao informado"
@@ -1715,8 +2555,8 @@ def store_and_notify_visit(
     max_price = lead_data.get("max_price", 0) if lead_data else 0
 
     # Formata valores monetarios
-    renda_fmt = f"R$ {renda:,.0f}".replace(",", ".") if renda else "Nao informado"
-    limite_fmt = f"R$ {max_price:,.0f}".replace(",", ".") if max_price else "Nao informado"
+    renda_fmt = format_brl(renda) if renda else "Nao informado"
+    limite_fmt = format_brl(max_price) if max_price else "Nao informado"
 
     # Dados do imovel
     prop_title = property_ctx.get("title", "Imovel selecionado") if property_ctx else "Imovel selecionado"
@@ -1756,57 +2596,69 @@ Responda para confirmar."""
     return visit
 
 
+def message_buffer_shard(from_number: str) -> tuple[threading.Lock, dict[str, dict]]:
+    """Retorna (lock, dict) do shard do buffer responsavel por from_number."""
+    return message_buffer_shards[hash(from_number) % MESSAGE_BUFFER_SHARDS]
+
+
 def add_to_message_buffer(from_number: str, message_text: str, session: str, real_phone: str = None) -> None:
     """
-    Adiciona mensagem ao buffer e (re)inicia timer.
-    Quando o timer dispara, todas as mensagens sao processadas juntas.
-    """
-    global message_buffer
-
-    with message_buffer_lock:
-        if from_number in message_buffer:
-            # Cancela timer existente
-            old_timer = message_buffer[from_number].get("timer")
-            if old_timer:
-                old_timer.cancel()
+    Adiciona mensagem ao buffer e adia o prazo de processamento (debounce).
+    Quando o prazo vence, todas as mensagens sao processadas juntas.
 
+    Um unico job por buffer no followup_scheduler: mensagens novas so empurram o
+    "deadline", e o job reagenda a si mesmo se acordar antes dele (sem cancel +
+    schedule no heap a cada mensagem da rajada).
+    """
+    lock, message_buffer = message_buffer_shard(from_number)
+    with lock:
+        buffer_data = message_buffer.get(from_number)
+        if buffer_data is not None:
+            if len(buffer_data["messages"]) >= MAX_BUFFERED_MESSAGES:
+                # Flood: descarta sem adiar o processamento do que ja esta no buffer
+                logger.warning(f"Message buffer full for {from_number} ({MAX_BUFFERED_MESSAGES}), dropping message")
+                return
             # Adiciona mensagem ao buffer existente
-            message_buffer[from_number]["messages"].append(message_text)
+            buffer_data["messages"].append(message_text)
             # Atualiza real_phone se fornecido (mantem o primeiro valido)
-            if real_phone and not message_buffer[from_number].get("real_phone"):
-                message_buffer[from_number]["real_phone"] = real_phone
+            if real_phone and not buffer_data.get("real_phone"):
+                buffer_data["real_phone"] = real_phone
         else:
             # Cria novo buffer
-            message_buffer[from_number] = {
+            buffer_data = message_buffer[from_number] = {
                 "messages": [message_text],
                 "session": session,
-                "real_phone": real_phone or from_number.replace("@c.us", "").replace("@lid", "")
+                "real_phone": real_phone or strip_chat_suffix(from_number)
             }
 
-        # Cria novo timer
-        timer = threading.Timer(
-            MESSAGE_BUFFER_DELAY,
-            process_buffered_messages,
-            args=[from_number]
-        )
-        message_buffer[from_number]["timer"] = timer
-        timer.start()
+        buffer_data["deadline"] = time.monotonic() + MESSAGE_BUFFER_DELAY
+        if buffer_data.get("job_id") is None:
+            # Agenda processamento (o scheduler enfileira no pool ao vencer; sem thread por mensagem)
+            buffer_data["job_id"] = followup_scheduler.schedule(
+                MESSAGE_BUFFER_DELAY, process_buffered_messages, from_number
+            )
 
-        logger.info(f"Buffered message from {from_number} ({len(message_buffer[from_number]['messages'])} in buffer, processing in {MESSAGE_BUFFER_DELAY}s)")
+        logger.info(f"Buffered message from {from_number} ({len(buffer_data['messages'])} in buffer, processing in {MESSAGE_BUFFER_DELAY}s)")
 
 
 def process_buffered_messages(from_number: str) -> None:
     """
     Processa todas as mensagens acumuladas no buffer para um usuario.
-    Chamada pelo timer apos MESSAGE_BUFFER_DELAY segundos.
+    Chamada pelo followup_scheduler apos MESSAGE_BUFFER_DELAY segundos sem mensagens novas.
     """
-    global message_buffer
+    lock, message_buffer = message_buffer_shard(from_number)
+    with lock:
+        buffer_data = message_buffer.get(from_number)
+        if buffer_data is None:
+            return
 
-    with message_buffer_lock:
-        if from_number not in message_buffer:
+        # Chegou mensagem depois do agendamento: espera o restante do prazo
+        remaining = buffer_data["deadline"] - time.monotonic()
+        if remaining > 0:
+            buffer_data["job_id"] = followup_scheduler.schedule(remaining, process_buffered_messages, from_number)
             return
 
-        buffer_data = message_buffer.pop(from_number)
+        del message_buffer[from_number]
 
     messages = buffer_data["messages"]
     session = buffer_data["session"]
@@ -1814,12 +2666,15 @@ def process_buffered_messages(from_number: str) -> None:
     if not messages:
         return
 
-    # Combina todas as mensagens em uma so
-    combined_text = " ".join(messages)
-    logger.info(f"Processing {len(messages)} buffered messages from {from_number}: {combined_text[:80]}...")
+    # Combina todas as mensagens em uma so (caso comum: uma unica mensagem, ja logada em process_message_sync)
+    if len(messages) == 1:
+        combined_text = messages[0]
+    else:
+        combined_text = " ".join(messages)
+        logger.info(f"Processing {len(messages)} buffered messages from {from_number}: {combined_text[:80]}...")
 
     # Cria message_data combinado (inclui real_phone do buffer)
-    real_phone = buffer_data.get("real_phone", from_number.replace("@c.us", "").replace("@lid", ""))
+    real_phone = buffer_data["real_phone"]  # Sempre preenchido por add_to_message_buffer
     combined_message_data = {
         "from_number": from_number,
         "real_phone": real_phone,
@@ -1838,6 +2693,82 @@ def process_buffered_messages(from_number: str) -> None:
         logger.exception(f"Error processing buffered messages: {e}")
 
 
+def prepare_memude_listing(item: dict) -> tuple[int, str, float, dict]:
+    """
+    Extrai de um imovel bruto do Memude os campos usados no filtro client-side.
+
+    Returns:
+        (quartos, bairro em minusculas, preco em reais, imovel no formato de saida)
+    """
+    get = item.get  # Uma busca de atributo por imovel, nao uma por campo
+
+    # Extrai preco (em centavos)
+    price_raw = get("valor", 0)
+    try:
+        price_cents = float(price_raw) if price_raw else 0
+    except (ValueError, TypeError):
+        price_cents = 0
+    price_reais = price_cents / 100 if price_cents else 0
+
+    # Extrai bairro (categories e um array)
+    bairros = get("categories", [])
+    bairro = bairros[0] if bairros else ""
+
+    # Extrai quartos (pode ser "2", "2-3", etc); caso comum so digitos dispensa a regex
+    quartos_str = str(get("quartos", "0"))
+    if quartos_str.isdecimal():
+        quartos = int(quartos_str)
+    else:
+        quartos_match = DIGITS_RE.search(quartos_str)
+        quartos = int(quartos_match.group()) if quartos_match else 0
+
+    # Cidade pode vir como lista ou string
+    cidade = get("cidade")
+    city = cidade[0] if isinstance(cidade, list) and cidade else (cidade or "")
+
+    listing = {
+        "id": get("id"),
+        "title": get("title", "Imovel"),
+        "price": price_reais,
+        "price_formatted": format_brl(price_reais, 2),
+        "city": city,
+        "neighborhood": bairro,
+        "bedrooms": quartos_str,
+        "area": get("area", ""),
+        "image_url": get("image", ""),
+        "link": get("link", "")
+    }
+    return quartos, bairro.lower(), price_reais, listing
+
+
+def fetch_memude_catalog() -> list[tuple[int, str, float, dict]]:
+    """
+    Retorna o catalogo do Memude ja preparado para o filtro (ver prepare_memude_listing),
+    em cache por MEMUDE_CACHE_TTL segundos: a extracao por imovel roda uma vez por busca
+    a API, nao a cada lead.
+
+    Erros de rede/HTTP sao propagados (nada e guardado no cache).
+    """
+    with _memude_cache_lock:
+        if _memude_cache["data"] is not None and time.monotonic() - _memude_cache["ts"] < MEMUDE_CACHE_TTL:
+            return _memude_cache["data"]
+
+        url = "https://www.memude.com.br/wp-json/custom/v1/posts"
+        # Busca MAIS imoveis para ter margem de filtro client-side
+        params = {"per_page": 100}
+
+        logger.info(f"Searching Memude API (will filter client-side)")
+        response = memude_http.get(url, params=params, timeout=15)
+        response.raise_for_status()
+
+        all_properties = orjson.loads(response.content)
+        logger.info(f"Memude returned {len(all_properties)} total properties")
+        catalog = [prepare_memude_listing(item) for item in all_properties]
+        _memude_cache["data"] = catalog
+        _memude_cache["ts"] = time.monotonic()
+        return catalog
+
+
 def search_properties_memude(filters: dict = None) -> list[dict]:
     """
     Busca imoveis na API do Memude com filtro CLIENT-SIDE.
@@ -1851,86 +2782,38 @@ def search_properties_memude(filters: dict = None) -> list[dict]:
     Returns:
         Lista de imoveis filtrados (max 5)
     """
-    import requests
-
     try:
-        url = "https://www.memude.com.br/wp-json/custom/v1/posts"
-        # Busca MAIS imoveis para ter margem de filtro client-side
-        params = {"per_page": 100}
-
-        # Headers de browser real para evitar bloqueio Cloudflare/ModSecurity
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
-            "Referer": "https://www.memude.com.br/"
-        }
-
-        logger.info(f"Searching Memude API (will filter client-side)")
         logger.info(f"Filters to apply: {filters}")
-        response = requests.get(url, params=params, headers=headers, timeout=15)
-        response.raise_for_status()
-
-        all_properties = response.json()
-        logger.info(f"Memude returned {len(all_properties)} total properties")
+        catalog = fetch_memude_catalog()
 
         # FILTRO CLIENT-SIDE
-        filtered = []
-        for item in all_properties:
-            # Extrai dados do imovel
-            price_raw = item.get("valor", 0)
+        # Valores dos filtros normalizados uma vez, fora do loop por imovel
+        filters = filters or {}
+        filter_bairro = filters["neighborhood"].lower() if filters.get("neighborhood") else None
+        filter_quartos = None
+        if filters.get("bedrooms"):
             try:
-                price_cents = float(price_raw) if price_raw else 0
+                filter_quartos = int(filters["bedrooms"])
             except (ValueError, TypeError):
-                price_cents = 0
-            price_reais = price_cents / 100 if price_cents else 0
-
-            # Extrai bairro (categories e um array)
-            bairros = item.get("categories", [])
-            bairro = bairros[0] if bairros else ""
-
-            # Extrai quartos (pode ser "2", "2-3", etc)
-            quartos_str = str(item.get("quartos", "0"))
-            quartos_match = re.search(r'\d+', quartos_str)
-            quartos = int(quartos_match.group()) if quartos_match else 0
-
-            # Aplica filtros
-            if filters:
-                # Filtro de bairro (case-insensitive, busca parcial)
-                if filters.get("neighborhood"):
-                    filter_bairro = filters["neighborhood"].lower()
-                    if filter_bairro not in bairro.lower():
-                        continue  # Nao passou no filtro de bairro
-
-                # Filtro de quartos (minimo)
-                if filters.get("bedrooms"):
-                    try:
-                        filter_quartos = int(filters["bedrooms"])
-                        if quartos != filter_quartos:
-                            continue  # Só aceita número EXATO de quartos
-                    except (ValueError, TypeError):
-                        pass
+                pass
+        filter_max_price = filters.get("max_price")
 
-                # Filtro de preco maximo
-                if filters.get("max_price"):
-                    if price_reais > filters["max_price"]:
-                        continue  # Acima do orcamento
-
-            # Imovel passou nos filtros!
-            filtered.append({
-                "id": item.get("id"),
-                "title": item.get("title", "Imovel"),
-                "price": price_reais,
-                "price_formatted": f"R$ {price_reais:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
-                "city": item.get("cidade", [""])[0] if isinstance(item.get("cidade"), list) and item.get("cidade") else item.get("cidade", "") or "",
-                "neighborhood": bairro,
-                "bedrooms": quartos_str,
-                "area": item.get("area", ""),
-                "image_url": item.get("image", ""),
-                "link": item.get("link", "")
-            })
+        filtered = []
+        for quartos, bairro_lower, price_reais, listing in catalog:
+            # Filtro de quartos
+            if filter_quartos is not None and quartos != filter_quartos:
+                continue  # Só aceita número EXATO de quartos
+
+            # Filtro de bairro (case-insensitive, busca parcial)
+            if filter_bairro and filter_bairro not in bairro_lower:
+                continue  # Nao passou no filtro de bairro
+
+            # Filtro de preco maximo
+            if filter_max_price and price_reais > filter_max_price:
+                continue  # Acima do orcamento
+
+            # Imovel passou nos filtros! (copia: o catalogo em cache e compartilhado)
+            filtered.append(dict(listing))
 
             # Limita a 5 resultados
             if len(filtered) >= 5:
@@ -1947,6 +2830,16 @@ def search_properties_memude(filters: dict = None) -> list[dict]:
         return []
 
 
+# Linhas da legenda do imovel: (rotulo, chave em property_data, sufixo)
+PROPERTY_CAPTION_FIELDS = (
+    ("Valor", "price_formatted", ""),
+    ("Quartos", "bedrooms", ""),
+    ("Area", "area", "m2"),
+    ("Bairro", "neighborhood", ""),
+    ("Cidade", "city", ""),
+)
+
+
 def send_property_image_sync(session: str, chat_id: str, property_data: dict) -> bool:
     """
     Envia imagem de imovel via WAHA.
@@ -1959,35 +2852,24 @@ def send_property_image_sync(session: str, chat_id: str, property_data: dict) ->
     Returns:
         True se enviou, False se falhou
     """
-    import requests
-
     try:
         image_url = property_data.get("image_url")
         if not image_url:
             logger.warning(f"No image URL for property {property_data.get('title')}")
             return False
 
-        # Monta caption formatada
-        caption = f"*{property_data.get('title', 'Imovel')}*\n\n"
-
-        if property_data.get("price_formatted"):
-            caption += f"Valor: {property_data['price_formatted']}\n"
-        if property_data.get("bedrooms"):
-            caption += f"Quartos: {property_data['bedrooms']}\n"
-        if property_data.get("area"):
-            caption += f"Area: {property_data['area']}m2\n"
-        if property_data.get("neighborhood"):
-            caption += f"Bairro: {property_data['neighborhood']}\n"
-        if property_data.get("city"):
-            caption += f"Cidade: {property_data['city']}\n"
-        if property_data.get("link"):
-            caption += f"\nMais detalhes: {property_data['link']}"
+        # Monta caption formatada (uma leitura por campo e um unico join)
+        parts = [f"*{property_data.get('title', 'Imovel')}*\n\n"]
+        for label, key, suffix in PROPERTY_CAPTION_FIELDS:
+            value = property_data.get(key)
+            if value:
+                parts.append(f"{label}: {value}{suffix}\n")
+        link = property_data.get("link")
+        if link:
+            parts.append(f"\nMais detalhes: {link}")
+        caption = "".join(parts)
 
         url = f"{WAHA_BASE_URL}/api/sendImage"
-        headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": WAHA_API_KEY
-        }
         payload = {
             "session": session,
             "chatId": chat_id,
@@ -1995,7 +2877,7 @@ def send_property_image_sync(session: str, chat_id: str, property_data: dict) ->
             "caption": caption
         }
 
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = waha_http.post(url, data=orjson.dumps(payload), timeout=30)
         response.raise_for_status()
 
         logger.info(f"Sent property image to {chat_id}: {property_data.get('title')}")
@@ -2006,7 +2888,9 @@ def send_property_image_sync(session: str, chat_id: str, property_data: dict) ->
         return False
 
 
-def send_properties_to_lead(session: str, chat_id: str, filters: dict = None, conversation_id: str = None) -> int:
+def send_properties_to_lead(
+    session: str, chat_id: str, filters: dict = None, conversation_id: str = None, ai_data: dict | None = None
+) -> int:
     """
     Busca e envia imoveis para o lead.
 
@@ -2015,6 +2899,8 @@ def send_properties_to_lead(session: str, chat_id: str, filters: dict = None, co
         chat_id: ID do chat
         filters: Filtros de busca
         conversation_id: ID da conversa para extração via AI
+        ai_data: Extracao via AI ja lida no turno (evita nova consulta; a resposta da IA ja
+            mudou a versao do historico, entao o cache nao seria aproveitado)
 
     Returns:
         Quantidade de imoveis enviados
@@ -2022,7 +2908,8 @@ def send_properties_to_lead(session: str, chat_id: str, filters: dict = None, co
     # Enriquecer filtros com extração via AI se disponível
     if conversation_id and filters:
         try:
-            ai_data = extract_lead_data_with_ai(conversation_id)
+            if ai_data is None:
+                ai_data = extract_lead_data_with_ai(conversation_id)
             if ai_data:
                 # Preencher campos faltantes com dados extraídos via AI
                 if not filters.get("bedrooms") and ai_data.get("bedrooms"):
@@ -2049,11 +2936,17 @@ def send_properties_to_lead(session: str, chat_id: str, filters: dict = None, co
         return 0
 
     sent_count = 0
+    next_send_at = 0.0
     for prop in properties:
+        # Delay entre envios para nao parecer spam, contado do inicio do envio anterior:
+        # o tempo da requisicao ao WAHA ja entra no intervalo e nao ha espera apos o ultimo
+        wait = next_send_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        started = time.monotonic()
         if send_property_image_sync(session, chat_id, prop):
             sent_count += 1
-            # Delay entre envios para nao parecer spam
-            time.sleep(1.5)
+            next_send_at = started + PROPERTY_SEND_INTERVAL
 
     logger.info(f"Sent {sent_count}/{len(properties)} properties to {chat_id}")
     return sent_count
@@ -2141,41 +3034,29 @@ def extract_message_data(payload: dict[str, Any]) -> dict[str, Any] | None:
         return None
 
 
-def get_ai_response_sync(
-    message_text: str,
-    conversation_id: str,
-    property_context: dict = None,
-    is_landing_page: bool = False,
-    landing_property: dict = None,
-    properties_available: int = None,
-    active_visit: dict = None
-) -> str:
+def is_duplicate_message(message_id: str) -> bool:
     """
-    Get AI response using OpenRouter API (synchronous).
+    Registra o ID da mensagem e indica se ela ja foi recebida antes.
 
     Args:
-        message_text: User's message text
-        conversation_id: Conversation identifier
-        property_context: Optional dict with property info from property selection
-        is_landing_page: True if lead came from landing page
-        landing_property: Property dict from landing page context
-        properties_available: Number of properties available (None if not checked)
-        active_visit: Visit dict if lead has an active scheduled visit
+        message_id: ID da mensagem no WAHA
 
     Returns:
-        AI-generated response text
+        True se a mensagem e uma reentrega do webhook
     """
-    try:
-        import httpx
+    if not message_id:
+        return False
+    with seen_message_ids_lock:
+        if message_id in seen_message_ids:
+            return True
+        seen_message_ids[message_id] = None
+        if len(seen_message_ids) > MAX_SEEN_MESSAGE_IDS:
+            seen_message_ids.popitem(last=False)
+        return False
 
-        # Use prompt diferenciado para landing leads
-        if is_landing_page and landing_property:
-            landing_prompt = get_system_prompt_for_lead(True, landing_property)
-            if landing_prompt:
-                system_prompt = landing_prompt
-            else:
-                # Fallback to default
-                system_prompt = """Voce e um assistente imobiliario do Ceara conversando pelo WhatsApp.
+
+# Prompts de sistema fixos (o de landing lead especifico vem de get_system_prompt_for_lead)
+LANDING_FALLBACK_SYSTEM_PROMPT = """Voce e um assistente imobiliario do Ceara conversando pelo WhatsApp.
 
 REGRAS:
 - Respostas CURTAS (2-3 frases)
@@ -2184,8 +3065,10 @@ REGRAS:
 - NUNCA peca numero de WhatsApp (voce JA esta no WhatsApp)
 
 Foco em agendar visita para o imovel especifico."""
-        else:
-            system_prompt = """Voce e um assistente imobiliario do Ceara conversando pelo WhatsApp.
+
+# Prompt padrao em tres partes: o bloco de qualificacao sai quando o lead ja informou
+# nome, bairro e quartos (QUALIFIED_SYSTEM_PROMPT), encurtando o prompt dos turnos seguintes
+SYSTEM_PROMPT_RULES = """Voce e um assistente imobiliario do Ceara conversando pelo WhatsApp.
 
 REGRAS:
 - Respostas CURTAS (2-3 frases)
@@ -2193,7 +3076,9 @@ REGRAS:
 - SEM EMOJIS
 - NUNCA peca numero de WhatsApp (voce JA esta no WhatsApp)
 
-DADOS OBRIGATORIOS PARA AGENDAMENTO:
+"""
+
+SYSTEM_PROMPT_QUALIFICATION = """DADOS OBRIGATORIOS PARA AGENDAMENTO:
 Antes de confirmar QUALQUER visita, voce DEVE ter coletado:
 1. Nome do cliente
 2. Bairro de interesse
@@ -2214,7 +3099,9 @@ FLUXO DE QUALIFICACAO:
    - Usar para calcular limite de financiamento: Renda x 30% x 360
    - IMPORTANTE: Perguntar renda ANTES de enviar opcoes de imoveis
 
-QUANDO LEAD PEDIR OPCOES/FOTOS:
+"""
+
+SYSTEM_PROMPT_FLOW = """QUANDO LEAD PEDIR OPCOES/FOTOS:
 - Se NAO tiver renda ainda, pergunte: "Para te enviar opcoes adequadas, qual sua renda mensal aproximada?"
 - Se contexto indicar [DISPONIBILIDADE: X imoveis disponiveis], responda "Vou te enviar algumas opcoes agora"
 - Se contexto indicar [DISPONIBILIDADE: NAO ha imoveis disponiveis], NUNCA diga que vai enviar. Responda algo como "No momento nao encontrei imoveis com esses criterios. Posso buscar em outro bairro ou ajustar os criterios?"
@@ -2247,28 +3134,122 @@ NUNCA agende diretamente sem o lead confirmar a data exata.
 Se receber contexto de imovel SELECIONADO, foque nele e ofereça visita.
 Seja conversacional e direto."""
 
-        # Injetar data atual no prompt para o AI calcular datas corretamente
-        today = datetime.now()
-        weekday_names = ["segunda-feira", "terca-feira", "quarta-feira", "quinta-feira", "sexta-feira", "sabado", "domingo"]
-        today_weekday = weekday_names[today.weekday()]
+DEFAULT_SYSTEM_PROMPT = SYSTEM_PROMPT_RULES + SYSTEM_PROMPT_QUALIFICATION + SYSTEM_PROMPT_FLOW
 
-        # Calcular próximos dias da semana para referência
-        days_until_friday = (4 - today.weekday()) % 7
-        if days_until_friday == 0:  # Se já é sexta, vai para próxima
-            days_until_friday = 7
-        next_friday = today + timedelta(days=days_until_friday)
+QUALIFIED_SYSTEM_PROMPT = SYSTEM_PROMPT_RULES + """DADOS DO LEAD:
+Nome, bairro e quartos ja foram informados na conversa - NAO pergunte de novo.
+Se ainda nao tiver a renda mensal, pergunte antes de enviar opcoes de imoveis.
 
-        days_until_saturday = (5 - today.weekday()) % 7
-        if days_until_saturday == 0:  # Se já é sábado, vai para próximo
-            days_until_saturday = 7
-        next_saturday = today + timedelta(days=days_until_saturday)
+""" + SYSTEM_PROMPT_FLOW
 
-        date_context = f"""DATA ATUAL: Hoje é {today_weekday}, {today.strftime('%d/%m/%Y')}.
+WEEKDAY_NAMES = ("segunda-feira", "terca-feira", "quarta-feira", "quinta-feira", "sexta-feira", "sabado", "domingo")
+
+
+@lru_cache(maxsize=4)
+def get_date_context(today: date) -> str:
+    """
+    Monta o bloco "DATA ATUAL" injetado no system prompt.
+    So muda na virada do dia, por isso fica em cache pela data.
+    """
+    today_weekday = WEEKDAY_NAMES[today.weekday()]
+
+    # Calcular próximos dias da semana para referência
+    days_until_friday = (4 - today.weekday()) % 7
+    if days_until_friday == 0:  # Se já é sexta, vai para próxima
+        days_until_friday = 7
+    next_friday = today + timedelta(days=days_until_friday)
+
+    days_until_saturday = (5 - today.weekday()) % 7
+    if days_until_saturday == 0:  # Se já é sábado, vai para próximo
+        days_until_saturday = 7
+    next_saturday = today + timedelta(days=days_until_saturday)
+
+    return f"""DATA ATUAL: Hoje é {today_weekday}, {today.strftime('%d/%m/%Y')}.
 Proxima sexta-feira: {next_friday.strftime('%d/%m/%Y')}
 Proximo sabado: {next_saturday.strftime('%d/%m/%Y')}
 Use essas datas como referencia ao confirmar agendamentos.
 
 """
+
+
+def choose_model_and_prompt(conversation_id: str, message_text: str, property_context: dict = None) -> tuple[str, str]:
+    """
+    Escolhe modelo e system prompt do turno (leads que nao vieram de landing page).
+
+    Com nome, bairro e quartos ja coletados (estado do lead, sem varrer historico) usa o
+    prompt sem o bloco de qualificacao; nesse caso, se AI_MODEL_LIGHT estiver configurado
+    e o turno nao envolver imovel selecionado nem agendamento, usa o modelo leve.
+    """
+    if not validate_lead_data_for_scheduling(conversation_id)["is_valid"]:
+        return AI_MODEL, DEFAULT_SYSTEM_PROMPT
+
+    use_light = AI_MODEL_LIGHT and not property_context and not SCHEDULE_WORDS_RE.search(message_text.lower())
+    return (AI_MODEL_LIGHT if use_light else AI_MODEL), QUALIFIED_SYSTEM_PROMPT
+
+
+def get_cached_ai_response(cache_key: bytes) -> str | None:
+    """Retorna a resposta em cache para o payload (None se ausente ou expirada)."""
+    with _ai_response_cache_lock:
+        cached = _ai_response_cache.get(cache_key)
+        if cached is None:
+            return None
+        stored_at, ai_message = cached
+        if time.monotonic() - stored_at > AI_RESPONSE_CACHE_TTL:
+            del _ai_response_cache[cache_key]
+            return None
+        _ai_response_cache.move_to_end(cache_key)
+        return ai_message
+
+
+def store_ai_response(cache_key: bytes, ai_message: str) -> None:
+    """Guarda a resposta do LLM (LRU limitado a MAX_AI_RESPONSE_CACHE entradas)."""
+    with _ai_response_cache_lock:
+        _ai_response_cache[cache_key] = (time.monotonic(), ai_message)
+        _ai_response_cache.move_to_end(cache_key)
+        while len(_ai_response_cache) > MAX_AI_RESPONSE_CACHE:
+            _ai_response_cache.popitem(last=False)
+
+
+def get_ai_response_sync(
+    message_text: str,
+    conversation_id: str,
+    property_context: dict = None,
+    is_landing_page: bool = False,
+    landing_property: dict = None,
+    properties_available: int = None,
+    active_visit: dict = None
+) -> str:
+    """
+    Get AI response using OpenRouter API (synchronous).
+
+    Args:
+        message_text: User's message text
+        conversation_id: Conversation identifier
+        property_context: Optional dict with property info from property selection
+        is_landing_page: True if lead came from landing page
+        landing_property: Property dict from landing page context
+        properties_available: Number of properties available (None if not checked)
+        active_visit: Visit dict if lead has an active scheduled visit
+
+    Returns:
+        AI-generated response text
+    """
+    try:
+        model = AI_MODEL
+
+        # Use prompt diferenciado para landing leads
+        if is_landing_page and landing_property:
+            landing_prompt = get_system_prompt_for_lead(True, landing_property)
+            if landing_prompt:
+                system_prompt = landing_prompt
+            else:
+                # Fallback to default
+                system_prompt = LANDING_FALLBACK_SYSTEM_PROMPT
+        else:
+            model, system_prompt = choose_model_and_prompt(conversation_id, message_text, property_context)
+
+        # Injetar data atual no prompt para o AI calcular datas corretamente (calculado uma vez por dia)
+        date_context = get_date_context(datetime.now().date())
         # Prepend ao system_prompt
         system_prompt = date_context + system_prompt
 
@@ -2308,13 +3289,10 @@ Use essas datas como referencia ao confirmar agendamentos.
         try:
             # Extrair lead_number do conversation_id (whatsapp_PHONE@c.us)
             lead_number = conversation_id.replace("whatsapp_", "") if conversation_id.startswith("whatsapp_") else conversation_id
-            visit_history = get_lead_visit_history(lead_number, lead_number.replace("@c.us", "").replace("@lid", ""))
-
-            if visit_history:
-                history_context = format_visit_history_for_ai(visit_history)
-                if history_context:
-                    user_message = f"{history_context}\n{user_message}"
-                    logger.info(f"Injected {len(visit_history)} visit history records for {conversation_id}")
+            history_context = get_cached_visit_history_context(lead_number)
+            if history_context:
+                user_message = f"{history_context}\n{user_message}"
+                logger.info(f"Injected visit history for {conversation_id}")
         except Exception as e:
             logger.warning(f"Error getting visit history for AI context: {e}")
 
@@ -2331,26 +3309,35 @@ Use essas datas como referencia ao confirmar agendamentos.
         messages.append({"role": "user", "content": user_message})
 
         payload = {
-            "model": "google/gemini-3-flash-preview",
+            "model": model,
             "messages": messages,
             "temperature": 0.7,
             "max_tokens": 150
         }
 
-        # Use httpx client for API calls
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
+        body = orjson.dumps(payload)
+        cache_key = hashlib.sha256(body).digest()
+        cached = get_cached_ai_response(cache_key)
+        if cached is not None:
+            stats["ai_cache_hits"] += 1
+            logger.info(f"AI response cache hit for conversation {conversation_id}")
+            return cached
+        stats["ai_cache_misses"] += 1
+
+        # Cliente compartilhado (keep-alive) para as chamadas da API
+        response = openrouter_client.post(
+            f"{OPENROUTER_BASE_URL}/chat/completions",
+            headers=headers,
+            content=body
+        )
+        response.raise_for_status()
 
-            data = response.json()
-            ai_message = data["choices"][0]["message"]["content"]
+        data = orjson.loads(response.content)
+        ai_message = data["choices"][0]["message"]["content"]
+        store_ai_response(cache_key, ai_message)
 
-            logger.info(f"Got AI response for conversation {conversation_id}")
-            return ai_message
+        logger.info(f"Got AI response for conversation {conversation_id}")
+        return ai_message
 
     except Exception as e:
         logger.exception(f"Error getting AI response: {e}")
@@ -2398,11 +3385,6 @@ def send_waha_message_sync(session: str, chat_id: str, text: str) -> dict[str, A
     """
     url = f"{WAHA_BASE_URL}/api/sendText"  # Define before try to avoid UnboundLocalError
     try:
-        import requests
-        headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": WAHA_API_KEY
-        }
         payload = {
             "session": session,
             "chatId": chat_id,
@@ -2411,11 +3393,10 @@ def send_waha_message_sync(session: str, chat_id: str, text: str) -> dict[str, A
 
         logger.info(f"Sending message to WAHA: url={url}, chatId={chat_id}, session={session}")
 
-        # Use requests library which has better Docker networking compatibility
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = waha_http.post(url, data=orjson.dumps(payload), timeout=30)
         response.raise_for_status()
 
-        result = response.json()
+        result = orjson.loads(response.content)
         logger.info(f"Message sent successfully to {chat_id}")
         return result
 
@@ -2424,6 +3405,41 @@ def send_waha_message_sync(session: str, chat_id: str, text: str) -> dict[str, A
         raise
 
 
+def send_followup_message_sync(session: str, chat_id: str, text: str) -> dict[str, Any]:
+    """
+    Envia mensagem proativa (follow-up agendado) respeitando WAHA_FOLLOWUP_CONCURRENCY.
+
+    Raises:
+        TimeoutError: se nao houver vaga de envio em FOLLOWUP_SEND_WAIT segundos
+    """
+    if not followup_send_slots.acquire(timeout=FOLLOWUP_SEND_WAIT):
+        raise TimeoutError(f"No follow-up send slot available for {chat_id} after {FOLLOWUP_SEND_WAIT}s")
+    try:
+        return send_waha_message_sync(session, chat_id, text)
+    finally:
+        followup_send_slots.release()
+
+
+def notify_waha_async(notify: Callable[..., bool], *args) -> bool:
+    """
+    Dispara uma notificacao de UI ao WAHA (mark_as_seen_sync, send_typing_indicator_sync)
+    no waha_notify_pool, sem esperar a resposta.
+
+    Returns:
+        False se a fila ja tem WAHA_NOTIFY_MAX_PENDING notificacoes pendentes (descartada)
+    """
+    if not waha_notify_slots.acquire(blocking=False):
+        logger.warning(f"WAHA notify queue full, dropping {notify.__name__}")
+        return False
+    try:
+        future = waha_notify_pool.submit(notify, *args)
+    except RuntimeError:  # Pool encerrado (shutdown)
+        waha_notify_slots.release()
+        return False
+    future.add_done_callback(lambda _: waha_notify_slots.release())
+    return True
+
+
 def mark_as_seen_sync(session: str, chat_id: str) -> bool:
     """
     Marca mensagens como lidas/vistas via WAHA API.
@@ -2431,17 +3447,12 @@ def mark_as_seen_sync(session: str, chat_id: str) -> bool:
     """
     url = f"{WAHA_BASE_URL}/api/{session}/sendSeen"
     try:
-        import requests
-        headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": WAHA_API_KEY
-        }
         payload = {
             "session": session,
             "chatId": chat_id
         }
         logger.info(f"Marking message as seen for {chat_id}")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = waha_http.post(url, data=orjson.dumps(payload), timeout=10)
         response.raise_for_status()
         logger.info(f"Message marked as seen for {chat_id}")
         return True
@@ -2457,17 +3468,12 @@ def send_typing_indicator_sync(session: str, chat_id: str) -> bool:
     """
     url = f"{WAHA_BASE_URL}/api/{session}/presence"
     try:
-        import requests
-        headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": WAHA_API_KEY
-        }
         payload = {
             "chatId": chat_id,
             "presence": "typing"
         }
         logger.info(f"Sending typing indicator to {chat_id}")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = waha_http.post(url, data=orjson.dumps(payload), timeout=10)
         response.raise_for_status()
         logger.info(f"Typing indicator sent to {chat_id}")
         return True
@@ -2476,6 +3482,88 @@ def send_typing_indicator_sync(session: str, chat_id: str) -> bool:
         return False
 
 
+def deliver_reply(session: str, chat_id: str, text: str) -> bool:
+    """
+    Envia uma resposta agendada ao lead (apos pausa de digitacao).
+
+    O processamento da mensagem ja foi contado quando o envio foi agendado; um envio
+    falho conta em messages_failed. Retorna True se a mensagem foi enviada.
+    """
+    try:
+        send_waha_message_sync(session, chat_id, text)
+        return True
+    except Exception as e:
+        stats["messages_failed"] += 1
+        logger.exception(f"Failed to deliver reply to {chat_id}: {e}")
+        return False
+
+
+def deliver_ai_response(
+    session: str,
+    from_number: str,
+    conversation_id: str,
+    ai_response: str,
+    send_properties: bool,
+    ai_data: dict | None = None,
+) -> None:
+    """
+    Envia a resposta da IA apos a pausa de "digitando..." (agendado pelo followup_scheduler).
+
+    As pausas viram jobs agendados: nenhum worker fica parado em time.sleep enquanto
+    o lead "espera" a digitacao ou o intervalo antes das fotos.
+    """
+    if not deliver_reply(session, from_number, ai_response):
+        return
+    logger.info(f"Successfully sent AI response to {from_number}")
+
+    if send_properties:
+        # Pequeno delay antes das fotos
+        followup_scheduler.schedule(2, deliver_properties, session, from_number, conversation_id, ai_data)
+
+
+def deliver_properties(session: str, from_number: str, conversation_id: str, ai_data: dict | None = None) -> None:
+    """
+    Busca e envia imoveis com os filtros da conversa e agenda o resumo final.
+
+    ai_data: extracao via AI lida no turno (pre-check/agendamento), reaproveitada no enriquecimento
+    """
+    try:
+        # Extrai filtros da conversa (bairro, quartos, preco)
+        filters = extract_filters_from_history(conversation_id)
+        logger.info(f"Extracted filters from conversation: {filters}")
+
+        # Busca e envia imoveis com filtros
+        properties_sent = send_properties_to_lead(
+            session, from_number, filters=filters, conversation_id=conversation_id, ai_data=ai_data
+        )
+    except Exception as e:
+        logger.exception(f"Error sending properties to {from_number}: {e}")
+        return
+
+    if properties_sent > 0:
+        followup_scheduler.schedule(
+            1, deliver_reply, session, from_number,
+            f"Enviei {properties_sent} opcoes para voce. Algum te interessou?"
+        )
+
+
+# Palavras-chave de intencao do usuario (compiladas uma vez, sem .lower() por mensagem)
+USER_WANTS_PROPERTIES_RE = re.compile(
+    r'\b(?:fotos?|imagens?|op[cç][aã]o|op[cç][oõ]es|im[oó]ve[il]s?|apartamento|casa|ver|mostrar'
+    r'|tem o que|tem algo|dispon[ií]vel)\b',
+    re.IGNORECASE,
+)
+SKIP_COLD_FOLLOWUP_RE = re.compile(
+    r'\b(?:sem interesse|nao quero|nao tenho interesse|nao preciso|desisto|cancelar)\b',
+    re.IGNORECASE,
+)
+# Frases da RESPOSTA da IA que prometem envio de opcoes (busca por substring, como antes)
+AI_PROMISES_PROPERTIES_RE = re.compile(
+    r'vou (?:te )?enviar|enviar (?:algumas|op(?:coes|ções))|te mostrar algumas|mostrar algumas op(?:coes|ções)',
+    re.IGNORECASE,
+)
+
+
 def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
     """
     Process incoming WhatsApp message and send AI response (synchronous).
@@ -2486,6 +3574,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
     Returns:
         Processing result
     """
+    started_at = time.monotonic()
     try:
         from_number = message_data["from_number"]
         message_text = message_data["message_text"]
@@ -2495,8 +3584,8 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
 
         logger.info(f"Processing message from {from_number}: {message_text[:50]}...")
 
-        # Marcar mensagem como lida (check azul no WhatsApp do lead)
-        mark_as_seen_sync(session, from_number)
+        # Marcar mensagem como lida (check azul no WhatsApp do lead), em paralelo com o processamento
+        notify_waha_async(mark_as_seen_sync, session, from_number)
 
         # Create conversation ID
         conversation_id = f"whatsapp_{from_number}"
@@ -2506,7 +3595,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
         cancel_cold_lead_followup(conversation_id)
 
         # ===== DETECTAR LEAD DE LANDING PAGE =====
-        real_phone = message_data.get("real_phone", from_number.replace("@c.us", "").replace("@lid", ""))
+        real_phone = message_data.get("real_phone") or strip_chat_suffix(from_number)
         is_landing_page_lead = False
         lp_context = None
 
@@ -2525,7 +3614,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
                     with get_db() as conn:
                         conn.execute(
                             "UPDATE landing_leads_v2 SET status = 'in_conversation', first_message_at = ? WHERE id = ?",
-                            (datetime.now().isoformat(), lp_context["lead_id"])
+                            (iso_now(), lp_context["lead_id"])
                         )
                         conn.commit()
                 except Exception as e:
@@ -2547,36 +3636,35 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
         # ===== PROCESSAR CONFIRMAÇÃO/FEEDBACK DE VISITA =====
         visit_for_confirmation = lead_has_scheduled_visit(from_number, real_phone)
         if visit_for_confirmation:
-            message_lower = message_text.lower().strip()
-
             # Verificar se é resposta de confirmação
             if visit_for_confirmation.get("confirmation_sent") and not visit_for_confirmation.get("lead_confirmed"):
                 if is_confirmation_response(message_text):
-                    if any(w in message_lower for w in ["sim", "confirmo", "vou", "irei"]):
+                    if CONFIRMATION_YES_RE.search(message_text):
+                        confirmed_at = iso_now()  # mesmo instante em memoria e no banco
                         visit_for_confirmation["lead_confirmed"] = True
-                        visit_for_confirmation["lead_confirmed_at"] = datetime.now().isoformat()
+                        visit_for_confirmation["lead_confirmed_at"] = confirmed_at
                         response = "Confirmado! Estaremos te esperando. Ate mais tarde!"
                         # Notificar corretor
                         notify_broker_lead_confirmed(visit_for_confirmation)
                         # Persistir no banco
                         update_visit_in_db(visit_for_confirmation["id"], {
                             "lead_confirmed": 1,
-                            "lead_confirmed_at": datetime.now().isoformat(),
+                            "lead_confirmed_at": confirmed_at,
                             "status": "confirmed"
                         })
                     else:
                         visit_for_confirmation["status"] = "cancelled"
+                        cancel_visit_followups(visit_for_confirmation)
                         response = "Entendi, visita cancelada. Posso ajudar a reagendar para outro dia?"
                         # Persistir cancelamento no banco
                         update_visit_in_db(visit_for_confirmation["id"], {
                             "status": "cancelled"
                         })
 
-                    # Enviar resposta e encerrar processamento
-                    send_typing_indicator_sync(session, from_number)
-                    time.sleep(1)
-                    send_waha_message_sync(session, from_number, response)
+                    # Enviar resposta e encerrar processamento ("digitando..." corre durante a pausa)
+                    notify_waha_async(send_typing_indicator_sync, session, from_number)
                     add_to_history(conversation_id, "assistant", response)
+                    followup_scheduler.schedule(1, deliver_reply, session, from_number, response)
                     logger.info(f"Processed confirmation response for visit #{visit_for_confirmation['id']}")
                     return {"status": "success", "type": "confirmation_response"}
 
@@ -2596,15 +3684,14 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
                     # Persistir feedback no banco
                     update_visit_in_db(visit_for_confirmation["id"], {
                         "feedback_score": score,
-                        "feedback_at": datetime.now().isoformat(),
+                        "feedback_at": iso_now(),
                         "status": "completed"
                     })
 
-                    # Enviar resposta e encerrar processamento
-                    send_typing_indicator_sync(session, from_number)
-                    time.sleep(1)
-                    send_waha_message_sync(session, from_number, response)
+                    # Enviar resposta e encerrar processamento ("digitando..." corre durante a pausa)
+                    notify_waha_async(send_typing_indicator_sync, session, from_number)
                     add_to_history(conversation_id, "assistant", response)
+                    followup_scheduler.schedule(1, deliver_reply, session, from_number, response)
                     logger.info(f"Processed feedback (score={score}) for visit #{visit_for_confirmation['id']}")
                     return {"status": "success", "type": "feedback_response", "score": score}
 
@@ -2638,16 +3725,22 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
 
         # ===== DETECTAR AGENDAMENTO DE VISITA =====
         scheduling = detect_scheduling_intent(message_text, conversation_id)
+        # Filtros/dados AI ja lidos neste turno (reaproveitados no pre-check e no envio de imoveis)
+        lead_filters = None
+        lead_ai_data = None
 
         if scheduling["has_scheduling"]:
             logger.info(f"Scheduling intent detected! Validating lead data...")
 
-            # Primeiro: Tentar extração via AI (mais precisa para respostas curtas)
-            ai_data = extract_lead_data_with_ai(conversation_id)
+            # Primeiro: Tentar extração via AI (mais precisa para respostas curtas);
+            # aguarda o resultado atualizado pois decide se o agendamento pode seguir
+            ai_data = extract_lead_data_with_ai(conversation_id, wait=True)
 
             # Segundo: Fallback para regex
-            filters = extract_filters_from_history(conversation_id)
-            lead_name = extract_lead_name(conversation_id)
+            history = get_conversation_history_view(conversation_id)
+            filters = extract_filters_from_history(conversation_id, history)
+            lead_name = extract_lead_name(conversation_id, history)
+            lead_filters, lead_ai_data = filters, ai_data
 
             # Combinar dados: AI tem prioridade, depois regex
             final_name = ai_data.get("name") or lead_name
@@ -2674,7 +3767,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
 
                 lead_data = {
                     "name": final_name,
-                    "phone": message_data.get("real_phone", from_number.replace("@c.us", "").replace("@lid", "")),
+                    "phone": real_phone,
                     "neighborhood": final_neighborhood,
                     "bedrooms": final_bedrooms,
                     "renda": final_renda if final_renda else 0,
@@ -2694,51 +3787,49 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
                 logger.info(f"Visit scheduled and broker notified: {visit}")
 
         # Detecta pedido de fotos/opcoes na MENSAGEM DO USUARIO
-        message_lower = message_text.lower()
-        user_wants_properties = any(keyword in message_lower for keyword in [
-            "foto", "fotos", "imagem", "imagens",
-            "opcao", "opcoes", "opção", "opções",
-            "imovel", "imoveis", "imóvel", "imóveis",
-            "apartamento", "casa", "ver", "mostrar",
-            "tem o que", "tem algo", "disponivel", "disponível"
-        ])
+        user_wants_properties = bool(USER_WANTS_PROPERTIES_RE.search(message_text))
+
+        # Verificar se lead tem visita agendada ANTES de gerar resposta AI
+        pre_active_visit = lead_has_scheduled_visit(from_number, real_phone)
 
         # ===== PRE-CHECK: Verificar disponibilidade de imoveis ANTES de gerar resposta =====
+        # So quando o turno pode oferecer opcoes: com visita agendada, lead de landing page ou
+        # imovel ja selecionado nada e enviado (ver DECISAO abaixo), entao evita AI/Memude
         available_count = None
         pre_filters = None
-        try:
-            # Adiciona mensagem atual ao historico temporariamente para extração
-            temp_history = get_conversation_history(conversation_id) + [{"role": "user", "content": message_text}]
-
-            # Extrai filtros incluindo a mensagem atual
-            pre_filters = extract_filters_from_history(conversation_id)
-
-            # Se tem filtros suficientes, consulta disponibilidade
-            if pre_filters.get("neighborhood") or pre_filters.get("max_price") or pre_filters.get("bedrooms"):
-                # Usa AI extraction para enriquecer filtros (como já fazemos em send_properties_to_lead)
-                ai_data = extract_lead_data_with_ai(conversation_id)
-                if ai_data:
-                    if not pre_filters.get("bedrooms") and ai_data.get("bedrooms"):
-                        pre_filters["bedrooms"] = str(ai_data.get("bedrooms"))
-                    if not pre_filters.get("neighborhood") and ai_data.get("neighborhood"):
-                        pre_filters["neighborhood"] = ai_data.get("neighborhood")
-                    if not pre_filters.get("max_price") and ai_data.get("renda"):
-                        try:
-                            renda = float(ai_data.get("renda"))
-                            pre_filters["max_price"] = renda * 0.30 * 360
-                        except (ValueError, TypeError):
-                            pass
-
-                # Consulta Memude
-                pre_search_results = search_properties_memude(pre_filters)
-                available_count = len(pre_search_results) if pre_search_results else 0
-                logger.info(f"Pre-check: {available_count} properties available for filters {pre_filters}")
-        except Exception as e:
-            logger.warning(f"Pre-check failed: {e}")
-            available_count = None
-
-        # Verificar se lead tem visita agendada ANTES de gerar resposta AI
-        pre_active_visit = lead_has_scheduled_visit(from_number, real_phone)
+        if not (pre_active_visit or is_landing_page_lead or selection["has_selection"]):
+            try:
+                # Extrai filtros incluindo a mensagem atual (ja no historico); copia pois e enriquecido abaixo
+                if lead_filters is not None:
+                    pre_filters = dict(lead_filters)
+                else:
+                    pre_filters = extract_filters_from_history(conversation_id)
+
+                # Se tem filtros suficientes, consulta disponibilidade
+                if pre_filters.get("neighborhood") or pre_filters.get("max_price") or pre_filters.get("bedrooms"):
+                    # Usa AI extraction para enriquecer filtros (como já fazemos em send_properties_to_lead)
+                    if lead_ai_data is None:
+                        lead_ai_data = extract_lead_data_with_ai(conversation_id)
+                    ai_data = lead_ai_data
+                    if ai_data:
+                        if not pre_filters.get("bedrooms") and ai_data.get("bedrooms"):
+                            pre_filters["bedrooms"] = str(ai_data.get("bedrooms"))
+                        if not pre_filters.get("neighborhood") and ai_data.get("neighborhood"):
+                            pre_filters["neighborhood"] = ai_data.get("neighborhood")
+                        if not pre_filters.get("max_price") and ai_data.get("renda"):
+                            try:
+                                renda = float(ai_data.get("renda"))
+                                pre_filters["max_price"] = renda * 0.30 * 360
+                            except (ValueError, TypeError):
+                                pass
+
+                    # Consulta Memude
+                    pre_search_results = search_properties_memude(pre_filters)
+                    available_count = len(pre_search_results) if pre_search_results else 0
+                    logger.info(f"Pre-check: {available_count} properties available for filters {pre_filters}")
+            except Exception as e:
+                logger.warning(f"Pre-check failed: {e}")
+                available_count = None
 
         # Get AI response (synchronous) - passa contexto de selecao se houver
         # Para landing leads, passa contexto do imovel especifico
@@ -2762,17 +3853,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
             )
 
         # Detecta se AI disse que vai enviar opcoes na RESPOSTA
-        ai_lower = ai_response.lower()
-        ai_will_send = any(phrase in ai_lower for phrase in [
-            "vou te enviar",
-            "vou enviar",
-            "enviar algumas",
-            "enviar opcoes",
-            "enviar opções",
-            "te mostrar algumas",
-            "mostrar algumas opcoes",
-            "mostrar algumas opções"
-        ])
+        ai_will_send = AI_PROMISES_PROPERTIES_RE.search(ai_response) is not None
 
         # ===== DECISAO: ENVIAR OPCOES OU NAO =====
         # Verificar se lead já tem visita agendada - NÃO enviar mais opções
@@ -2793,7 +3874,7 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
 
         # Save AI response to history (user message already added at start)
         add_to_history(conversation_id, "assistant", ai_response)
-        logger.info(f"Conversation history updated for {conversation_id} ({len(get_conversation_history(conversation_id))} messages)")
+        logger.info(f"Conversation history updated for {conversation_id} ({len(conversation_history.get(conversation_id, ()))} messages)")
 
         # Humanized delay before sending (simulates reading + typing)
         delay = calculate_human_delay(ai_response)
@@ -2802,59 +3883,35 @@ def process_message_sync(message_data: dict[str, Any]) -> dict[str, Any]:
         # Mostrar "digitando..." no WhatsApp do lead
         send_typing_indicator_sync(session, from_number)
 
-        time.sleep(delay)
-
-        # Send response via WhatsApp using direct WAHA API call (synchronous)
-        send_result = send_waha_message_sync(session, from_number, ai_response)
-
-        logger.info(f"Successfully sent AI response to {from_number}")
-
-        # Se deve enviar fotos (usuario pediu OU AI disse que vai enviar)
-        properties_sent = 0
+        # O tempo ja gasto com IA/Memude conta como "digitacao"; o envio e agendado para o
+        # restante em vez de prender o worker dormindo
+        remaining = max(0.0, delay - (time.monotonic() - started_at))
         if should_send_properties:
             logger.info(f"Sending properties to {from_number} (user_request={user_wants_properties}, ai_promised={ai_will_send})")
-            time.sleep(2)  # Pequeno delay antes das fotos
-
-            # Extrai filtros da conversa (bairro, quartos, preco)
-            filters = extract_filters_from_history(conversation_id)
-            logger.info(f"Extracted filters from conversation: {filters}")
-
-            # Busca e envia imoveis com filtros
-            properties_sent = send_properties_to_lead(session, from_number, filters=filters, conversation_id=conversation_id)
-
-            if properties_sent > 0:
-                time.sleep(1)
-                send_waha_message_sync(
-                    session,
-                    from_number,
-                    f"Enviei {properties_sent} opcoes para voce. Algum te interessou?"
-                )
+        followup_scheduler.schedule(
+            remaining, deliver_ai_response, session, from_number, conversation_id, ai_response, should_send_properties,
+            lead_ai_data,
+        )
 
         # ===== AGENDAR FOLLOW-UP PARA LEAD FRIO =====
         # Verificar se NÃO deve agendar follow-up frio
-        message_lower = message_text.lower()
         should_skip_cold_followup = (
             active_visit is not None or  # Visita já agendada = follow-up de visita cobre
-            "sem interesse" in message_lower or
-            "nao quero" in message_lower or
-            "nao tenho interesse" in message_lower or
-            "nao preciso" in message_lower or
-            "desisto" in message_lower or
-            "cancelar" in message_lower
+            SKIP_COLD_FOLLOWUP_RE.search(message_text) is not None
         )
 
         if not should_skip_cold_followup:
             # Agendar follow-up caso lead não responda
-            schedule_cold_lead_followup(conversation_id, ai_response)
+            schedule_cold_lead_followup(conversation_id)
         else:
             logger.info(f"Skipping cold lead follow-up for {conversation_id} (active_visit or no interest)")
 
         return {
             "status": "success",
             "from_number": from_number,
-            "response_sent": True,
-            "properties_sent": properties_sent,
-            "message_id": send_result.get("id", "")
+            "response_scheduled": True,
+            "send_properties": should_send_properties,
+            "delivery_delay": round(remaining, 1)
         }
 
     except Exception as e:
@@ -2898,6 +3955,14 @@ def webhook():
                 "reason": "Message filtered (not processable)"
             }), 200
 
+        # Reentrega do mesmo webhook: evita chamada de IA e resposta duplicadas
+        if is_duplicate_message(message_data["message_id"]):
+            logger.info(f"Duplicate webhook ignored: {message_data['message_id']}")
+            return jsonify({
+                "status": "ignored",
+                "reason": "Duplicate message"
+            }), 200
+
         # Add to buffer instead of processing immediately
         # This allows aggregating multiple consecutive messages
         add_to_message_buffer(
@@ -2931,10 +3996,7 @@ def health():
 
     Returns server status and statistics.
     """
-    uptime_seconds = (
-        datetime.utcnow() -
-        datetime.fromisoformat(stats["server_started_at"])
-    ).total_seconds()
+    uptime_seconds = time.monotonic() - BOOT_MONOTONIC
 
     return jsonify({
         "status": "healthy",
@@ -2965,11 +4027,23 @@ def list_visits():
     List all scheduled visits.
 
     Returns list of scheduled visits for debugging/monitoring.
+
+    Query params:
+        due_before: ISO datetime; only pending/confirmed visits scheduled until then
     """
+    due_before = request.args.get("due_before")
+    if due_before:
+        try:
+            visits = visits_due_before(datetime.fromisoformat(due_before))
+        except ValueError:
+            return jsonify({"error": "due_before deve ser uma data ISO (ex: 2025-01-31T18:00)"}), 400
+    else:
+        visits = list(scheduled_visits.values())
+
     return jsonify({
-        "visits": list(scheduled_visits.values()),
-        "count": len(scheduled_visits),
-        "timestamp": datetime.now().isoformat()
+        "visits": visits,
+        "count": len(visits),
+        "timestamp": iso_now()
     }), 200
 
 
@@ -3011,17 +4085,17 @@ def register_landing_lead():
             return jsonify({"error": "phone e property.title sao obrigatorios"}), 400
 
         # Normaliza telefone (remove caracteres)
-        phone = re.sub(r'\D', '', phone)
+        phone = NON_DIGIT_RE.sub('', phone)
         if not phone.startswith("55"):
             phone = f"55{phone}"
 
         # Formata preco
         price = prop.get("price", 0)
-        price_formatted = f"R$ {price:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if price else "Consultar"
+        price_formatted = format_brl(price, 2) if price else "Consultar"
 
         # Registra lead com dados do imovel embutidos
         with get_db() as conn:
-            conn.execute('''
+            cursor = conn.execute('''
                 INSERT INTO landing_leads_v2
                 (phone, name, source_url, property_title, property_price, property_price_formatted,
                  property_neighborhood, property_bedrooms, property_area, property_image_url,
@@ -3040,7 +4114,7 @@ def register_landing_lead():
                 prop.get("description", "")
             ))
             conn.commit()
-            lead_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            lead_id = cursor.lastrowid
 
         # Agenda follow-up em 5 minutos
         schedule_followup(lead_id, phone, delay_seconds=300)
@@ -3067,7 +4141,7 @@ def list_landing_leads():
                 SELECT * FROM landing_leads_v2
                 ORDER BY registered_at DESC
             ''')
-            leads = [dict(row) for row in cursor.fetchall()]
+            leads = [public_row(row, LANDING_LEAD_INTERNAL_COLUMNS) for row in cursor.fetchall()]
 
         return jsonify({"leads": leads, "count": len(leads)}), 200
 
@@ -3207,7 +4281,7 @@ def dashboard_get_lead(lead_id: int):
 
             visits = []
             for row in visits_cursor:
-                visit = dict(row)
+                visit = public_row(row, VISIT_INTERNAL_COLUMNS)
                 # Deserializar JSON
                 if visit.get("property_info"):
                     try:
@@ -3249,6 +4323,7 @@ def dashboard_get_lead_conversation(lead_id: int):
     """
     Retorna historico de conversa de um lead.
     """
+    flush_pending_messages()  # Inclui mensagens ainda no buffer de write-behind
     try:
         with get_db() as conn:
             # Buscar lead para obter o telefone
@@ -3277,7 +4352,7 @@ def dashboard_get_lead_conversation(lead_id: int):
                 SELECT id, role, content, created_at
                 FROM conversation_messages
                 WHERE conversation_id IN ({placeholders})
-                ORDER BY created_at ASC
+                ORDER BY created_at ASC, id ASC
             ''', conversation_ids)
 
             # Transformar para formato esperado pelo frontend
@@ -3365,7 +4440,7 @@ def dashboard_update_lead(lead_id: int):
                 (lead_id,)
             ).fetchone()
 
-            return jsonify(dict(updated_lead)), 200
+            return jsonify(public_row(updated_lead, LANDING_LEAD_INTERNAL_COLUMNS)), 200
 
     except Exception as e:
         logger.exception(f"Error updating lead {lead_id}: {e}")
@@ -3436,7 +4511,7 @@ def dashboard_get_visits():
 
             visits = []
             for row in cursor.fetchall():
-                visit = dict(row)
+                visit = public_row(row, VISIT_INTERNAL_COLUMNS)
                 # Deserializar JSON
                 if visit.get("lead_data"):
                     try:
@@ -3508,7 +4583,7 @@ def dashboard_get_visit(visit_uuid: str):
             if not visit:
                 return jsonify({"error": "Visit not found"}), 404
 
-            visit_data = dict(visit)
+            visit_data = public_row(visit, VISIT_INTERNAL_COLUMNS)
 
             # Deserializar JSON
             if visit_data.get("lead_data"):
@@ -3602,6 +4677,7 @@ def dashboard_update_visit(visit_uuid: str):
             # Executar update
             conn.execute(update_sql, params)
             conn.commit()
+            invalidate_visit_history_cache()
 
             # Retornar visita atualizada
             updated_visit = conn.execute(
@@ -3609,7 +4685,7 @@ def dashboard_update_visit(visit_uuid: str):
                 (visit_uuid,)
             ).fetchone()
 
-            visit_data = dict(updated_visit)
+            visit_data = public_row(updated_visit, VISIT_INTERNAL_COLUMNS)
 
             # Deserializar JSON
             if visit_data.get("lead_data"):
@@ -4476,7 +5552,7 @@ if __name__ == "__main__":
     logger.info(f"Host: {WEBHOOK_HOST}")
     logger.info(f"Port: {WEBHOOK_PORT}")
     logger.info(f"Debug: {DEBUG_MODE}")
-    logger.info(f"OpenRouter API Key: {'*' * 20}{OPENROUTER_API_KEY[-10:]}")
+    logger.info(f"OpenRouter API Key: {'*' * 20 + OPENROUTER_API_KEY[-10:] if OPENROUTER_API_KEY else 'NOT SET'}")
     logger.info("=" * 80)
     logger.info("Endpoints:")
     logger.info("  POST /api/v1/whatsapp/webhook - Receive messages")